@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-in for the Elasticsearch endpoints used by the app: search, scroll, mget, aggregations, index stats and mappings
+
+Responses go through JSON serialization, so the parsing cost paid by the clients is measured, and an optional latency models the network round-trip.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from localsearch import DirectoryIndex
+
+# Elasticsearch field type for each pandas dtype kind, the same mapping used by scripts/bootstrap_elasticsearch.py
+FIELD_TYPES = {
+    'i': 'long',
+    'u': 'long',
+    'f': 'double',
+    'b': 'boolean',
+    'M': 'date',
+    'O': 'keyword'
+}
+
+# metric aggregations computed by the stand-in, the other sub-aggregations are nested bucket aggregations
+METRIC_TYPES = ('value_count', 'sum', 'cardinality', 'avg', 'percentiles')
+
+# pandas period of each calendar interval of date histograms
+CALENDAR_PERIODS = {
+    'day': 'D',
+    'week': 'W',
+    'month': 'M',
+    'quarter': 'Q'
+}
+
+def to_wire(payload):
+    """Serializes and parses a response, as it would be sent over the network"""
+    return json.loads(json.dumps(payload))
+
+def select_source(source, includes):
+    """Applies _source filtering to a document, supporting dotted paths to nested fields"""
+    if(includes is None or includes is True):
+        return source
+    if(includes is False):
+        return None
+
+    selected = {}
+    for path in ([includes] if isinstance(includes, str) else includes):
+        value, target, keys = source, selected, path.split('.')
+        for key in keys:
+            if(not isinstance(value, dict) or key not in value):
+                break
+            value = value[key]
+        else:
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return selected
+
+
+class FakeDocumentIndex:
+    """Index of json documents (the directory), searched with match_all or multi_match queries
+
+    Args:
+        name (str): name of the index
+        documents (dict): documents by id
+
+    Attributes:
+        name (str): name of the index
+        uuid (str): random uuid of the index, changes when the index is recreated
+        documents (dict): documents by id
+        sequence_numbers (dict): sequence number of each document
+        text_index (localsearch.DirectoryIndex): BM25 index over the text fields, used to score multi_match queries
+
+    """
+    def __init__(self, name, documents):
+        self.name = name
+        self.uuid = uuid.uuid4().hex
+        self.documents = {}
+        self.sequence_numbers = {}
+        self.text_index = DirectoryIndex(None, None, name)
+        for doc_id, document in documents.items():
+            self.documents[doc_id] = document
+            self.sequence_numbers[doc_id] = len(self.sequence_numbers)
+            self.text_index.add_document(doc_id, document)
+        self.text_index.vocabulary = sorted(set(term for field in self.text_index.fields for term in self.text_index.postings[field]))
+
+    @property
+    def count(self):
+        return len(self.documents)
+
+    def get_mapping(self):
+        def infer(value):
+            if(isinstance(value, dict)):
+                return {'properties': {key: infer(item) for key, item in value.items()}}
+            if(isinstance(value, bool)):
+                return {'type': 'boolean'}
+            if(isinstance(value, int)):
+                return {'type': 'long'}
+            if(isinstance(value, float)):
+                return {'type': 'float'}
+            if(isinstance(value, list)):
+                return infer(value[0]) if value else {'type': 'keyword'}
+            return {'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+
+        properties = {}
+        for document in self.documents.values():
+            for key, value in document.items():
+                properties.setdefault(key, infer(value))
+        return {'properties': properties}
+
+    def match(self, query):
+        """Finds the documents matching a query, with their scores"""
+        if('multi_match' in query):
+            fields = {}
+            for field in query['multi_match']['fields']:
+                name, _, boost = field.partition('^')
+                fields[name] = float(boost or 1)
+            return self.text_index.score(query['multi_match']['query'], fields, prefix=False)
+        if('match_all' in query):
+            return {doc_id: 1.0 for doc_id in self.documents}
+        raise NotImplementedError(f'{sorted(query)} queries are not supported by the stand-in')
+
+    def get_sort_value(self, doc_id, field):
+        value = self.documents[doc_id]
+        for key in field.replace('.keyword', '').split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        return value if value is not None else doc_id
+
+    def build_hits(self, entries, source, seq_no):
+        hits = []
+        for doc_id, score, sort in entries:
+            hit = {'_index': self.name, '_type': '_doc', '_id': doc_id, '_score': score}
+            if(source is not False):
+                hit['_source'] = select_source(self.documents[doc_id], source)
+            if(seq_no):
+                hit['_seq_no'] = self.sequence_numbers[doc_id]
+                hit['_primary_term'] = 1
+            if(sort is not None):
+                hit['sort'] = sort
+            hits.append(hit)
+        return to_wire(hits)
+
+    def search(self, body):
+        """Runs a query, returning the sorted (doc_id, score, sort values) entries"""
+        scores = self.match(body.get('query', {'match_all': {}}))
+        sort = body.get('sort', ['_score'])
+        sort = [entry for entry in ([sort] if isinstance(sort, (str, dict)) else sort) if entry != '_doc']
+
+        if(not sort):
+            return [(doc_id, score, None) for doc_id, score in scores.items()]
+
+        # descending scores, ascending values for the other fields
+        fields = [entry if isinstance(entry, str) else next(iter(entry)) for entry in sort]
+        def sort_key(values):
+            return tuple(-value if field == '_score' else value for field, value in zip(fields, values))
+
+        entries = []
+        for doc_id, score in scores.items():
+            values = [score if field == '_score' else self.get_sort_value(doc_id, field) for field in fields]
+            entries.append((doc_id, score, values))
+        entries.sort(key=lambda entry: sort_key(entry[2]))
+
+        if('search_after' in body):
+            after = sort_key(body['search_after'])
+            entries = [entry for entry in entries if sort_key(entry[2]) > after]
+        return entries
+
+
+class FakeFrameIndex:
+    """Index of tabular documents (the data index), held as a dataframe, supporting match_all scans and aggregations
+
+    Args:
+        name (str): name of the index
+        frame (pandas.DataFrame): documents, indexed by document id
+
+    Attributes:
+        name (str): name of the index
+        uuid (str): random uuid of the index, changes when the index is recreated
+        frame (pandas.DataFrame): documents, indexed by document id
+
+    """
+    def __init__(self, name, frame):
+        self.name = name
+        self.uuid = uuid.uuid4().hex
+        self.frame = frame
+
+    @property
+    def count(self):
+        return len(self.frame)
+
+    def get_mapping(self):
+        return {'properties': {column: {'type': FIELD_TYPES.get(dtype.kind, 'keyword')} for column, dtype in self.frame.dtypes.items()}}
+
+    def search(self, body):
+        query = body.get('query', {'match_all': {}})
+        positions = np.arange(len(self.frame))
+        if('bool' in query):
+            # only "exists" and "range" filters are supported, keeping the documents matching every filter
+            for clause in query['bool'].get('filter', []):
+                positions = positions[self.match_filter(clause, positions)]
+        elif('range' in query):
+            positions = positions[self.match_filter(query, positions)]
+        elif('match_all' not in query):
+            raise NotImplementedError(f'{sorted(query)} queries are not supported on tabular indices by the stand-in')
+
+        # sliced scrolls split the documents by position, where Elasticsearch hashes their ids
+        if('slice' in body):
+            positions = positions[positions % body['slice']['max'] == body['slice']['id']]
+        return positions
+
+    def match_filter(self, clause, positions):
+        """Evaluates an "exists" or "range" filter on the documents at the given positions, as a mask"""
+        if('exists' in clause):
+            return self.frame[clause['exists']['field']].iloc[positions].notna().to_numpy()
+        if('range' in clause):
+            field, bounds = next(iter(clause['range'].items()))
+            values = self.frame[field].iloc[positions]
+            mask = values.notna().to_numpy().copy()
+            comparisons = {'gt': np.greater, 'gte': np.greater_equal, 'lt': np.less, 'lte': np.less_equal}
+            for operator, bound in bounds.items():
+                bound = pd.Timestamp(bound) if values.dtype.kind == 'M' else bound
+                mask &= np.asarray(comparisons[operator](values, bound))
+            return mask
+        raise NotImplementedError(f'{sorted(clause)} filters are not supported on tabular indices by the stand-in')
+
+    def build_hits(self, positions, source, seq_no):
+        page = self.frame.iloc[positions]
+        if(source is not None and source is not True and source is not False):
+            page = page[[source] if isinstance(source, str) else list(source)]
+
+        # documents are serialized the way Elasticsearch stores them, dates as ISO strings
+        sources = json.loads(page.to_json(orient='records', date_format='iso', date_unit='ms')) if source is not False else [None] * len(page)
+        hits = []
+        for position, doc_id, document in zip(positions, page.index, sources):
+            hit = {'_index': self.name, '_type': '_doc', '_id': doc_id, '_score': 1.0}
+            if(document is not None):
+                hit['_source'] = document
+            if(seq_no):
+                hit['_seq_no'] = int(position)
+                hit['_primary_term'] = 1
+            hits.append(hit)
+        return hits
+
+    def compute_metric(self, frame, groups, metric):
+        """Computes a metric aggregation for each group of a frame, as {group: metric response}"""
+        metric_type, params = next(iter(metric.items()))
+        grouped = frame[params['field']].groupby(groups)
+
+        if(metric_type == 'value_count'):
+            return {key: {'value': int(value)} for key, value in grouped.count().items()}
+        if(metric_type == 'sum'):
+            return {key: {'value': float(value)} for key, value in grouped.sum().items()}
+        if(metric_type == 'cardinality'):
+            return {key: {'value': int(value)} for key, value in grouped.nunique().items()}
+        if(metric_type == 'avg'):
+            return {key: {'value': float(value)} for key, value in grouped.mean().items()}
+        if(metric_type == 'percentiles'):
+            percentiles = {float(q): grouped.quantile(q / 100) for q in params.get('percents', [50])}
+            return {key: {'values': {str(q): float(values[key]) for q, values in percentiles.items()}} for key in grouped.groups}
+        raise NotImplementedError(f'{metric_type} aggregation is not supported by the stand-in')
+
+    def aggregate(self, aggregations, positions=None):
+        """Computes bucket aggregations with metric sub-aggregations over the documents matching the query, as built by searchutils.AggregationSearcher"""
+        frame = self.frame if positions is None else self.frame.iloc[positions]
+        return to_wire(self.aggregate_frame(aggregations, frame))
+
+    def aggregate_frame(self, aggregations, frame):
+        """Computes bucket aggregations over a subset of the documents, nested bucket aggregations recursing over the documents of each bucket"""
+        # metrics of empty buckets, kept by date histograms with min_doc_count 0
+        empty_metrics = {'value_count': {'value': 0}, 'cardinality': {'value': 0}, 'sum': {'value': 0.0}, 'avg': {'value': None}}
+
+        results = {}
+        for name, definition in aggregations.items():
+            sub_aggregations = definition.get('aggs', definition.get('aggregations', {}))
+            metric_aggregations = {
+                metric_name: metric for metric_name, metric in sub_aggregations.items() if next(iter(metric)) in METRIC_TYPES
+            }
+            bucket_aggregations = {
+                bucket_name: bucket for bucket_name, bucket in sub_aggregations.items() if bucket_name not in metric_aggregations
+            }
+            bucket_type = next(key for key in definition if key not in ('aggs', 'aggregations'))
+            params = definition[bucket_type]
+            field = frame[params['field']]
+
+            if(bucket_type == 'terms'):
+                groups = field.where(field.isin(params['include'])) if 'include' in params else field
+            elif(bucket_type == 'date_histogram'):
+                dates = pd.to_datetime(field)
+                period = CALENDAR_PERIODS[params['calendar_interval']]
+                groups = dates.dt.floor('D') if period == 'D' else dates.dt.to_period(period).dt.start_time
+            else:
+                raise NotImplementedError(f'{bucket_type} aggregation is not supported by the stand-in')
+
+            counts = groups.value_counts().sort_index()
+            metrics = {metric_name: self.compute_metric(frame, groups, metric) for metric_name, metric in metric_aggregations.items()}
+            subsets = dict(iter(frame.groupby(groups))) if bucket_aggregations else {}
+
+            if(bucket_type == 'date_histogram' and len(counts) and params.get('min_doc_count', 0) == 0):
+                periods = pd.period_range(counts.index.min(), counts.index.max(), freq=period)
+                counts = counts.reindex(periods.start_time, fill_value=0)
+
+            buckets = []
+            for key, doc_count in counts.items():
+                bucket = {'key': key, 'doc_count': int(doc_count)}
+                for metric_name, metric in metric_aggregations.items():
+                    metric_type, metric_params = next(iter(metric.items()))
+                    default = empty_metrics.get(metric_type, {'values': {str(float(q)): None for q in metric_params.get('percents', [50])}})
+                    bucket[metric_name] = metrics[metric_name].get(key, default)
+                if(bucket_aggregations):
+                    bucket.update(self.aggregate_frame(bucket_aggregations, subsets.get(key, frame.iloc[:0])))
+                buckets.append(bucket)
+
+            if(bucket_type == 'date_histogram'):
+                for bucket in buckets:
+                    bucket['key_as_string'] = bucket['key'].isoformat()
+                    bucket['key'] = int(bucket['key'].value // 10**6)
+                results[name] = {'buckets': buckets}
+            else:
+                order_key, direction = next(iter(params.get('order', {'_count': 'desc'}).items()))
+
+                def sort_value(bucket):
+                    if(order_key == '_count'):
+                        return bucket['doc_count']
+                    metric_name, _, percentile = order_key.partition('[')
+                    metric = bucket[metric_name]
+                    value = metric['values'][percentile.rstrip(']')] if percentile else metric['value']
+                    return value if value is not None else -np.inf
+
+                buckets.sort(key=sort_value, reverse=(direction == 'desc'))
+                size = params.get('size', 10)
+                results[name] = {
+                    'doc_count_error_upper_bound': 0,
+                    'sum_other_doc_count': sum(bucket['doc_count'] for bucket in buckets[size:]),
+                    'buckets': buckets[:size]
+                }
+        return results
+
+
+class FakeIndicesClient:
+    """Stand-in for the indices namespace of the client"""
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index, **params):
+        return index in self.client.indices_data
+
+    def refresh(self, index=None, **params):
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def stats(self, index=None, metric=None, **params):
+        self.client.wait()
+        return to_wire({'indices': {
+            target.name: {'uuid': target.uuid, 'primaries': {'docs': {'count': target.count, 'deleted': 0}}}
+            for target in self.client.resolve(index)
+        }})
+
+    def get_mapping(self, index=None, **params):
+        self.client.wait()
+        return to_wire({target.name: {'mappings': target.get_mapping()} for target in self.client.resolve(index)})
+
+
+class FakeElasticsearch:
+    """In-process stand-in for the low-level Elasticsearch client, holding its indices in memory
+
+    Args:
+        latency (float): seconds added to every request, modelling the network round-trip. Defaults to 0.
+
+    Attributes:
+        latency (float): seconds added to every request
+        indices_data (dict): indices by name
+        scrolls (dict): open scroll contexts by scroll id
+        requests (int): number of requests served
+
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.indices_data = {}
+        self.scrolls = {}
+        self.requests = 0
+        self.indices = FakeIndicesClient(self)
+
+    def add_documents(self, index, documents):
+        """Creates an index of json documents, replacing any index with the same name
+
+        Args:
+            index (str): name of the index
+            documents (dict): documents by id
+
+        Returns:
+            None
+        """
+        self.indices_data[index] = FakeDocumentIndex(index, documents)
+
+    def add_frame(self, index, frame):
+        """Creates an index of tabular documents, replacing any index with the same name
+
+        Args:
+            index (str): name of the index
+            frame (pandas.DataFrame): documents, indexed by document id
+
+        Returns:
+            None
+        """
+        self.indices_data[index] = FakeFrameIndex(index, frame)
+
+    def append_frame(self, index, frame):
+        """Appends tabular documents to an existing index, which keeps its uuid as when documents are indexed into it
+
+        Args:
+            index (str): name of the index
+            frame (pandas.DataFrame): new documents, indexed by document id
+
+        Returns:
+            None
+        """
+        target = self.indices_data[index]
+        target.frame = pd.concat([target.frame, frame])
+
+    def wait(self):
+        self.requests += 1
+        if(self.latency):
+            time.sleep(self.latency)
+
+    def resolve(self, index):
+        names = index if isinstance(index, (list, tuple)) else str(index).split(',')
+        return [self.indices_data[name] for name in names]
+
+    def search(self, body=None, index=None, scroll=None, size=None, **params):
+        self.wait()
+        # newer clients send the body keys as keyword arguments
+        body = dict(body or {})
+        body.update({key.rstrip('_'): value for key, value in params.items() if key not in ('request_timeout', 'params', 'headers', 'ignore')})
+        target = self.resolve(index)[0]
+        size = body.get('size', size if size is not None else 10)
+        source = body.get('_source', True)
+        seq_no = body.get('seq_no_primary_term', False)
+
+        entries = target.search(body)
+        response = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(entries), 'relation': 'eq'}, 'max_score': None, 'hits': []}
+        }
+
+        if(scroll is not None):
+            scroll_id = uuid.uuid4().hex
+            self.scrolls[scroll_id] = (target, entries, size, source, seq_no)
+            response['_scroll_id'] = scroll_id
+            response['hits']['hits'] = target.build_hits(entries[:size], source, seq_no)
+            self.scrolls[scroll_id] = (target, entries[size:], size, source, seq_no)
+        else:
+            response['hits']['hits'] = target.build_hits(entries[body.get('from', 0):body.get('from', 0) + size], source, seq_no)
+
+        if('aggs' in body or 'aggregations' in body):
+            response['aggregations'] = target.aggregate(body.get('aggs', body.get('aggregations')), entries)
+        return response
+
+    def scroll(self, body=None, scroll_id=None, **params):
+        self.wait()
+        scroll_id = scroll_id or body['scroll_id']
+        target, entries, size, source, seq_no = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (target, entries[size:], size, source, seq_no)
+        return {
+            '_scroll_id': scroll_id,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(entries), 'relation': 'eq'}, 'hits': target.build_hits(entries[:size], source, seq_no)}
+        }
+
+    def clear_scroll(self, body=None, scroll_id=None, **params):
+        self.wait()
+        scroll_ids = scroll_id or body['scroll_id']
+        for scroll_id in ([scroll_ids] if isinstance(scroll_ids, str) else scroll_ids):
+            self.scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    def mget(self, body=None, index=None, **params):
+        self.wait()
+        target = self.resolve(index)[0]
+        docs = []
+        for doc_id in body['ids']:
+            if(doc_id in target.documents):
+                docs.append({'_index': target.name, '_id': doc_id, 'found': True,
+                             '_seq_no': target.sequence_numbers[doc_id], '_source': target.documents[doc_id]})
+            else:
+                docs.append({'_index': target.name, '_id': doc_id, 'found': False})
+        return to_wire({'docs': docs})
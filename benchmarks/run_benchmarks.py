@@ -0,0 +1,362 @@
+"""
+Times each stage of the app (directory search, dataset load, aggregation, downloads) on synthetic data, across dataset sizes
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 100000,1000000 --output results.json
+    python benchmarks/run_benchmarks.py --sizes 100000 --baseline results.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from elasticsearch.helpers import scan
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from components import Download, Visualizer, ElasticVisualizer, StreamingVisualizer
+from aggregations import AggregationPlanner
+from caching import AggregationCache
+from searchutils import MultiMatchSearcher, AggregationSearcher, DirectoryScanner
+from localsearch import DirectoryIndex, LocalMultiMatchSearcher
+from datasets import ProjectedDataset
+from snapshots import SnapshotStore, SharedSnapshotStore
+from exports import ExportSource
+from plans import SpecCompiler
+from rollups import RollupStore
+from streaming import StreamingAggregator, PartialAggregate
+from reductions import reduce_output
+
+from synthetic import generate_orders, generate_directory, load_repository_specs
+from fake_elasticsearch import FakeElasticsearch
+
+DIRECTORY_INDEX = 'directory'
+DATA_INDEX = 'orders'
+CLUSTER = 'http://benchmark:9200'
+
+# slices read in parallel by the streaming aggregation stage
+STREAM_SLICES = 4
+
+# documents appended to the data index before each incremental refresh, as a fraction of its rows
+APPEND_FRACTION = 0.01
+
+# search inputs cycled through by the directory search stages
+QUERIES = ['top sellers', 'monthly orders', 'product categories', 'revenue by state', 'freight', 'sales 2018']
+
+def parse_arguments():
+    """Parses the command line arguments of the benchmark"""
+    parser = argparse.ArgumentParser(description='Times each stage of the app on synthetic Olist-shaped data, with an in-process Elasticsearch stand-in')
+    parser.add_argument('--sizes', default='100000,1000000', help='comma separated list of dataset sizes (rows)')
+    parser.add_argument('--directory-size', type=int, default=1000, help='number of specs in the directory index')
+    parser.add_argument('--repeat', type=int, default=20, help='number of timed runs of the fast stages')
+    parser.add_argument('--load-repeat', type=int, default=3, help='number of timed runs of the dataset load stages')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every Elasticsearch request, modelling the network round-trip')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+    parser.add_argument('--no-memory', action='store_true', help='skips the peak memory measurements, which run each stage once more under tracemalloc')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON file of a previous run, the p50 latency of each stage is compared against it')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative p50 slowdown over the baseline reported as a regression')
+    parser.add_argument('--min-delta', type=float, default=1.0, help='p50 slowdowns below this many milliseconds are ignored as noise')
+    return parser.parse_args()
+
+
+class ScanDataset(ProjectedDataset):
+    """Projected dataset fetching columns through a scroll over the stand-in, the same transfer Eland performs against a cluster"""
+    def __init__(self, es_client, index_reference, version, store=None, watermark_field=None):
+        ProjectedDataset.__init__(self, CLUSTER, index_reference, version, store, watermark_field)
+        self.es_client = es_client
+
+    def fetch_columns(self, columns):
+        return self.scan_columns(columns, {'match_all': {}})
+
+    def fetch_appended(self, columns, watermark):
+        return self.scan_columns(columns, {'range': {self.watermark_field: {'gte': watermark}}})
+
+    def count_documents(self):
+        stats = self.es_client.indices.stats(index=self.index_reference, metric='docs')
+        docs = [index_stats['primaries']['docs'] for index_stats in stats['indices'].values()]
+        return sum(index_docs['count'] for index_docs in docs), sum(index_docs['deleted'] for index_docs in docs)
+
+    def scan_columns(self, columns, query):
+        hits = scan(self.es_client, index=self.index_reference, query={'query': query, '_source': columns}, size=10000)
+        ids, rows = [], []
+        for hit in hits:
+            ids.append(hit['_id'])
+            rows.append(hit['_source'])
+
+        frame = pd.DataFrame.from_records(rows, columns=columns)
+        frame.index = pd.Index(ids, dtype=object, name='_id')
+
+        # date fields are parsed from their ISO representation, as Eland does with the index mapping
+        mapping = self.es_client.indices.get_mapping(index=self.index_reference)[self.index_reference]['mappings']['properties']
+        for column in columns:
+            if(mapping[column]['type'] == 'date'):
+                frame[column] = pd.to_datetime(frame[column])
+        return frame
+
+
+class NullSink(io.RawIOBase):
+    """Write-only file object discarding the data, used to time exports without a network"""
+    def __init__(self):
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = memoryview(data).nbytes
+        self.position += size
+        return size
+
+    def tell(self):
+        return self.position
+
+
+def measure(function, repeat, memory=True):
+    """Runs a stage several times, measuring its latency and (on one extra run) its peak traced memory
+
+    Args:
+        function (callable): stage to run, without arguments
+        repeat (int): number of timed runs
+        memory (bool): runs the stage once more under tracemalloc to measure its peak memory. Defaults to True.
+
+    Returns:
+        result (dict): latency percentiles in milliseconds, peak memory in megabytes and number of runs
+    """
+    # warm-up run, so lazy imports and first-time allocations are not timed
+    function()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    result = {
+        'runs': repeat,
+        'mean_ms': float(np.mean(timings)),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p90_ms': float(np.percentile(timings, 90)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'max_ms': float(np.max(timings)),
+        'peak_mb': None
+    }
+    if(memory):
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_mb'] = peak / 2**20
+    return result
+
+def run_size(rows, arguments, directory_specs):
+    """Runs every stage on a dataset of the given size
+
+    Args:
+        rows (int): number of rows of the synthetic data index
+        arguments (argparse.Namespace): benchmark parameters
+        directory_specs (list): specs of the synthetic directory index
+
+    Returns:
+        results (list): one result per stage
+    """
+    memory = not arguments.no_memory
+    es = FakeElasticsearch(arguments.latency)
+    es.add_documents(DIRECTORY_INDEX, {spec['spec_id']: spec for spec in directory_specs})
+    es.add_frame(DATA_INDEX, generate_orders(rows, seed=arguments.seed))
+
+    results = []
+    def record(stage, function, repeat=arguments.repeat, spec_id=None):
+        result = measure(function, repeat, memory)
+        result.update({'stage': stage, 'spec_id': spec_id, 'rows': rows})
+        results.append(result)
+        print(f"{rows:>12,} rows | {stage:<24} {spec_id or '':<26} p50 {result['p50_ms']:>10.2f} ms | p99 {result['p99_ms']:>10.2f} ms"
+              + (f" | peak {result['peak_mb']:>9.1f} MB" if memory else ''))
+
+    # directory search, through Elasticsearch and through the in-process index
+    queries = iter(QUERIES * (arguments.repeat + 2))
+    searcher = MultiMatchSearcher(es, CLUSTER, DIRECTORY_INDEX)
+    def search_directory():
+        searcher.build_query_object(next(queries))
+        searcher.search_data_directory(size=5)
+    record('directory_search', search_directory)
+
+    directory_index = DirectoryIndex(es, CLUSTER, DIRECTORY_INDEX)
+    directory_index.refresh_index(force=True)
+    local_queries = iter(QUERIES * (arguments.repeat + 2))
+    local_searcher = LocalMultiMatchSearcher(es, CLUSTER, DIRECTORY_INDEX, directory_index)
+    def search_directory_locally():
+        local_searcher.build_query_object(next(local_queries))
+        local_searcher.search_data_directory(size=5)
+    record('directory_search_local', search_directory_locally)
+
+    # dataset load, from the data index and from a local snapshot
+    dimensions = DirectoryScanner(es, CLUSTER, DIRECTORY_INDEX).get_spec_dimensions()
+    version = DirectoryScanner(es, CLUSTER, DATA_INDEX).get_index_version()
+    record('dataset_load', lambda: ScanDataset(es, DATA_INDEX, version).load_columns(dimensions), arguments.load_repeat)
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        store = SnapshotStore(snapshot_dir)
+        ScanDataset(es, DATA_INDEX, version, store).load_columns(dimensions)
+        record('dataset_load_snapshot', lambda: ScanDataset(es, DATA_INDEX, version, store).load_columns(dimensions), arguments.load_repeat)
+
+    # worker process mapping the dataset published by another worker, with dictionary-encoded strings
+    with tempfile.TemporaryDirectory() as shared_dir:
+        shared_store = SharedSnapshotStore(shared_dir)
+        ScanDataset(es, DATA_INDEX, version, shared_store).load_columns(dimensions)
+        record('dataset_load_shared', lambda: ScanDataset(es, DATA_INDEX, version, shared_store).load_columns(dimensions), arguments.load_repeat)
+
+    dataset = ScanDataset(es, DATA_INDEX, version)
+    dataset.load_columns(dimensions)
+    compiler = SpecCompiler(DirectoryScanner(es, CLUSTER, DATA_INDEX).get_index_schema())
+    cubes = RollupStore()
+    executor = ThreadPoolExecutor(max_workers=STREAM_SLICES)
+
+    # aggregation of each repository spec, in pandas and pushed down to Elasticsearch
+    for spec in load_repository_specs():
+        visualizer = Visualizer(dataset, spec, compiler=compiler)
+        record('build_handle', visualizer.build_handle, spec_id=spec['spec_id'])
+        visualizer.build_handle()
+        record('make_aggregation', visualizer.make_aggregation, spec_id=spec['spec_id'])
+
+        elastic_visualizer = ElasticVisualizer(AggregationSearcher(es, CLUSTER, DATA_INDEX), spec, compiler=compiler)
+        elastic_visualizer.build_handle()
+        record('aggregation_pushdown', elastic_visualizer.make_aggregation, spec_id=spec['spec_id'])
+
+        # out-of-core aggregation, streaming the index over sliced scrolls read by a thread pool
+        streaming_visualizer = StreamingVisualizer(StreamingAggregator(es, DATA_INDEX, executor, STREAM_SLICES), spec, compiler=compiler)
+        streaming_visualizer.build_handle()
+        record('aggregation_streaming', streaming_visualizer.make_aggregation, arguments.load_repeat, spec_id=spec['spec_id'])
+
+        # timeseries specs narrowed to the middle half of their time span, answered from the daily rollup
+        plan = compiler.get_plan(spec)
+        if(cubes.supports(plan)):
+            first, last = cubes.get_cube(dataset, plan).get_bounds()
+            window = (first + (last - first) / 4, last - (last - first) / 4)
+            rollup_visualizer = Visualizer(dataset, spec, compiler=compiler, cubes=cubes, time_range=window)
+            record('rollup_window', rollup_visualizer.build_output, spec_id=spec['spec_id'])
+
+        # output reduced to the resolution of the chart before rendering
+        visualizer.make_aggregation()
+        output = visualizer.output
+        record('reduce_output', lambda: reduce_output(output, spec['specs'], plan), spec_id=spec['spec_id'])
+
+        # base64 link written to the page when no export server is configured
+        download = Download(visualizer.output)
+        def encode_download():
+            download.get_csv_data()
+            base64.b64encode(download.data.encode()).decode()
+        record('download_encode', encode_download, spec_id=spec['spec_id'])
+
+    # daily lines of the crosstab spec, with as many points as days in every panel
+    daily_spec = next(spec for spec in load_repository_specs() if spec['spec_id'] == 'revenue_by_state_category_month')
+    daily_spec = dict(daily_spec, spec_id='revenue_by_state_category_day', instructions=dict(daily_spec['instructions'], time_unit='day'))
+    daily_visualizer = Visualizer(dataset, daily_spec, compiler=compiler)
+    daily_visualizer.build_output()
+    daily_output, daily_plan = daily_visualizer.output, compiler.get_plan(daily_spec)
+    record('reduce_output', lambda: reduce_output(daily_output, daily_spec['specs'], daily_plan), spec_id=daily_spec['spec_id'])
+
+    # the underlying rows, inlined as base64 or streamed by the export server
+    rows_download = Download(dataset.data)
+    def encode_rows():
+        rows_download.get_csv_data()
+        base64.b64encode(rows_download.data.encode()).decode()
+    record('download_encode_rows', encode_rows, arguments.load_repeat)
+
+    for export_format in ('csv.gz', 'parquet'):
+        source = ExportSource(lambda: dataset.data, name='rows')
+        record(f'export_rows[{export_format}]', lambda: source.write(NullSink(), export_format, 50000), arguments.load_repeat)
+
+    # incremental refresh: documents appended above the high-water mark are pulled and merged into the cached outputs and the rollups
+    watermark_field = 'order_purchase_timestamp'
+    refreshed = ScanDataset(es, DATA_INDEX, version, watermark_field=watermark_field)
+    refreshed.load_columns(dimensions)
+    cache = AggregationCache(256 * 1024 ** 2)
+    refresh_cubes = RollupStore()
+    planner = AggregationPlanner(refreshed, load_repository_specs(), compiler, refresh_cubes, PartialAggregate.from_group_keys)
+    planner.prefetch(cache, 10)
+
+    batches = iter(range(1, arguments.repeat + 3))
+    def append_and_refresh():
+        # the documents are indexed in the stand-in before the refresh, which is part of the timing
+        batch = next(batches)
+        appended = generate_orders(max(int(rows * APPEND_FRACTION), 1), seed=arguments.seed + batch)
+        appended.index = pd.Index([f'append-{batch}-{i}' for i in range(len(appended))], dtype=object)
+        appended[watermark_field] = refreshed.data[watermark_field].max() + pd.to_timedelta(np.arange(len(appended)) % 86400, unit='s')
+        es.append_frame(DATA_INDEX, appended)
+
+        previous_version = refreshed.version
+        delta = refreshed.append_documents(DirectoryScanner(es, CLUSTER, DATA_INDEX).get_index_version())
+        cache.append_documents(refreshed, delta, previous_version)
+        refresh_cubes.append_documents(refreshed, delta, previous_version)
+    record('dataset_append', append_and_refresh)
+
+    executor.shutdown()
+    return results
+
+def compare(results, baseline, tolerance, min_delta):
+    """Compares the p50 latency of each stage against a previous run
+
+    Args:
+        results (list): results of this run
+        baseline (list): results of the previous run
+        tolerance (float): relative slowdown reported as a regression
+        min_delta (float): slowdowns below this many milliseconds are ignored as noise
+
+    Returns:
+        regressions (list): description of each stage slower than the baseline beyond the tolerance
+    """
+    previous = {(result['rows'], result['stage'], result['spec_id']): result for result in baseline}
+    regressions = []
+    for result in results:
+        key = (result['rows'], result['stage'], result['spec_id'])
+        if(key not in previous):
+            continue
+        before, after = previous[key]['p50_ms'], result['p50_ms']
+        if(after > before * (1 + tolerance) and after - before > min_delta):
+            stage = f"{result['stage']} ({result['spec_id']})" if result['spec_id'] else result['stage']
+            regressions.append(f"{stage} at {result['rows']:,} rows: "
+                               f"p50 {before:.2f} ms -> {after:.2f} ms")
+    return regressions
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    directory_specs = generate_directory(arguments.directory_size, seed=arguments.seed)
+
+    results = []
+    for rows in [int(size) for size in arguments.sizes.split(',')]:
+        results += run_size(rows, arguments, directory_specs)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'parameters': vars(arguments),
+        'results': results
+    }
+
+    if(arguments.output):
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f'Results written to {arguments.output}')
+
+    if(arguments.baseline):
+        with open(arguments.baseline, 'r') as baseline_file:
+            regressions = compare(results, json.load(baseline_file)['results'], arguments.tolerance, arguments.min_delta)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if(regressions):
+            raise SystemExit(1)
+        print(f'No regression beyond {arguments.tolerance:.0%} of the baseline p50 latencies')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data shaped like the Olist order items tables referenced by the specs, and synthetic directory specs
+"""
+
+import os
+import json
+import glob
+import numpy as np
+import pandas as pd
+
+STATES = ['SP', 'RJ', 'MG', 'RS', 'PR', 'SC', 'BA', 'DF', 'ES', 'GO', 'PE', 'CE', 'PA', 'MT', 'MA',
+          'MS', 'PB', 'PI', 'RN', 'AL', 'SE', 'TO', 'RO', 'AM', 'AC', 'AP', 'RR']
+
+SPECS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'specs')
+
+def zipf_weights(size, exponent=1.1):
+    """Skewed popularity weights, a few sellers and categories concentrate most orders as in the real dataset"""
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+def generate_orders(rows, sellers=3000, categories=73, seed=0):
+    """Generates order items with the columns used by the specs
+
+    Args:
+        rows (int): number of order items
+        sellers (int): number of distinct sellers. Defaults to 3000, as in the Olist dataset.
+        categories (int): number of distinct product categories. Defaults to 73, as in the Olist dataset.
+        seed (int): random seed, the same seed always generates the same data. Defaults to 0.
+
+    Returns:
+        pandas.DataFrame: order items indexed by document id
+    """
+    rng = np.random.default_rng(seed)
+
+    # about 1.15 items per order, as in the Olist dataset
+    orders = max(int(rows / 1.15), 1)
+    order_numbers = np.sort(rng.integers(0, orders, rows))
+
+    seller_names = np.array([f'Seller {i:05d} Comercio Ltda' for i in range(sellers)], dtype=object)
+    category_names = np.array([f'category_{i:03d}' for i in range(categories)], dtype=object)
+
+    start = np.datetime64('2016-09-04T00:00:00')
+    span = int((np.datetime64('2018-10-17T00:00:00') - start) / np.timedelta64(1, 's'))
+
+    # orders grow over time, as in the real dataset
+    order_times = start + (span * np.sqrt(rng.random(orders))).astype('timedelta64[s]')
+
+    frame = pd.DataFrame({
+        'order_id': pd.Series(order_numbers).map('{:032x}'.format).to_numpy(dtype=object),
+        'order_item_id': (pd.Series(order_numbers).groupby(order_numbers).cumcount() + 1).to_numpy(),
+        'seller_name': seller_names[rng.choice(sellers, rows, p=zipf_weights(sellers))],
+        'product_category_name': category_names[rng.choice(categories, rows, p=zipf_weights(categories))],
+        'customer_state': np.array(STATES, dtype=object)[rng.choice(len(STATES), rows, p=zipf_weights(len(STATES), 1.5))],
+        'price': np.round(rng.lognormal(4.4, 0.9, rows), 2),
+        'freight_value': np.round(rng.lognormal(2.8, 0.5, rows), 2),
+        'order_purchase_timestamp': order_times[order_numbers].astype('datetime64[ns]')
+    })
+    frame.index = pd.Index([f'doc-{i}' for i in range(rows)], dtype=object)
+    return frame
+
+def load_repository_specs():
+    """Loads the example specs of the repository, skipping the template
+
+    Returns:
+        specs (list): specs from the specs folder
+    """
+    specs = []
+    for spec_path in sorted(glob.glob(os.path.join(SPECS_DIR, '*.json'))):
+        if(os.path.basename(spec_path) != 'spec_template.json'):
+            with open(spec_path, 'r') as spec_file:
+                specs.append(json.load(spec_file))
+    return specs
+
+def generate_directory(size, seed=0):
+    """Generates a directory of specs, variations of the repository specs with distinct titles and descriptions
+
+    Args:
+        size (int): number of specs in the directory
+        seed (int): random seed. Defaults to 0.
+
+    Returns:
+        specs (list): generated specs, the repository specs first
+    """
+    rng = np.random.default_rng(seed)
+    base_specs = load_repository_specs()
+    words = ['orders', 'sellers', 'revenue', 'freight', 'category', 'state', 'monthly', 'daily', 'customers',
+             'products', 'volume', 'average', 'median', 'top', 'marketplace', 'payments', 'delivery', 'reviews']
+
+    specs = list(base_specs)
+    for i in range(max(size - len(base_specs), 0)):
+        spec = json.loads(json.dumps(base_specs[i % len(base_specs)]))
+        spec['spec_id'] = f"{spec['spec_id']}_{i}"
+        spec['title'] = f"{spec['title']} ({' '.join(rng.choice(words, 3))} {i})"
+        spec['description'] = f"{spec['description']} {' '.join(rng.choice(words, 8))}"
+        specs.append(spec)
+    return specs[:size]
@@ -1,23 +1,183 @@
 import os
+import json
+import time
+import uuid
+import argparse
 import pandas as pd
-import eland as ed
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+
+# Elasticsearch field type for each pandas dtype kind, the same mapping used by eland
+FIELD_TYPES = {
+    'i': 'long',
+    'u': 'long',
+    'f': 'double',
+    'b': 'boolean',
+    'M': 'date',
+    'O': 'keyword',
+    'U': 'keyword'
+}
+
+def parse_arguments():
+    """Parses the command line arguments of the loader"""
+    parser = argparse.ArgumentParser(description='Streams a CSV file into an Elasticsearch index, chunk by chunk')
+    parser.add_argument('file_path', help='path to the CSV file')
+    parser.add_argument('target_index_name', help='index the rows are loaded into')
+    parser.add_argument('--mode', choices=['append', 'replace', 'upsert'], default='replace',
+                        help='append to the index, replace it, or upsert documents by id (requires --id-column)')
+    parser.add_argument('--id-column', help='column used as document id, ids are derived from the run and the row number otherwise')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='number of rows read and committed at a time')
+    parser.add_argument('--bulk-size', type=int, default=2000, help='number of documents in each bulk request')
+    parser.add_argument('--workers', type=int, default=4, help='number of bulk requests sent in parallel')
+    parser.add_argument('--dtypes', help='JSON file with explicit pandas dtypes by column, inferred from the first chunk otherwise')
+    parser.add_argument('--parse-dates', default='', help='comma separated list of date columns')
+    parser.add_argument('--resume', action='store_true', help='resumes a failed run from the last committed chunk')
+    arguments = parser.parse_args()
+
+    if(arguments.mode == 'upsert' and arguments.id_column is None):
+        parser.error('--mode upsert requires --id-column')
+    return arguments
+
+def infer_dtypes(file_path, parse_dates, sample_rows):
+    """Infers the dtypes of every column from the first rows, so every chunk is parsed the same way"""
+    sample = pd.read_csv(file_path, nrows=sample_rows)
+    dtypes = {}
+    for column, dtype in sample.dtypes.items():
+        if(column in parse_dates):
+            continue
+        elif(dtype.kind in 'iu'):
+            # nullable integers, since later chunks may have missing values
+            dtypes[column] = 'Int64'
+        elif(dtype.kind == 'b'):
+            dtypes[column] = 'boolean'
+        elif(dtype.kind == 'f'):
+            dtypes[column] = 'float64'
+        else:
+            dtypes[column] = 'object'
+    return dtypes
+
+def build_mappings(dtypes, parse_dates):
+    """Builds the index mappings from the dtypes of the columns"""
+    properties = {column: {'type': FIELD_TYPES[pd.api.types.pandas_dtype(dtype).kind]} for column, dtype in dtypes.items()}
+    for column in parse_dates:
+        properties[column] = {'type': 'date'}
+    return {'properties': properties}
+
+def build_actions(chunk, target_index_name, mode, id_column, run_id, first_row):
+    """Serializes a chunk into bulk actions, missing values are sent as null and not indexed
+
+    Without an id column, documents are identified by the run and their row number in the file, so a chunk sent again by a resumed
+    run overwrites the documents it had already written instead of duplicating them. Upserts leave missing values out of the partial
+    document, since a null would overwrite the value already stored in the field.
+    """
+    lines = chunk.to_json(orient='records', lines=True, date_format='iso', date_unit='ms').splitlines()
+    if(id_column):
+        ids = chunk[id_column].astype(str).tolist()
+    else:
+        ids = [f'{run_id}-{row}' for row in range(first_row, first_row + len(lines))]
+
+    for doc_id, line in zip(ids, lines):
+        if(mode == 'upsert'):
+            doc = {field: value for field, value in json.loads(line).items() if value is not None}
+            action = {'_op_type': 'update', '_source': json.dumps({'doc': doc, 'doc_as_upsert': True})}
+        else:
+            action = {'_op_type': 'index', '_source': line}
+
+        action['_index'] = target_index_name
+        action['_id'] = doc_id
+        yield action
+
+def read_checkpoint(checkpoint_path):
+    """Reads the state of a previous run: its id, the index settings it found, and the number of chunks and rows it committed"""
+    if(not os.path.exists(checkpoint_path)):
+        return None
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    """Records the state of the run, through a temporary file so a crash never leaves a partial checkpoint"""
+    with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
 
 if __name__ == "__main__":
-    file_path = sys.argv[1]
-    target_index_name = sys.argv[2]
-    df = pd.read_csv(file_path)
-    es = Elasticsearch(os.environ['ELASTIC_CLUSTER'])
+    arguments = parse_arguments()
+    file_path = arguments.file_path
+    target_index_name = arguments.target_index_name
+    parse_dates = [column for column in arguments.parse_dates.split(',') if column]
+    checkpoint_path = f'{file_path}.{target_index_name}.checkpoint'
+
+    es = Elasticsearch(os.environ['ELASTIC_CLUSTER'], timeout=120, retry_on_timeout=True, max_retries=3)
+
+    if(arguments.dtypes):
+        with open(arguments.dtypes, 'r') as dtypes_file:
+            dtypes = json.load(dtypes_file)
+    else:
+        dtypes = infer_dtypes(file_path, parse_dates, arguments.chunk_size)
+
+    checkpoint = read_checkpoint(checkpoint_path) if arguments.resume else None
+    if(checkpoint is not None):
+        print(f"Resuming after chunk {checkpoint['chunks']} ({checkpoint['rows']} rows already committed)")
+    elif(os.path.exists(checkpoint_path)):
+        os.remove(checkpoint_path)
+
+    # the index is only recreated on a fresh run, a resumed run keeps what was already committed
+    if(arguments.mode == 'replace' and checkpoint is None):
+        es.indices.delete(index=target_index_name, ignore=404)
+    if(not es.indices.exists(index=target_index_name)):
+        es.indices.create(index=target_index_name, body={'mappings': build_mappings(dtypes, parse_dates)})
+
+    # refreshes and replicas are turned off during the load and restored afterwards, the original settings are kept in the checkpoint
+    # before they are changed, since a run that crashed leaves them turned off for the resumed run to find
+    if(checkpoint is None):
+        settings = es.indices.get_settings(index=target_index_name)[target_index_name]['settings']['index']
+        checkpoint = {
+            'run_id': uuid.uuid4().hex,
+            'settings': {
+                'refresh_interval': settings.get('refresh_interval', '1s'),
+                'number_of_replicas': settings.get('number_of_replicas', '1')
+            },
+            'chunks': 0,
+            'rows': 0
+        }
+        write_checkpoint(checkpoint_path, checkpoint)
+    es.indices.put_settings(index=target_index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+
+    start_time = time.monotonic()
+    loaded_rows = 0
+    try:
+        chunks = pd.read_csv(file_path, dtype=dtypes, parse_dates=parse_dates, chunksize=arguments.chunk_size)
+
+        # committed rows are skipped chunk by chunk, a resumed run may use another chunk size
+        position = 0
+        for chunk in chunks:
+            first_row = position
+            position += len(chunk)
+            if(position <= checkpoint['rows']):
+                continue
+            if(first_row < checkpoint['rows']):
+                chunk = chunk.iloc[checkpoint['rows'] - first_row:]
+                first_row = checkpoint['rows']
+
+            chunk_start = time.monotonic()
+            actions = build_actions(chunk, target_index_name, arguments.mode, arguments.id_column, checkpoint['run_id'], first_row)
 
-    ed_input = ed.pandas_to_eland(
-        pd_df=df,
-        es_client=es,
+            # raises on the first failed document, so the chunk is not marked as committed
+            for _ in parallel_bulk(es, actions, thread_count=arguments.workers, chunk_size=arguments.bulk_size):
+                pass
 
-        # Where the data will live in Elasticsearch
-        es_dest_index=target_index_name,
+            checkpoint = dict(checkpoint, chunks=checkpoint['chunks'] + 1, rows=checkpoint['rows'] + len(chunk))
+            write_checkpoint(checkpoint_path, checkpoint)
 
-        # If the index already exists what should we do?
-        es_if_exists="replace",
+            loaded_rows += len(chunk)
+            chunk_rate = len(chunk) / max(time.monotonic() - chunk_start, 1e-9)
+            total_rate = loaded_rows / max(time.monotonic() - start_time, 1e-9)
+            print(f"Chunk {checkpoint['chunks']}: {checkpoint['rows']} rows committed ({chunk_rate:,.0f} rows/s, {total_rate:,.0f} rows/s overall)")
+    finally:
+        es.indices.put_settings(index=target_index_name, body={'index': checkpoint['settings']})
+        es.indices.refresh(index=target_index_name)
 
-        # Wait for data to be indexed before returning
-        es_refresh=True
-    )
\ No newline at end of file
+    if(os.path.exists(checkpoint_path)):
+        os.remove(checkpoint_path)
+    elapsed = time.monotonic() - start_time
+    print(f"Loaded {loaded_rows} rows into {target_index_name} in {elapsed:.1f}s ({loaded_rows / max(elapsed, 1e-9):,.0f} rows/s)")
@@ -1,21 +1,109 @@
-import sys
 import os
+import sys
 import json
+import glob
+import hashlib
+import argparse
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk, scan
 
-if __name__ == "__main__":
-    with open(sys.argv[1], 'r') as spec_file:
+# specs are compiled with the same compiler used by the app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from plans import SpecCompiler, SpecError
+from searchutils import Searcher
+
+# field of the indexed specs holding the hash of their contents, used to skip unchanged specs when syncing
+HASH_FIELD = 'spec_hash'
+
+def parse_arguments():
+    """Parses the command line arguments of the submitter"""
+    parser = argparse.ArgumentParser(description='Submits a spec file, or syncs a folder of specs, to the directory index')
+    parser.add_argument('path', help='path to a spec file, or to a folder of specs to sync')
+    parser.add_argument('--delete', action='store_true', help='when syncing, deletes specs that no longer exist in the folder')
+    parser.add_argument('--exclude', default='spec_template.json', help='comma separated list of file names skipped when syncing')
+    return parser.parse_args()
+
+def load_spec(spec_path):
+    """Loads a spec file and stamps it with the hash of its contents"""
+    with open(spec_path, 'r') as spec_file:
         specs = json.load(spec_file)
 
-    es = Elasticsearch(os.environ['ELASTIC_CLUSTER'])
+    specs.pop(HASH_FIELD, None)
+    specs[HASH_FIELD] = hashlib.sha256(json.dumps(specs, sort_keys=True).encode()).hexdigest()
+    return specs
+
+def get_compiler(es):
+    """Builds a spec compiler, checking each spec against the schema of its source index (DATA_INDEX for specs that do not name one)"""
+    def load_schema(index):
+        if(not es.indices.exists(index=index)):
+            return None
+        return Searcher(es, os.environ['ELASTIC_CLUSTER'], index).get_index_schema()
+
+    return SpecCompiler(default_index=os.environ.get('DATA_INDEX'), schema_loader=load_schema)
 
-    if not (es.indices.exists(index=os.environ['DIRECTORY'])):
-        es.indices.create(index=os.environ['DIRECTORY'], ignore=400)
-    
-    response = es.index(index=os.environ['DIRECTORY'], id=specs['spec_id'], body=specs)
+def submit_spec(es, directory, spec_path):
+    """Indexes a single spec file, after checking that it compiles"""
+    specs = load_spec(spec_path)
+    get_compiler(es).compile_spec(specs)
+    response = es.index(index=directory, id=specs['spec_id'], body=specs)
     if (response['_shards']['successful'] > 0):
         print(f"Specification with id {specs['spec_id']} was successfully submitted")
 
     else:
         raise ValueError(f"Specification with id {specs['spec_id']} could not be submitted, with response: {response}")
 
+def sync_specs(es, directory, folder, delete=False, exclude=()):
+    """Syncs a folder of specs in one bulk request, skipping specs whose contents did not change since the last sync"""
+    compiler = get_compiler(es)
+    specs = {}
+    broken = {}
+    for spec_path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        if(os.path.basename(spec_path) not in exclude):
+            spec = load_spec(spec_path)
+            try:
+                compiler.compile_spec(spec)
+                specs[spec['spec_id']] = spec
+            except SpecError as error:
+                broken[spec.get('spec_id')] = error
+
+    # hashes of the specs currently indexed
+    indexed = {
+        hit['_id']: hit['_source'].get(HASH_FIELD)
+        for hit in scan(es, index=directory, query={'query': {'match_all': {}}, '_source': [HASH_FIELD]})
+    }
+
+    actions = [
+        {'_op_type': 'index', '_index': directory, '_id': spec_id, '_source': spec}
+        for spec_id, spec in specs.items() if indexed.get(spec_id) != spec[HASH_FIELD]
+    ]
+    # broken specs still exist in the folder, so their indexed version is kept
+    removed = [spec_id for spec_id in indexed if spec_id not in specs and spec_id not in broken] if delete else []
+    actions += [{'_op_type': 'delete', '_index': directory, '_id': spec_id} for spec_id in removed]
+
+    if(actions):
+        successful, _ = bulk(es, actions)
+        es.indices.refresh(index=directory)
+    else:
+        successful = 0
+
+    unchanged = len(specs) - (len(actions) - len(removed))
+    print(f"Synced {folder}: {successful} operation(s) applied, {len(actions) - len(removed)} spec(s) indexed, {len(removed)} deleted, {unchanged} unchanged")
+
+    if(broken):
+        for error in broken.values():
+            print(error)
+        raise ValueError(f"{len(broken)} specification(s) could not be compiled and were not submitted")
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    directory = os.environ['DIRECTORY']
+
+    es = Elasticsearch(os.environ['ELASTIC_CLUSTER'])
+
+    if not (es.indices.exists(index=directory)):
+        es.indices.create(index=directory, ignore=400)
+
+    if(os.path.isdir(arguments.path)):
+        sync_specs(es, directory, arguments.path, arguments.delete, arguments.exclude.split(','))
+    else:
+        submit_spec(es, directory, arguments.path)
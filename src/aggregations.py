@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized aggregation engine used by the Visualizer, based on factorized grouping keys
+"""
+
+import numpy as np
+import pandas as pd
+
+from sketches import build_sketch, evaluate_sketch, get_sketch_key, DEFAULT_PRECISION, DEFAULT_RELATIVE_ERROR
+
+# period used to bin each time_unit in the instruction set: numpy datetime units for days and months, weeks ending on sunday and calendar quarters
+TIME_UNITS = {
+    'day': 'D',
+    'week': 'W',
+    'month': 'M',
+    'quarter': 'Q'
+}
+
+# largest product of the group counts of combined keys kept in one int64 code, larger products are densified first
+MAX_COMBINED_CODES = 1 << 62
+
+def get_day_offsets(series):
+    """Converts a time field into day offsets from the epoch
+
+    Args:
+        series (pandas.Series): time field, either datetimes or strings parsed by pandas.to_datetime
+
+    Returns:
+        tuple: (offsets, valid) arrays, the day offset of each row and whether the row has a time at all
+    """
+    days = pd.to_datetime(series).values.astype('datetime64[D]')
+    valid = ~np.isnat(days)
+    return np.where(valid, days.astype('int64'), 0), valid
+
+def bin_days(offsets, period):
+    """Bins day offsets into period offsets from the epoch
+
+    Args:
+        offsets (numpy.ndarray): day offsets from the epoch
+        period (str): period of the bins, one of the TIME_UNITS values
+
+    Returns:
+        numpy.ndarray: period offset of each day
+    """
+    if(period == 'D'):
+        return offsets
+    if(period == 'W'):
+        # the epoch is a thursday, weeks are shifted so they start on monday and end on sunday as in resample('W')
+        return (offsets + 3) // 7
+
+    months = offsets.astype('datetime64[D]').astype('datetime64[M]').astype('int64')
+    if(period == 'Q'):
+        return months // 3
+    return months
+
+def get_period_labels(offsets, period, name=None):
+    """Labels period offsets by the day pandas resampling uses: the day itself for days and the last day of the period otherwise
+
+    Args:
+        offsets (numpy.ndarray): period offsets from the epoch, as returned by bin_days
+        period (str): period of the bins, one of the TIME_UNITS values
+        name (str): name of the labels. Defaults to None.
+
+    Returns:
+        pandas.DatetimeIndex: label of each period
+    """
+    if(period == 'D'):
+        labels = offsets.astype('datetime64[D]')
+    elif(period == 'W'):
+        labels = (offsets * 7 + 3).astype('datetime64[D]')
+    else:
+        # first day of the next period, minus one day
+        months = (offsets + 1) * 3 if period == 'Q' else offsets + 1
+        labels = months.astype('datetime64[M]').astype('datetime64[D]') - np.timedelta64(1, 'D')
+    return pd.DatetimeIndex(labels.astype('datetime64[ns]'), name=name)
+
+def get_day_window(time_range):
+    """Converts a time range into an inclusive window of day offsets from the epoch
+
+    Args:
+        time_range (tuple): (start, end) dates or datetimes, both inclusive, either one can be None for an open range
+
+    Returns:
+        tuple: (first, last) day offsets, the first and last representable days when open
+    """
+    start, end = time_range
+    first = np.iinfo('int64').min if start is None else np.datetime64(pd.Timestamp(start), 'D').astype('int64')
+    last = np.iinfo('int64').max if end is None else np.datetime64(pd.Timestamp(end), 'D').astype('int64')
+    return first, last
+
+class GroupKeys:
+    """Factorized grouping keys: one integer group code per row and one label per group
+
+    Reductions over the codes use vectorized numpy/pandas kernels instead of per-group Python calls.
+
+    Args:
+        name (str or tuple): name of the grouping field, or names of the grouping fields of combined keys
+        codes (numpy.ndarray): group code of each row, -1 for rows with missing keys
+        labels (pandas.Index): label of each group, in code order (a MultiIndex for combined keys)
+        components (list): GroupKeys of each grouping field of combined keys. Defaults to None.
+        component_codes (list): code of each group in each component of combined keys. Defaults to None.
+
+    Attributes:
+        name (str or tuple): name of the grouping field, or names of the grouping fields of combined keys
+        codes (numpy.ndarray): group code of each row, -1 for rows with missing keys
+        labels (pandas.Index): label of each group, in code order
+        size (int): number of groups
+        partials (dict): partial reductions already computed for each value field, shared by every reduction over the same keys
+        components (list): GroupKeys of each grouping field of combined keys, empty for single keys
+        component_codes (list): code of each group in each component of combined keys, empty for single keys
+
+    """
+    def __init__(self, name, codes, labels, components=None, component_codes=None):
+        self.name = name
+        self.codes = codes
+        self.labels = labels
+        self.size = len(labels)
+        self.partials = {}
+        self.components = components or []
+        self.component_codes = component_codes or []
+
+    @classmethod
+    def from_categories(cls, series):
+        """Factorizes a categorical field
+
+        Args:
+            series (pandas.Series): categorical field
+
+        Returns:
+            GroupKeys: one group per distinct value
+        """
+        codes, uniques = pd.factorize(series, sort=False)
+        # dictionary-encoded columns (see snapshots.SharedSnapshotStore) are labeled by their values, as plain columns are
+        if(isinstance(series.dtype, pd.CategoricalDtype)):
+            return cls(series.name, codes, series.cat.categories.take(uniques.codes))
+        return cls(series.name, codes, pd.Index(uniques))
+
+    @classmethod
+    def from_times(cls, series, period, time_range=None):
+        """Bins a time field into periods, keeping empty periods between the first and the last one the same way pandas resampling does
+
+        Periods are labeled by the day itself for days and by their last day otherwise, as in resample('1d'), resample('W'), resample('1M') and resample('Q').
+
+        Args:
+            series (pandas.Series): time field, either datetimes or strings parsed by pandas.to_datetime
+            period (str): period of the bins, one of the TIME_UNITS values ("D", "W", "M" or "Q")
+            time_range (tuple): (start, end) dates, both inclusive, rows outside of the range are left out. Defaults to None, keeping every row.
+
+        Returns:
+            GroupKeys: one group per period
+        """
+        if(period not in TIME_UNITS.values()):
+            raise TypeError(f"{period} is not a valid period")
+
+        days, valid = get_day_offsets(series)
+        if(time_range is not None):
+            first, last = get_day_window(time_range)
+            valid &= (days >= first) & (days <= last)
+
+        if(not valid.any()):
+            return cls(series.name, np.full(len(series), -1), pd.DatetimeIndex([], name=series.name))
+
+        offsets = bin_days(days, period)
+        start = offsets[valid].min()
+        size = offsets[valid].max() - start + 1
+        codes = np.where(valid, offsets - start, -1)
+        return cls(series.name, codes, get_period_labels(np.arange(start, start + size), period, series.name))
+
+    @classmethod
+    def from_components(cls, components):
+        """Combines the keys of several grouping fields into one group per combination present in the rows
+
+        The codes of the components are combined into a single integer per row (mixed radix), and the combinations are densified,
+        so reductions run over as many groups as there are non-empty combinations instead of the product of the group counts,
+        and no intermediate frame of the grouping fields is built.
+
+        Args:
+            components (list): GroupKeys of each grouping field, built over the same rows
+
+        Returns:
+            GroupKeys: one group per combination with rows, in lexicographic order of the component codes
+        """
+        valid = np.ones(len(components[0].codes), dtype=bool)
+        combined = np.zeros(len(valid), dtype='int64')
+        radix = 1
+        for component in components:
+            valid &= component.codes >= 0
+            if(radix * max(component.size, 1) >= MAX_COMBINED_CODES):
+                # too many combinations for one code: the combinations seen so far are renumbered, keeping their order
+                combined = np.unique(np.where(valid, combined, 0), return_inverse=True)[1].reshape(-1).astype('int64')
+                radix = int(combined.max()) + 1 if len(combined) else 1
+            combined = combined * component.size + component.codes
+            radix *= max(component.size, 1)
+
+        # combinations are numbered in order, through a table of the present combinations when it is no larger than the rows
+        if(radix <= len(valid)):
+            present = np.bincount(combined[valid], minlength=radix) > 0
+            dense = (np.cumsum(present) - 1)[combined[valid]]
+        else:
+            dense, _ = pd.factorize(combined[valid], sort=True)
+        size = int(dense.max()) + 1 if len(dense) else 0
+        codes = np.full(len(valid), -1, dtype='int64')
+        codes[valid] = dense
+
+        # every row of a group holds the same component codes, so scattering them gives the codes of each group
+        component_codes = []
+        for component in components:
+            group_codes = np.zeros(size, dtype='int64')
+            group_codes[dense] = component.codes[valid]
+            component_codes.append(group_codes)
+
+        names = tuple(component.name for component in components)
+        labels = pd.MultiIndex.from_arrays(
+            [component.labels[group_codes] for component, group_codes in zip(components, component_codes)], names=list(names)
+        )
+        return cls(names, codes, labels, components, component_codes)
+
+    def get_partials(self, values):
+        """Computes the sum and count of non-missing values of each group, once for each value field
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys
+
+        Returns:
+            tuple: (sums, counts) arrays of each group, in code order
+        """
+        if(values.name not in self.partials):
+            numbers = np.asarray(values).astype('float64')
+            valid = (self.codes >= 0) & ~np.isnan(numbers)
+            sums = np.bincount(self.codes[valid], weights=numbers[valid], minlength=self.size)
+            counts = np.bincount(self.codes[valid], minlength=self.size)
+            self.partials[values.name] = (sums, counts)
+        return self.partials[values.name]
+
+    def count(self, values=None):
+        """Counts the rows of each group
+
+        Args:
+            values (pandas.Series): ignored, rows are counted regardless of missing values. Defaults to None.
+
+        Returns:
+            numpy.ndarray: number of rows of each group, in code order
+        """
+        if(None not in self.partials):
+            self.partials[None] = np.bincount(self.codes[self.codes >= 0], minlength=self.size)
+        return self.partials[None]
+
+    def sum(self, values):
+        """Sums the non-missing values of each group
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys
+
+        Returns:
+            numpy.ndarray: sum of each group, in code order (integers stay integers)
+        """
+        sums, _ = self.get_partials(values)
+        if(np.issubdtype(np.asarray(values).dtype, np.integer)):
+            return sums.astype('int64')
+        return sums
+
+    def mean(self, values):
+        """Averages the non-missing values of each group
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys
+
+        Returns:
+            numpy.ndarray: mean of each group, in code order (NaN for groups without values)
+        """
+        sums, counts = self.get_partials(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    def median(self, values):
+        """Computes the median of the non-missing values of each group
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys
+
+        Returns:
+            numpy.ndarray: median of each group, in code order (NaN for groups without values)
+        """
+        numbers = np.asarray(values).astype('float64')
+        valid = (self.codes >= 0) & ~np.isnan(numbers)
+        medians = pd.Series(numbers[valid]).groupby(self.codes[valid]).median()
+        return medians.reindex(np.arange(self.size)).to_numpy()
+
+    def get_sketch(self, values, op, params):
+        """Sketches the values of each group, once for each value field and sketch
+
+        Args:
+            values (pandas.Series): values to sketch, aligned with the keys
+            op (str): sketch-based reduction, "count_distinct" or "percentile"
+            params (dict): parameters of the reduction
+
+        Returns:
+            sketches.HyperLogLog or sketches.QuantileSketch: sketch of each group, keyed by group code
+        """
+        key = (values.name,) + get_sketch_key(op, params)
+        if(key not in self.partials):
+            valid = self.codes >= 0
+            self.partials[key] = build_sketch(op, self.codes[valid], np.asarray(values)[valid], params)
+        return self.partials[key]
+
+    def count_distinct(self, values, precision=DEFAULT_PRECISION):
+        """Estimates the distinct non-missing values of each group, from HyperLogLog sketches
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys
+            precision (int): number of register index bits of the sketches. Defaults to sketches.DEFAULT_PRECISION.
+
+        Returns:
+            numpy.ndarray: estimated distinct values of each group, in code order
+        """
+        params = {'precision': precision}
+        return evaluate_sketch(self.get_sketch(values, 'count_distinct', params), pd.RangeIndex(self.size), params)
+
+    def percentile(self, values, q=50, relative_error=DEFAULT_RELATIVE_ERROR):
+        """Estimates a percentile of the non-missing values of each group, from relative-error quantile sketches
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys
+            q (float): percentile, from 0 to 100. Defaults to 50.
+            relative_error (float): relative error of the estimates. Defaults to sketches.DEFAULT_RELATIVE_ERROR.
+
+        Returns:
+            numpy.ndarray: estimated percentile of each group, in code order (NaN for groups without values)
+        """
+        params = {'q': q, 'relative_error': relative_error}
+        return evaluate_sketch(self.get_sketch(values, 'percentile', params), pd.RangeIndex(self.size), params)
+
+    def reduce(self, values, op):
+        """Reduces values for each group
+
+        Args:
+            values (pandas.Series): values to reduce, aligned with the keys. Ignored for "count", which counts rows.
+            op (str): reduction, one of "count", "sum", "mean", "median", "count_distinct" or "percentile" (the median). Missing values are skipped.
+
+        Returns:
+            numpy.ndarray: reduced value of each group, in code order
+        """
+        if(op not in ('count', 'sum', 'mean', 'median', 'count_distinct', 'percentile')):
+            raise NotImplementedError(f'{op} operation is not supported')
+        return getattr(self, op)(values)
+
+def select_top(labels, values, limit):
+    """Selects the groups with the largest values through partial selection, without sorting every group
+
+    Args:
+        labels (pandas.Index): label of each group
+        values (numpy.ndarray): reduced value of each group
+        limit (int): number of groups to keep
+
+    Returns:
+        tuple: (labels, values) of the top groups, in descending order of value
+    """
+    # missing values are ranked last
+    ranking = np.where(np.isnan(values.astype('float64')), -np.inf, values)
+
+    if(limit < len(ranking)):
+        candidates = np.argpartition(-ranking, limit - 1)[:limit]
+    else:
+        candidates = np.arange(len(ranking))
+
+    top = candidates[np.argsort(-ranking[candidates], kind='stable')]
+    return labels[top], values[top]
+
+def load_plan_fields(data, plans):
+    """Reads the fields of spec plans from a dataset, along with the data version they belong to
+
+    Args:
+        data (pandas.DataFrame or datasets.ProjectedDataset): dataset holding the fields
+        plans (list): compiled spec plans
+
+    Returns:
+        tuple: frame holding the group and value fields of the plans, and its data version (None for datasets that are not versioned)
+    """
+    if(not hasattr(data, 'load_version')):
+        return data, getattr(data, 'version', None)
+    fields = list(dict.fromkeys(field for plan in plans for field in plan.group_fields + (plan.agg_field,)))
+    return data.load_version(fields)
+
+def build_group_keys(data, plan, time_range=None):
+    """Builds the group keys requested by a spec plan
+
+    Args:
+        data (pandas.DataFrame or datasets.ProjectedDataset): dataset to group
+        plan (plans.SpecPlan): compiled spec plan
+        time_range (tuple): (start, end) dates, both inclusive, restricting the rows of the time field. Defaults to None.
+
+    Returns:
+        GroupKeys: factorized categories for category specs, binned periods for timeseries specs, combined keys for crosstab specs
+    """
+    if(plan.report_type == 'timeseries'):
+        return GroupKeys.from_times(data[plan.group_field], plan.period, time_range)
+    if(plan.report_type == 'crosstab'):
+        return GroupKeys.from_components([
+            GroupKeys.from_times(data[field], plan.period, time_range) if field == plan.time_field else GroupKeys.from_categories(data[field])
+            for field in plan.group_fields
+        ])
+    return GroupKeys.from_categories(data[plan.group_field])
+
+def select_crosstab(keys, plan, limit):
+    """Selects the groups of combined keys whose categories all rank among the top categories of their field
+
+    Args:
+        keys (GroupKeys): combined keys built for a crosstab plan
+        plan (plans.SpecPlan): compiled crosstab plan
+        limit (int): number of categories kept for each categorical field, periods of the time field are all kept
+
+    Returns:
+        numpy.ndarray: mask of the kept groups, in code order
+    """
+    # categories are ranked by the rows of the groups they appear in, rows missing another group field are left out
+    rows = keys.count()
+    kept = np.ones(keys.size, dtype=bool)
+    for component, group_codes in zip(keys.components, keys.component_codes):
+        if(component.name == plan.time_field or component.size <= limit):
+            continue
+        marginal = np.bincount(group_codes, weights=rows, minlength=component.size).astype('int64')
+        top, _ = select_top(pd.RangeIndex(component.size), marginal, limit)
+        kept &= np.isin(group_codes, top)
+    return kept
+
+def aggregate(keys, data, plan, limit=10):
+    """Aggregates the dataset over previously built group keys, following a spec plan
+
+    Args:
+        keys (GroupKeys): group keys built for the plan
+        data (pandas.DataFrame or datasets.ProjectedDataset): dataset being grouped
+        plan (plans.SpecPlan): compiled spec plan
+        limit (int): number of top groups kept for category specs, and of top categories of each field for crosstab specs. Defaults to 10.
+
+    Returns:
+        pandas.DataFrame: aggregated data in the expected format for vega-lite plotting (long format for crosstab specs, one column per grouping field)
+    """
+    # counting only needs the group sizes, not the values themselves
+    values = None if plan.agg_operation == 'count' else data[plan.agg_field]
+    labels = keys.labels
+    reduced = plan.reducer(keys, values)
+
+    # crosstabs only hold the non-empty combinations, restricted to the top categories of each field
+    if(plan.report_type == 'crosstab'):
+        kept = select_crosstab(keys, plan, limit)
+        output = labels[kept].to_frame(index=False)
+        output[plan.agg_field] = reduced[kept]
+        return output
+
+    # categories are ranked, keeping only the top groups
+    if(plan.report_type == 'category'):
+        labels, reduced = select_top(labels, reduced, limit)
+
+    return pd.DataFrame({keys.name: labels, plan.agg_field: reduced})
+
+
+class AggregationPlanner:
+    """Plans the aggregation of a batch of specs, such as the results of a search
+
+    Specs sharing a grouping key (the same category field, or the same time field and time unit) are computed over group keys built once,
+    and partial reductions (counts, sums) over the same value field are shared between them.
+    When a rollup store is given, the timeseries specs it supports are rolled up from the daily cube of their time field instead.
+
+    Args:
+        data (pandas.DataFrame or datasets.ProjectedDataset): dataset used for the aggregations
+        definitions (list): json-like objects from directory search results
+        compiler (plans.SpecCompiler): compiler providing the spec plans
+        cubes (rollups.RollupStore): daily rollups of the time fields of the dataset. Defaults to None, aggregating the rows.
+        materialize (callable): builds the mergeable partial of an output from its group keys, called as materialize(plan, keys, data)
+            (see streaming.PartialAggregate.from_group_keys). Defaults to None, caching the outputs without partials.
+
+    Attributes:
+        data (pandas.DataFrame or datasets.ProjectedDataset): dataset used for the aggregations
+        definitions (list): json-like objects from directory search results
+        compiler (plans.SpecCompiler): compiler providing the spec plans
+        cubes (rollups.RollupStore): daily rollups of the time fields of the dataset
+        materialize (callable): builds the mergeable partial of an output from its group keys
+        plan (dict): spec plans grouped by grouping key
+        outputs (dict): aggregated output of each spec, by spec_id
+        partials (dict): mergeable partial of the output of each spec aggregated over group keys, by spec_id
+        versions (dict): data version of the rows each output was aggregated from, by spec_id
+        errors (dict): exception raised by each spec that could not be aggregated, by spec_id
+
+    """
+    def __init__(self, data, definitions, compiler, cubes=None, materialize=None):
+        self.data = data
+        self.definitions = definitions
+        self.compiler = compiler
+        self.cubes = cubes
+        self.materialize = materialize
+        self.outputs = {}
+        self.partials = {}
+        self.versions = {}
+        self.errors = {}
+
+    def build_plan(self):
+        """Compiles the definitions and groups their plans by grouping key
+
+        Args:
+            None
+
+        Returns:
+            None -> plan is stored in the plan attribute
+        """
+        plan = {}
+        for definition in self.definitions:
+            try:
+                spec_plan = self.compiler.get_plan(definition)
+            except ValueError as error:
+                self.errors[definition.get('spec_id')] = error
+                continue
+            plan.setdefault(spec_plan.grouping_key, []).append(spec_plan)
+        self.plan = plan
+
+    def execute(self, limit=10):
+        """Aggregates every planned spec, building the group keys once for each grouping key
+
+        Args:
+            limit (int): number of top groups kept for category specs. Defaults to 10.
+
+        Returns:
+            None -> outputs are stored in the outputs attribute, failures in the errors attribute
+        """
+        self.build_plan()
+        for spec_plans in self.plan.values():
+            # rolled up specs do not need the group keys, the cube of their time field is built once and shared instead
+            if(self.cubes is not None):
+                spec_plans = [spec_plan for spec_plan in spec_plans if not self.rollup(spec_plan)]
+                if(not spec_plans):
+                    continue
+
+            # the group keys and the values of the specs are read from the same version of the rows
+            try:
+                data, version = load_plan_fields(self.data, spec_plans)
+                keys = build_group_keys(data, spec_plans[0])
+            except (KeyError, TypeError, ValueError) as error:
+                for spec_plan in spec_plans:
+                    self.errors[spec_plan.spec_id] = error
+                continue
+
+            for spec_plan in spec_plans:
+                try:
+                    self.outputs[spec_plan.spec_id] = aggregate(keys, data, spec_plan, limit)
+                    self.versions[spec_plan.spec_id] = version
+                    if(self.materialize is not None):
+                        self.partials[spec_plan.spec_id] = self.materialize(spec_plan, keys, data)
+                except (KeyError, TypeError, ValueError) as error:
+                    self.errors[spec_plan.spec_id] = error
+
+    def rollup(self, spec_plan):
+        """Answers a spec from the rollup store, when the store supports it
+
+        Args:
+            spec_plan (plans.SpecPlan): compiled spec plan
+
+        Returns:
+            bool: True if the spec was answered (or failed) from the rollup store, False if its rows need to be aggregated
+        """
+        if(not self.cubes.supports(spec_plan)):
+            return False
+
+        try:
+            loaded = load_plan_fields(self.data, [spec_plan])
+            output = self.cubes.aggregate(self.data, spec_plan, loaded=loaded)
+        except (KeyError, TypeError, ValueError) as error:
+            self.errors[spec_plan.spec_id] = error
+            return True
+
+        if(output is None):
+            return False
+        self.outputs[spec_plan.spec_id] = output
+        self.versions[spec_plan.spec_id] = loaded[1]
+        return True
+
+    def prefetch(self, cache, limit=10):
+        """Aggregates the definitions that are not cached yet and stores their outputs in the aggregation cache
+
+        Each output is stored under the data version of the rows it was aggregated from, outputs of datasets that are not
+        versioned are not stored.
+
+        Args:
+            cache (caching.AggregationCache): cache receiving the aggregated outputs
+            limit (int): number of top groups kept for category specs. Defaults to 10.
+
+        Returns:
+            None -> outputs are stored in the cache
+        """
+        self.build_plan()
+        version = getattr(self.data, 'version', None)
+        cached = set(
+            spec_plan.spec_id for spec_plans in self.plan.values() for spec_plan in spec_plans
+            if cache.get(cache.make_key(spec_plan, limit, version)) is not None
+        )
+        self.definitions = [definition for definition in self.definitions if definition.get('spec_id') not in cached]
+        self.execute(limit)
+
+        for spec_plans in self.plan.values():
+            for spec_plan in spec_plans:
+                spec_version = self.versions.get(spec_plan.spec_id)
+                if(spec_version is not None):
+                    cache.put(cache.make_key(spec_plan, limit, spec_version), self.outputs[spec_plan.spec_id], self.partials.get(spec_plan.spec_id))
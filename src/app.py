@@ -7,27 +7,367 @@ github: https://github.com/mateuspicanco
 
 # Data processing imports
 import os
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 import pandas as pd
 import eland as ed
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError, NotFoundError
 
 # custom classes and components
-from components import ResultList, Download, Visualizer
-from searchutils import MultiMatchSearcher
+from components import ResultList, Download, Visualizer, ElasticVisualizer, StreamingVisualizer
+from searchutils import Searcher, MultiMatchSearcher, AggregationSearcher, DirectoryScanner
+from snapshots import SnapshotStore, SharedSnapshotStore
+from datasets import ProjectedDataset, DatasetManager
+from caching import AggregationCache
+from rollups import RollupStore
+from streaming import StreamingAggregator, PartialAggregate
+from aggregations import AggregationPlanner
+from exports import ExportServer
+from plans import SpecCompiler, SpecError
+from localsearch import DirectoryIndex, LocalMultiMatchSearcher
+from metrics import InstrumentedConnection, RequestTrace, track, start_metrics_server
+
+# "pandas" aggregates a copy of the dataset in memory, "elasticsearch" pushes the aggregations down to the data index,
+# "streaming" aggregates data indices too large for memory chunk by chunk, without loading them
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'pandas')
+
+# slices read in parallel and documents fetched by each scroll request in "streaming" execution mode
+STREAM_SLICES = int(os.environ.get('STREAM_SLICES', 4))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 10000))
+
+# local directory for feather snapshots of the data index, snapshots are disabled when not set
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR')
+
+# when set to "true", the snapshots are published once for every worker process of the host, which all map the same Arrow buffers
+# (SNAPSHOT_DIR should then be on a shared memory file system, such as /dev/shm)
+SHARED_DATASETS = os.environ.get('SHARED_DATASETS', 'false').lower() == 'true'
+
+# offset added to the ports of the export server and of the metrics endpoint, so several worker processes can run on the same host
+WORKER_PORT_OFFSET = int(os.environ.get('WORKER_PORT_OFFSET', 0))
+
+# memory budget for the datasets loaded by the process, in bytes, the least recently used datasets are released when it is exceeded
+DATASET_MEMORY_BYTES = int(os.environ.get('DATASET_MEMORY_BYTES', 4 * 1024 ** 3))
+
+# timestamp or sequence field of the data indices that only grows as documents are added, documents appended above its
+# high-water mark are pulled on their own and merged into the cached aggregations and rollups, disabled when not set
+WATERMARK_FIELD = os.environ.get('WATERMARK_FIELD')
+
+# minimum time between two checks of the data version of a loaded index, in seconds
+REFRESH_SECONDS = float(os.environ.get('REFRESH_SECONDS', 10))
+
+# memory bound for the aggregation cache shared by every session, in bytes
+AGGREGATION_CACHE_BYTES = int(os.environ.get('AGGREGATION_CACHE_BYTES', 64 * 1024 ** 2))
+
+# when set to "true", every spec in the directory is aggregated when the dataset is loaded or refreshed
+PRECOMPUTE_AGGREGATIONS = os.environ.get('PRECOMPUTE_AGGREGATIONS', 'false').lower() == 'true'
+
+# "elasticsearch" sends every directory search to the cluster, "local" searches an in-process copy of the directory index
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'elasticsearch')
+
+# url of the server streaming data exports as reached by the browser (through a reverse proxy), its port and the interface it binds to
+# downloads are inlined in the page as base64 links when EXPORT_URL is not set ("{port}" is replaced by the port of the worker)
+EXPORT_PORT = int(os.environ.get('EXPORT_PORT', 8502)) + WORKER_PORT_OFFSET
+EXPORT_URL = os.environ['EXPORT_URL'].replace('{port}', str(EXPORT_PORT)) if os.environ.get('EXPORT_URL') else None
+EXPORT_HOST = os.environ.get('EXPORT_HOST', '127.0.0.1')
+
+# connection pool size, request timeout (in seconds) and retries of the Elasticsearch client shared by every session
+ES_POOL_SIZE = int(os.environ.get('ES_POOL_SIZE', 10))
+ES_TIMEOUT = float(os.environ.get('ES_TIMEOUT', 30))
+ES_MAX_RETRIES = int(os.environ.get('ES_MAX_RETRIES', 3))
+
+# number of Elasticsearch requests of a page run that can be in flight at the same time
+ES_CONCURRENCY = int(os.environ.get('ES_CONCURRENCY', 8))
+
+# port of the Prometheus metrics endpoint, disabled when set to an empty value
+METRICS_PORT = os.environ.get('METRICS_PORT', '8503')
+
+# page runs slower than this many seconds are logged with their query text and the time of each stage, disabled when not set
+SLOW_REQUEST_SECONDS = float(os.environ['SLOW_REQUEST_SECONDS']) if os.environ.get('SLOW_REQUEST_SECONDS') else None
+
+# limit of data points for each visualization
+VISUALIZATION_LIMIT = 10
+
+@st.cache(allow_output_mutation=True)
+def get_client():
+    """Creates the Elasticsearch client shared by every session of the process
+
+    The client is thread-safe and keeps a pool of persistent connections, so reruns reuse open connections instead of connecting again.
+    Requests and bytes exchanged with the cluster are counted by the instrumented connection.
+
+    Args:
+        None
+
+    Returns:
+        elasticsearch.Elasticsearch: process-wide client
+    """
+    return Elasticsearch(
+        os.environ['ELASTIC_CLUSTER'],
+        connection_class=InstrumentedConnection,
+        maxsize=ES_POOL_SIZE,
+        timeout=ES_TIMEOUT,
+        max_retries=ES_MAX_RETRIES,
+        retry_on_timeout=True
+    )
+
+@st.cache(allow_output_mutation=True)
+def get_executor():
+    """Creates the thread pool shared by every session of the process, used to send independent Elasticsearch requests at the same time
+
+    Args:
+        None
+
+    Returns:
+        concurrent.futures.ThreadPoolExecutor: process-wide thread pool
+    """
+    return ThreadPoolExecutor(max_workers=ES_CONCURRENCY)
+
+def prefetch_pushdowns(executor, es_client, definitions, compiler, cache, versions, trace=None):
+    """Pushes the aggregations of several specs down to Elasticsearch at the same time, storing their outputs in the aggregation cache
+
+    Args:
+        executor (concurrent.futures.ThreadPoolExecutor): thread pool sending the aggregations
+        es_client (elasticsearch.Elasticsearch): client shared by every session
+        definitions (list): json-like objects from the directory
+        compiler (plans.SpecCompiler): compiler providing the plans of the definitions
+        cache (caching.AggregationCache): cache receiving the aggregated outputs
+        versions (dict): pending data version requests (concurrent.futures.Future) by data index, the missing indices are requested
+        trace (metrics.RequestTrace): trace of the current page run. Defaults to None.
+
+    Returns:
+        versions (dict): data version of each data index, None for indices whose version could not be read
+    """
+    for definition in definitions:
+        index = compiler.get_source_index(definition)
+        if(index not in versions):
+            versions[index] = executor.submit(Searcher(es_client, os.environ['ELASTIC_CLUSTER'], index).get_index_version)
+
+    resolved = {}
+    for index, request in versions.items():
+        try:
+            resolved[index] = request.result()
+        except TransportError:
+            resolved[index] = None
+
+    def build_output(definition):
+        # every aggregation gets its own searcher, since searchers hold the query they run
+        index = compiler.get_source_index(definition)
+        aggregator = AggregationSearcher(es_client, os.environ['ELASTIC_CLUSTER'], index)
+        ElasticVisualizer(aggregator, definition, compiler, trace, cache, resolved[index]).build_output(VISUALIZATION_LIMIT)
+
+    for request in [executor.submit(build_output, definition) for definition in definitions]:
+        try:
+            request.result()
+        except (SpecError, TransportError):
+            # broken specs and failed aggregations are reported when they are requested
+            pass
+    return resolved
+
+def create_dataset(target_index):
+    """Creates the (not yet loaded) dataset of a data index
+
+    Args:
+        target_index (str): index pattern of the data index
+
+    Returns:
+        datasets.ProjectedDataset: dataset of the index, versioned with the current state of the index
+    """
+    es_client = get_client()
+
+    # the data version can be pinned explicitly, otherwise it is derived from the index state
+    version = os.environ.get('DATA_VERSION')
+    if(version is None):
+        version = Searcher(es_client, os.environ['ELASTIC_CLUSTER'], target_index).get_index_version()
+
+    store = None
+    if(SNAPSHOT_DIR is not None):
+        store = SharedSnapshotStore(SNAPSHOT_DIR) if SHARED_DATASETS else SnapshotStore(SNAPSHOT_DIR)
+
+    return ProjectedDataset(es_client, target_index, version, store, WATERMARK_FIELD)
+
+def get_data_version(target_index):
+    """Reads the current data version of a data index, used to detect changes of the loaded datasets
+
+    Args:
+        target_index (str): index pattern of the data index
+
+    Returns:
+        version (str): data version of the index
+    """
+    return Searcher(get_client(), os.environ['ELASTIC_CLUSTER'], target_index).get_index_version()
+
+def get_spec_columns(target_index):
+    """Collects the union of the dimensions used by the specs reading from a data index
+
+    Args:
+        target_index (str): index pattern of the data index
+
+    Returns:
+        columns (list): columns of the index used by at least one spec
+    """
+    scanner = DirectoryScanner(get_client(), os.environ['ELASTIC_CLUSTER'], os.environ['DIRECTORY'])
+    return scanner.get_spec_dimensions(target_index, os.environ['DATA_INDEX'])
+
+@st.cache(allow_output_mutation=True)
+def get_dataset_manager():
+    """Creates the dataset manager shared by every session of the process
+
+    Args:
+        None
+
+    Returns:
+        datasets.DatasetManager: process-wide dataset manager, bounded by DATASET_MEMORY_BYTES
+    """
+    # pinned data versions are never refreshed, appended documents update the cached aggregations and the rollups in place
+    get_version = get_data_version if os.environ.get('DATA_VERSION') is None else None
+    listeners = [get_aggregation_cache().append_documents, get_rollup_store().append_documents]
+    return DatasetManager(create_dataset, get_spec_columns, DATASET_MEMORY_BYTES, get_version, REFRESH_SECONDS, listeners)
 
-@st.cache(suppress_st_warning=True)
 def load_dataset(target_index):
     """Loads data from Elasticsearch data store
 
+    Each data index is loaded the first time a spec reading from it is requested, and released when the memory budget of the
+    dataset manager is exceeded and it is the least recently used. Loaded indices are checked for changes every REFRESH_SECONDS:
+    with a WATERMARK_FIELD, appended documents are pulled on their own, otherwise (or when documents were updated or deleted) the index is loaded again.
+    Only the columns referenced by the specs reading from the index are loaded, any other column is loaded lazily when a spec requests it.
+    When SNAPSHOT_DIR is set, columns are memory-mapped from a local snapshot and only pulled again from Elasticsearch when the data version changes.
+    With SHARED_DATASETS, the worker processes of the host share the snapshot: a single one pulls each version and the others map it.
+
     Args:
         target_index (str): index pattern to load data from
 
     Returns:
-        pandas.DataFrame: dataframe containing the dataset
+        datasets.ProjectedDataset: dataset containing the projected columns
     """
-    ed_df = ed.read_es(os.environ['ELASTIC_CLUSTER'], target_index)
-    return ed.eland_to_pandas(ed_df)
+    return get_dataset_manager().get_dataset(target_index)
+
+def get_index_schema(target_index):
+    """Retrieves the schema of a data index, used by the spec compiler
+
+    Args:
+        target_index (str): index pattern of the data index
+
+    Returns:
+        schema (dict): Elasticsearch field type of each field, or None if the index does not exist
+    """
+    try:
+        return Searcher(get_client(), os.environ['ELASTIC_CLUSTER'], target_index).get_index_schema()
+    except NotFoundError:
+        return None
+
+@st.cache(allow_output_mutation=True)
+def get_spec_compiler():
+    """Creates the spec compiler shared by every session, checking each spec against the schema of its source index
+
+    Every spec in the directory is compiled when the app loads, so broken specs are caught before they are requested.
+
+    Args:
+        None
+
+    Returns:
+        plans.SpecCompiler: compiler caching the plans of every spec
+    """
+    compiler = SpecCompiler(default_index=os.environ['DATA_INDEX'], schema_loader=get_index_schema)
+
+    scanner = DirectoryScanner(get_client(), os.environ['ELASTIC_CLUSTER'], os.environ['DIRECTORY'])
+    compiler.compile_directory(scanner.get_directory_specs())
+    return compiler
+
+@st.cache(allow_output_mutation=True)
+def get_aggregation_cache():
+    """Creates the aggregation cache shared by every session of the process
+
+    Args:
+        None
+
+    Returns:
+        caching.AggregationCache: process-wide aggregation cache
+    """
+    return AggregationCache(AGGREGATION_CACHE_BYTES)
+
+@st.cache(allow_output_mutation=True)
+def get_rollup_store():
+    """Creates the store of daily time rollups shared by every session of the process
+
+    Args:
+        None
+
+    Returns:
+        rollups.RollupStore: process-wide rollup store
+    """
+    return RollupStore()
+
+@st.cache(suppress_st_warning=True, allow_output_mutation=True)
+def precompute_aggregations(target_index, version):
+    """Aggregates every spec in the directory index into the aggregation cache
+
+    Cached by index and data version, so it runs once when a dataset is first loaded and once after every data refresh.
+
+    Args:
+        target_index (str): index pattern of the dataset
+        version (str): data version of the dataset
+
+    Returns:
+        None -> aggregated outputs are stored in the aggregation cache
+    """
+    dataset = load_dataset(target_index)
+    cache = get_aggregation_cache()
+    compiler = get_spec_compiler()
+
+    es_client = get_client()
+    scanner = DirectoryScanner(es_client, os.environ['ELASTIC_CLUSTER'], os.environ['DIRECTORY'])
+    specs = [spec for spec in scanner.get_directory_specs() if compiler.get_source_index(spec) == target_index]
+
+    # specs sharing a grouping key are computed together, broken specs are skipped here and only reported when they are requested
+    planner = AggregationPlanner(dataset, specs, compiler, get_rollup_store(), PartialAggregate.from_group_keys)
+    planner.prefetch(cache, VISUALIZATION_LIMIT)
+
+@st.cache(allow_output_mutation=True)
+def get_directory_index(directory):
+    """Creates the in-process directory index shared by every session of the process
+
+    Args:
+        directory (str): index pattern of the directory index
+
+    Returns:
+        localsearch.DirectoryIndex: in-process directory index, refreshed from Elasticsearch
+    """
+    directory_index = DirectoryIndex(get_client(), os.environ['ELASTIC_CLUSTER'], directory)
+    directory_index.refresh_index(force=True)
+    return directory_index
+
+@st.cache(allow_output_mutation=True)
+def get_export_server():
+    """Starts the export server shared by every session of the process, when an EXPORT_URL is configured
+
+    The server has no authentication of its own: it binds to EXPORT_HOST (the loopback interface by default) and is meant to be
+    reached through the reverse proxy serving EXPORT_URL.
+
+    Args:
+        None
+
+    Returns:
+        exports.ExportServer: running export server, or None if exports are not configured and downloads are inlined in the page
+    """
+    if(EXPORT_URL is None):
+        return None
+
+    export_server = ExportServer(EXPORT_PORT, EXPORT_URL, EXPORT_HOST)
+    export_server.start()
+    return export_server
+
+@st.cache(allow_output_mutation=True)
+def get_metrics_endpoint(port):
+    """Starts the Prometheus metrics endpoint of the process, once
+
+    Args:
+        port (int): port the metrics endpoint listens on
+
+    Returns:
+        port (int): port the metrics endpoint listens on
+    """
+    start_metrics_server(port)
+    return port
 
 def main():
     """Executes the web app logic within Streamlit
@@ -41,75 +381,159 @@ def main():
         None
 
     """
-    st.title('Data Index :mag_right:')
+    # timings of this page run, for the slow-request log
+    trace = RequestTrace(SLOW_REQUEST_SECONDS)
 
-    st.markdown(
-        '''
-        [Data Pages](https://github.com/mateuspicanco/datapages) is a **proof of concept** for a **Data Self-Service** search engine.
-        You can use it to explore the [Olist Dataset](https://www.kaggle.com/olistbr/brazilian-ecommerce?select=olist_order_items_dataset.csv) interactively.
-        Use the search bar below and start exploring Olist orders, sellers and other kinds of data available. Here are a few suggestions for you to try out:
-        - Top sellers
-        - Most sold product categories
-        - Volume of orders over time
-        '''
-    )
+    # the page run is recorded however it ends, including failures and Streamlit reruns, which are the runs most worth seeing
+    try:
+        if(METRICS_PORT):
+            get_metrics_endpoint(int(METRICS_PORT) + WORKER_PORT_OFFSET)
 
-    # instantiate objects clients and search objects
-    es_client = Elasticsearch(os.environ['ELASTIC_CLUSTER'])
+        st.title('Data Index :mag_right:')
 
-    # decided to user the multi match search while boosting description
-    searcher = MultiMatchSearcher(es_client, os.environ['ELASTIC_CLUSTER'], os.environ['DIRECTORY'])
+        st.markdown(
+            '''
+            [Data Pages](https://github.com/mateuspicanco/datapages) is a **proof of concept** for a **Data Self-Service** search engine.
+            You can use it to explore the [Olist Dataset](https://www.kaggle.com/olistbr/brazilian-ecommerce?select=olist_order_items_dataset.csv) interactively.
+            Use the search bar below and start exploring Olist orders, sellers and other kinds of data available. Here are a few suggestions for you to try out:
+            - Top sellers
+            - Most sold product categories
+            - Volume of orders over time
+            '''
+        )
 
-    # loading the dataset from Elasticsearch data store
-    df = load_dataset(os.environ['DATA_INDEX'])
+        # the client and thread pool are shared by every session, searchers are created for each run since they hold the query
+        es_client = get_client()
+        executor = get_executor()
 
+        # decided to user the multi match search while boosting description
+        if(SEARCH_BACKEND == 'local'):
+            directory_index = get_directory_index(os.environ['DIRECTORY'])
+            searcher = LocalMultiMatchSearcher(es_client, os.environ['ELASTIC_CLUSTER'], os.environ['DIRECTORY'], directory_index)
+        else:
+            searcher = MultiMatchSearcher(es_client, os.environ['ELASTIC_CLUSTER'], os.environ['DIRECTORY'])
 
-    search_bar = st.text_input('What kind of information are you looking for?', key='SearchBar')
+        # compiled and validated plans of the directory specs
+        compiler = get_spec_compiler()
 
-    # Check if search bar received a text input
-    if(search_bar):
-        # by default, the specs used took the "description" and "title" fields for search
-        searcher.build_query_object(search_bar, ('description', 'title'))
-        hits = searcher.search_data_directory()
+        # datasets are only loaded when aggregating in memory, the first time one of their specs is requested
+        aggregation_cache = get_aggregation_cache()
+        rollup_store = get_rollup_store()
 
-        # get the ResultsList object to output the search results
-        result_list = ResultList(hits)
+        search_bar = st.text_input('What kind of information are you looking for?', key='SearchBar')
 
-        # establishing a limit for search results for the proof of concept (decided on 5 records)
-        search_limit = 5
+        # Check if search bar received a text input
+        if(search_bar):
+            trace.query = search_bar
 
-        if(len(hits) != 0):
-            st.write(f'Your search for **{search_bar}** returned **{len(hits)}** result(s)')
-            if(len(hits) > search_limit):
-                st.info(f'Showing only the first {limit} results for **{search_bar}**')
+            # by default, the specs used took the "description" and "title" fields for search
+            searcher.build_query_object(search_bar, ('description', 'title'))
 
-            result_list.display_search_results(limit=search_limit)
+            # establishing a limit for search results for the proof of concept (decided on 5 records)
+            search_limit = 5
 
-            # retrieving references for the results so that the vega specs can be called back
-            references = result_list.get_index_references(search_limit)
-            results_bar = st.selectbox(label='Please choose what data source would like to explore',
-                                    options=list(references.keys()),
-                                    key='ResultsBar')
+            # the version of the default data index is read while the directory is searched, to key the pushed down aggregations
+            if(EXECUTION_MODE == 'elasticsearch'):
+                default_searcher = Searcher(es_client, os.environ['ELASTIC_CLUSTER'], os.environ['DATA_INDEX'])
+                version_requests = {os.environ['DATA_INDEX']: executor.submit(default_searcher.get_index_version)}
 
-            if(results_bar):
-                # getting the spec reference
-                plot_ref = references[results_bar]
-                st.spinner('Processing your request...')
-                st.write(f'Please select one of the analysis available')
+            # only the top results by relevance are retrieved, the total is still tracked by Elasticsearch
+            with track('search_data_directory', trace=trace):
+                hits = searcher.search_data_directory(size=search_limit)
 
-                # # generating visualizations
-                plot_type = plot_ref['instructions']['type']
+            # get the ResultsList object to output the search results
+            result_list = ResultList(hits)
 
-                # Visualizer takes the data and the spec
-                visualizer = Visualizer(df, plot_ref)
-                visualizer.display_visualization(limit=10)
+            if(len(hits) != 0):
+                st.write(f'Your search for **{search_bar}** returned **{searcher.total_hits}** result(s)')
+                if(searcher.total_hits > search_limit):
+                    st.info(f'Showing only the first {search_limit} results for **{search_bar}**')
 
-                # # generating the download links from the resulting visualization
-                download_link = Download(visualizer.output)
-                download_link.get_download_link()
+                result_list.display_search_results(limit=search_limit)
 
-        else:
-            st.warning(f'Your search for **{search_bar}** did not return any results')
+                # retrieving references for the results so that the vega specs can be called back
+                references = result_list.get_index_references(search_limit)
+
+                # every result is aggregated ahead of time (in one shared pass, or in concurrent requests), so switching between them hits the cache
+                if(EXECUTION_MODE == 'elasticsearch'):
+                    with track('prefetch', trace=trace):
+                        data_versions = prefetch_pushdowns(executor, es_client, list(references.values()), compiler, aggregation_cache, version_requests, trace)
+                elif(EXECUTION_MODE != 'streaming'):
+                    # results are grouped by source index, broken specs are left out so their datasets are not loaded for nothing
+                    errors = compiler.compile_directory(list(references.values()))
+                    definitions_by_index = {}
+                    for definition in references.values():
+                        if(definition.get('spec_id') not in errors):
+                            definitions_by_index.setdefault(compiler.get_source_index(definition), []).append(definition)
+
+                    for index, definitions in definitions_by_index.items():
+                        with track('load_dataset', trace=trace):
+                            dataset = load_dataset(index)
+                        if(PRECOMPUTE_AGGREGATIONS):
+                            with track('precompute_aggregations', trace=trace):
+                                precompute_aggregations(index, dataset.version)
+                        with track('prefetch', trace=trace):
+                            planner = AggregationPlanner(dataset, definitions, compiler, rollup_store, PartialAggregate.from_group_keys)
+                            planner.prefetch(aggregation_cache, VISUALIZATION_LIMIT)
+
+                results_bar = st.selectbox(label='Please choose what data source would like to explore',
+                                        options=list(references.keys()),
+                                        key='ResultsBar')
+
+                if(results_bar):
+                    # getting the spec reference
+                    plot_ref = references[results_bar]
+                    st.spinner('Processing your request...')
+                    st.write(f'Please select one of the analysis available')
+
+                    # Visualizer takes the data (or the aggregation searcher) and the spec, broken specs are reported instead of rendered
+                    try:
+                        source_index = compiler.get_plan(plot_ref).source_index
+                        if(EXECUTION_MODE == 'elasticsearch'):
+                            aggregator = AggregationSearcher(es_client, os.environ['ELASTIC_CLUSTER'], source_index)
+                            visualizer = ElasticVisualizer(aggregator, plot_ref, compiler, trace, aggregation_cache, data_versions.get(source_index))
+                        elif(EXECUTION_MODE == 'streaming'):
+                            # only the selected result is streamed, since every aggregation reads the whole index
+                            aggregator = StreamingAggregator(es_client, source_index, executor, STREAM_SLICES, STREAM_CHUNK_SIZE)
+                            version = Searcher(es_client, os.environ['ELASTIC_CLUSTER'], source_index).get_index_version()
+                            visualizer = StreamingVisualizer(aggregator, plot_ref, compiler, trace, aggregation_cache, version)
+                        else:
+                            with track('load_dataset', trace=trace):
+                                df = load_dataset(source_index)
+
+                            # timeseries specs can be narrowed to a time window, answered from the daily rollup of their time field
+                            time_range = None
+                            plan = compiler.get_plan(plot_ref)
+                            if(rollup_store.supports(plan)):
+                                cube = rollup_store.get_cube(df, plan)
+                                bounds = cube.get_bounds() if cube is not None else None
+                                if(bounds is not None):
+                                    window = st.date_input('Time window', value=bounds, min_value=bounds[0], max_value=bounds[1])
+                                    if(len(window) == 2 and tuple(window) != bounds):
+                                        time_range = tuple(window)
+
+                            visualizer = Visualizer(df, plot_ref, aggregation_cache, compiler, trace, rollup_store, time_range)
+                    except SpecError as error:
+                        st.error(f'This analysis is currently unavailable: {error}')
+                        return
+
+                    # # generating visualizations
+                    visualizer.display_visualization(limit=VISUALIZATION_LIMIT)
+
+                    # # generating the download links from the resulting visualization
+                    if(EXECUTION_MODE in ('elasticsearch', 'streaming')):
+                        download_link = Download(visualizer.output, get_export_server(), trace=trace, reduction=visualizer.reduction)
+                    else:
+                        download_link = Download(
+                            visualizer.output, get_export_server(), df, plot_ref['instructions']['dimensions'], trace, visualizer.reduction,
+                            visualizer.time_range, visualizer.plan.time_field
+                        )
+                    download_link.get_download_link()
+
+            else:
+                st.warning(f'Your search for **{search_bar}** did not return any results')
+    finally:
+        trace.finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide caches shared by every Streamlit session
+"""
+
+import threading
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+
+class AggregationCache:
+    """Memory-bounded LRU cache of aggregation results (Visualizer outputs)
+
+    Entries are keyed by spec id, limit and dataset version, so every session rendering the same analysis over the same data reuses the same result.
+    When the total size of the cached results exceeds the memory bound, the least recently used entries are evicted.
+    Results can be cached with the mergeable partial they were finalized from, so they are carried over to the next data version by
+    merging the documents appended to the index (see append_documents) instead of being aggregated again.
+
+    Args:
+        max_bytes (int): memory bound for the cached results, in bytes
+
+    Attributes:
+        max_bytes (int): memory bound for the cached results, in bytes
+        entries (collections.OrderedDict): cached results, their partials and their sizes, ordered from least to most recently used
+        size (int): total size of the cached results, in bytes
+        hits (int): number of lookups answered from the cache
+        misses (int): number of lookups that were not cached
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(plan, limit, version):
+        """Builds the key of an aggregated output
+
+        The version of the spec itself is part of the key, so editing a spec never serves a stale result.
+
+        Args:
+            plan (plans.SpecPlan): compiled plan of the spec
+            limit (int): limit used for the aggregation
+            version (str): data version of the dataset
+
+        Returns:
+            key (tuple): (spec_id, spec version, limit, version) key of the result
+        """
+        return (plan.spec_id, plan.version, limit, version)
+
+    def get(self, key):
+        """Retrieves a cached result and marks it as the most recently used
+
+        Args:
+            key (tuple): key of the result built by make_key
+
+        Returns:
+            pandas.DataFrame: cached result, or None if the key is not cached
+        """
+        with self.lock:
+            if(key not in self.entries):
+                self.misses += 1
+                CACHE_LOOKUPS.labels('aggregation', 'miss').inc()
+                return None
+
+            self.hits += 1
+            CACHE_LOOKUPS.labels('aggregation', 'hit').inc()
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, output, partial=None):
+        """Caches a result, evicting the least recently used results while the memory bound is exceeded
+
+        Args:
+            key (tuple): key of the result built by make_key
+            output (pandas.DataFrame): aggregated result to cache
+            partial (streaming.PartialAggregate): partial the result was finalized from. Defaults to None, dropping the result when the data changes.
+
+        Returns:
+            None -> result is stored in the entries attribute
+        """
+        output_size = int(output.memory_usage(index=True, deep=True).sum()) + (partial.nbytes if partial is not None else 0)
+
+        # results larger than the whole cache are never kept
+        if(output_size > self.max_bytes):
+            return
+
+        with self.lock:
+            if(key in self.entries):
+                self.size -= self.entries.pop(key)[2]
+
+            self.entries[key] = (output, partial, output_size)
+            self.size += output_size
+
+            while(self.size > self.max_bytes):
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def append_documents(self, dataset, appended, previous_version):
+        """Carries the results of the previous data version of a dataset over to its new version, merging the appended documents into their partials
+
+        Results cached without a partial, or whose fields are missing from the appended documents, are dropped and aggregated again when requested.
+
+        Args:
+            dataset (datasets.ProjectedDataset): refreshed dataset, holding its new version
+            appended (pandas.DataFrame): appended documents
+            previous_version (str): data version of the dataset before the appends
+
+        Returns:
+            None -> results are stored under the new version
+        """
+        with self.lock:
+            stale = [(key, partial) for key, (_, partial, _) in self.entries.items() if key[3] == previous_version]
+            for key, _ in stale:
+                self.size -= self.entries.pop(key)[2]
+
+        for (spec_id, spec_version, limit, _), partial in stale:
+            if(partial is None or not set(partial.plan.group_fields + (partial.plan.agg_field,)).issubset(appended.columns)):
+                continue
+            partial.add_chunk(appended)
+            self.put((spec_id, spec_version, limit, dataset.version), partial.finalize(limit), partial)
+
+    def clear(self):
+        """Removes every cached result
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
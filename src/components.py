@@ -5,24 +5,55 @@ Custom components for displaying information in a specific way in Streamlit
 
 # data processing imports
 import base64
-import numpy as np
 import pandas as pd
 
 # streamlit
 import streamlit as st
 
+# aggregation engine and exports
+from aggregations import GroupKeys, build_group_keys, aggregate, get_day_offsets, get_day_window, load_plan_fields
+from streaming import PartialAggregate
+from exports import ExportSource
+from reductions import reduce_output
+from plans import SpecCompiler
+from metrics import track
+
 class Download:
     """Download URL handler for providing download functionality to Streamlit page
 
+    When an export server is given, the data is registered for export and only links are written to the page: the data is streamed
+    in chunks (CSV, gzip-compressed CSV, Parquet or Arrow) when a link is clicked. Otherwise, the data is inlined as a base64 CSV link.
+
     Args: 
         dataframe (pandas.DataFrame): data that will be used for generating the results for download
+        export_server (exports.ExportServer): server streaming the exports. Defaults to None, inlining the data in the page.
+        source (pandas.DataFrame or datasets.ProjectedDataset): dataset holding the underlying rows of the results. Defaults to None.
+        columns (list): columns of the underlying rows to export. Defaults to None, exporting every column.
+        trace (metrics.RequestTrace): trace of the current page run, recording the encoding time. Defaults to None.
+        reduction (reductions.Reduction): reduction applied to the charted data, noted next to the links. Defaults to None.
+        time_range (tuple): (start, end) dates, both inclusive, restricting the underlying rows to the time window of the page. Defaults to None.
+        time_field (str): field the time window applies to. Defaults to None.
 
     Attributes:
         dataframe (pandas.DataFrame): data attribute that will be converted into base64 file for download
+        export_server (exports.ExportServer): server streaming the exports
+        source (pandas.DataFrame or datasets.ProjectedDataset): dataset holding the underlying rows of the results
+        columns (list): columns of the underlying rows to export
+        trace (metrics.RequestTrace): trace of the current page run
+        reduction (reductions.Reduction): reduction applied to the charted data, the downloaded data is never reduced
+        time_range (tuple): (start, end) dates restricting the underlying rows to the time window of the page
+        time_field (str): field the time window applies to
 
     """
-    def __init__(self, dataframe):
+    def __init__(self, dataframe, export_server=None, source=None, columns=None, trace=None, reduction=None, time_range=None, time_field=None):
         self.dataframe = dataframe
+        self.export_server = export_server
+        self.source = source
+        self.columns = columns
+        self.trace = trace
+        self.reduction = reduction
+        self.time_range = time_range
+        self.time_field = time_field
 
     def get_csv_data(self):
         """Simple wrappper on top of pandas.DataFrame.to_csv() with previously specified parameters
@@ -35,6 +66,54 @@ class Download:
         """
         self.data = self.dataframe.to_csv(index=False)
 
+    def get_source_rows(self):
+        """Selects the underlying rows to export, only built when the export is requested
+
+        The registered export only references the needed columns of the loaded frame, never the dataset itself: a dataset released
+        by the memory budget is not loaded again by a click on a link.
+
+        Args:
+            None
+
+        Returns:
+            callable: returns the underlying rows within the time window of the page
+        """
+        needed = list(self.columns) if self.columns is not None else None
+        if(needed is not None and self.time_range is not None and self.time_field not in needed):
+            needed.append(self.time_field)
+
+        frame = self.source.load_columns(needed or []) if hasattr(self.source, 'load_columns') else self.source
+        columns = {column: frame[column] for column in (needed or frame.columns)}
+        time_range, time_field = self.time_range, self.time_field
+
+        def get_frame():
+            rows = pd.DataFrame(columns)
+            if(time_range is not None):
+                # the same window as the chart (see GroupKeys.from_times)
+                days, valid = get_day_offsets(rows[time_field])
+                first, last = get_day_window(time_range)
+                rows = rows[valid & (days >= first) & (days <= last)]
+            return rows
+        return get_frame
+
+    def get_export_links(self, get_frame, columns=None, name='analysis'):
+        """Registers data for export and builds its download links
+
+        Args:
+            get_frame (callable): returns the dataframe to export when a link is clicked
+            columns (list): subset of columns to export. Defaults to None, exporting every column.
+            name (str): file name of the export. Defaults to "analysis".
+
+        Returns:
+            links (str): html links for each export format
+        """
+        token = self.export_server.register(ExportSource(get_frame, columns, name))
+        labels = {'csv': 'CSV', 'csv.gz': 'CSV (gzip)', 'parquet': 'Parquet', 'arrow': 'Arrow'}
+        return ' | '.join(
+            f'<a href="{self.export_server.get_url(token, export_format)}" download>{label}</a>'
+            for export_format, label in labels.items()
+        )
+
     def get_download_link(self):
         """Generates a download clickable link containing the data processed by the Download object
 
@@ -45,13 +124,24 @@ class Download:
             streamlit html ref: resulting html element on page with clickable href
 
         """
-        self.get_csv_data()
+        # the chart may show a reduced output, the downloads always hold every data point
+        note = '' if self.reduction is None else f'{self.reduction.describe()}, the download holds every data point.<br>'
 
-        # encodes data for download in the browser
-        self.download_object = base64.b64encode(self.data.encode()).decode()
+        if(self.export_server is not None):
+            dataframe = self.dataframe
+            href = f'{note}Download the data for your search: {self.get_export_links(lambda: dataframe)}'
+            if(self.source is not None):
+                href += f'<br>Download the underlying rows: {self.get_export_links(self.get_source_rows(), self.columns, "rows")}'
+            return st.write(href, unsafe_allow_html=True)
+
+        with track('download_encode', trace=self.trace):
+            self.get_csv_data()
+
+            # encodes data for download in the browser
+            self.download_object = base64.b64encode(self.data.encode()).decode()
 
         # builds the html object 
-        href = f'Click <i><a href="data:file/csv;base64,{self.download_object}" download="analysis.csv">here</a></i> to download the data for your search.'
+        href = f'{note}Click <i><a href="data:file/csv;base64,{self.download_object}" download="analysis.csv">here</a></i> to download the data for your search.'
         return st.write(href, unsafe_allow_html=True)
 
 class ResultList:
@@ -120,68 +210,139 @@ class Visualizer:
     """Visualization handler for interface with the Directory index and Vega-lite specs
 
     Args:
-        data (pandas.DataFrame): original dataset that will be used to generate "views" given vega-lite specs.
+        data (pandas.DataFrame or datasets.ProjectedDataset): original dataset that will be used to generate "views" given vega-lite specs.
         definition (dict): json-like object from directory search results 
+        cache (caching.AggregationCache): cache of aggregated outputs shared across sessions. Defaults to None, disabling caching.
+        compiler (plans.SpecCompiler): compiler providing validated plans for the definitions. Defaults to None, compiling without schema checks.
+        trace (metrics.RequestTrace): trace of the current page run, recording the time of each stage. Defaults to None.
+        cubes (rollups.RollupStore): daily rollups answering timeseries specs without scanning the rows. Defaults to None, aggregating the rows.
+        time_range (tuple): (start, end) dates, both inclusive, restricting timeseries specs to a time window. Defaults to None.
     
     Attributes:
-        data (pandas.DataFrame): dataset that will be used to create views for visualizations
+        data (pandas.DataFrame or datasets.ProjectedDataset): dataset that will be used to create views for visualizations
         definition (dict): raw json-like object from search
         instructions (dict): json-like object from raw definition isolating just the instruction set for building the visualization
         specs (dict): json-link object with explicit vega-lite specs
+        cache (caching.AggregationCache): cache of aggregated outputs shared across sessions
+        plan (plans.SpecPlan): compiled plan of the definition, raises plans.SpecError on creation if the definition is not valid
+        trace (metrics.RequestTrace): trace of the current page run
+        cubes (rollups.RollupStore): daily rollups answering timeseries specs without scanning the rows
+        time_range (tuple): (start, end) dates restricting timeseries specs to a time window, ignored by category specs
+        reduction (reductions.Reduction): reduction applied to the output when it was last charted, None when charted as it is
+        frame (pandas.DataFrame): fields of the spec read from the dataset, None until they are loaded (see load_data)
+        version (str): data version of the loaded fields, None for datasets that are not versioned
 
     """
-    def __init__(self, data, definition):
+    def __init__(self, data, definition, cache=None, compiler=None, trace=None, cubes=None, time_range=None):
         self.data = data
         self.definition = definition
         self.instructions = self.definition['instructions']
         self.specs = self.definition['specs']
+        self.cache = cache
+        self.plan = (compiler or SpecCompiler()).get_plan(definition)
+        self.trace = trace
+        self.cubes = cubes
+        self.time_range = time_range if self.plan.report_type == 'timeseries' else None
+        self.reduction = None
+        self.frame = None
+        self.version = None
 
-    def build_handle(self):
-        """Defines an aggreagtion handle based on the type of plot requested in the instruction set
+    def load_data(self):
+        """Reads the fields of the spec from the dataset, along with their data version
+
+        The group keys, the values, the partial, the cube and the cache key of an output are all built from the fields read here,
+        so an output is never built from rows of another version than the one it is cached under.
 
         Args:
-            None -> logic is entirely contained within the instruction set
+            None
 
         Returns:
-            None -> output is stored in self.handle object
+            None -> frame and version attributes are updated
+        """
+        self.frame, self.version = load_plan_fields(self.data, [self.plan])
+
+    def get_cache_key(self, limit=10):
+        """Builds the key of the aggregated output in the aggregation cache
 
+        Args:
+            limit (int): limit used for the aggregation
+
+        Returns:
+            key (tuple): key built by the cache for the version of the loaded fields, or None if the dataset is not versioned
         """
+        if(self.version is None):
+            return None
+        return self.cache.make_key(self.plan, limit, self.version)
+
+    def build_output(self, limit=10):
+        """Builds the aggregated output, reusing the cached output for the same spec, limit and dataset version when available
+
+        Timeseries specs are rolled up from the daily cube of their time field when a rollup store is given. Outputs restricted to a
+        time window are not cached, since every window is answered from the cube (or the rows) instead.
+
+        Args:
+            limit (int): limits the number of output data points to not overcrowd the visualization -> useful for categorical data with high cardinality
 
-        # make a copy of the data to avoid self-referencing
-        data = self.data[self.instructions['dimensions']].copy()
+        Returns:
+            None -> generates output attribute containing the aggregated data in the expected format for vega-lite plotting
+        """
+        self.load_data()
+        key = None
+        if(self.cache is not None and self.time_range is None):
+            key = self.get_cache_key(limit)
+
+        if(key is not None):
+            output = self.cache.get(key)
+            if(output is not None):
+                self.output = output
+                return
+
+        if(self.cubes is not None and self.cubes.supports(self.plan)):
+            with track('rollup', self.plan.spec_id, self.trace):
+                output = self.cubes.aggregate(self.data, self.plan, self.time_range, (self.frame, self.version))
+            if(output is not None):
+                self.output = output
+                if(key is not None):
+                    self.cache.put(key, self.output)
+                return
+
+        with track('build_handle', self.plan.spec_id, self.trace):
+            self.build_handle()
+        with track('make_aggregation', self.plan.spec_id, self.trace):
+            self.make_aggregation(limit)
+
+        if(key is not None):
+            self.cache.put(key, self.output, self.get_partial())
+
+    def get_partial(self):
+        """Builds the mergeable partial of the aggregated output from the group keys, so the cached output can absorb documents appended to the dataset
 
-        # get the type of plot being requested
-        report_type = self.instructions['type']
+        Args:
+            None
 
-        # check if plot type is time-based (timeseries, data that is associated with time objects)
-        if(report_type == 'timeseries'):
-            time_field = self.instructions['time_field']
-            time_unit = self.instructions['time_unit']
+        Returns:
+            streaming.PartialAggregate: partial of the output, or None if the output can not be updated incrementally
+        """
+        if(not isinstance(self.handle, GroupKeys)):
+            return None
+        return PartialAggregate.from_group_keys(self.plan, self.handle, self.frame)
 
-            # converts time field to pandas DateTime object
-            data[time_field] = pd.to_datetime(data[time_field])
-            data = data.set_index(time_field)
+    def build_handle(self):
+        """Defines an aggreagtion handle based on the type of plot requested in the instruction set
 
-            # Check each unit for resampling 
-            if(time_unit == 'month'):
-                data_handle = data.resample('1M')
-                self.handle = data_handle
+        The handle holds the factorized grouping keys, so no copy of the dimension columns is made.
 
-            elif(time_unit == 'day'):
-                data_handle = data.resample('1d')
-                self.handle = data_handle
-            else:
-                raise TypeError(f"{time_unit} is not a valid time unit")
+        Args:
+            None -> logic is entirely contained within the compiled plan of the instruction set
 
-        # If report is not timeseries (category)
-        elif(report_type == 'category'):
-            cat_field = self.instructions['cat_field']
+        Returns:
+            None -> output is stored in self.handle object
 
-            # group by target category
-            data_handle = data.groupby(cat_field)
-            self.handle = data_handle
-        else:
-            raise TypeError(f"Instruction set{self.instruction} given is not valid, check for plot types or dimensions")
+        """
+        if(self.frame is None):
+            self.load_data()
+        # categories are factorized, time fields are binned into periods (including empty periods as in resampling)
+        self.handle = build_group_keys(self.frame, self.plan, self.time_range)
 
     def make_aggregation(self, limit=10):
         """Builds the aggregation from the previously defined handles
@@ -191,36 +352,14 @@ class Visualizer:
         Returns:
             None -> generates output attribute containing the aggregated data in the expected format for vega-lite plotting 
         """
-        op = self.instructions['agg_operation']
-        sort = False
-        if(self.instructions['type'] == 'category'):
-            sort = True
-        if(op == 'count'):
-            if(sort):
-                self.output = self.handle.aggregate(len).reset_index().sort_values(by=self.instructions['agg_field'], ascending=False).reset_index(drop=True).head(limit)
-            else:
-                self.output = self.handle.aggregate(len).reset_index()
-        elif(op == 'sum'):
-            if(sort):
-                self.output = self.handle.aggregate(np.sum).reset_index().sort_values(by=self.instructions['agg_field'], ascending=False).reset_index(drop=True).head(limit)
-            else:
-                self.output = self.handle.aggregate(np.sum).reset_index()
-        elif(op == 'mean'):
-            if(sort):
-                self.output = self.handle.aggregate(np.mean).reset_index().sort_values(by=self.instructions['agg_field'], ascending=False).reset_index(drop=True).head(limit)
-            else:
-                self.output = self.handle.aggregate(np.mean).reset_index()
-        elif(op == 'median'):
-            if(sort):
-                self.output = self.handle.aggregate(np.median).reset_index().sort_values(by=self.instructions['agg_field'], ascending=False).reset_index(drop=True).head(limit)
-            else:
-                self.output = self.handle.aggregate(np.median).reset_index()
-        else:
-            raise NotImplementedError('{op} operation is not supported')
+        self.output = aggregate(self.handle, self.frame, self.plan, limit)
 
     def display_visualization(self, limit=10):
         """Builds and displays Vega-lite visualizations in streamlit pages
 
+        The output is reduced to the resolution of the chart before it is sent to the page (see reductions.reduce_output), the reduction
+        applied is kept in the reduction attribute and the output attribute keeps every data point for downloads.
+
         Args:
             limit (int): limits the number of output data points to not overcrowd the visualization -> useful for categorical data with high cardinality
 
@@ -228,6 +367,98 @@ class Visualizer:
             streamlit vega_lite chart: vega-lite chart object with the given specifications
 
         """
-        self.build_handle()
-        self.make_aggregation(limit)
-        return st.vega_lite_chart(self.output, self.specs)
+        self.build_output(limit)
+        with track('reduce_output', self.plan.spec_id, self.trace):
+            chart_output, self.reduction = reduce_output(self.output, self.specs, self.plan)
+        with track('render', self.plan.spec_id, self.trace):
+            return st.vega_lite_chart(chart_output, self.specs)
+
+class ElasticVisualizer(Visualizer):
+    """Extends Visualizer by pushing the aggregation down to Elasticsearch instead of aggregating a pandas copy of the dataset
+
+    Args:
+        searcher (searchutils.AggregationSearcher): aggregation searcher pointing to the data index
+        definition (dict): json-like object from directory search results
+        compiler (plans.SpecCompiler): compiler providing validated plans for the definitions. Defaults to None, compiling without schema checks.
+        trace (metrics.RequestTrace): trace of the current page run, recording the time of each stage. Defaults to None.
+        cache (caching.AggregationCache): cache of aggregated outputs shared across sessions. Defaults to None, disabling caching.
+        version (str): data version of the data index, used to key cached outputs. Defaults to None, disabling caching.
+
+    Attributes:
+        searcher (searchutils.AggregationSearcher): aggregation searcher used to compile and run the instruction set
+        version (str): data version of the data index, used to key cached outputs
+        definition (dict): raw json-like object from search
+        instructions (dict): json-like object from raw definition isolating just the instruction set for building the visualization
+        specs (dict): json-link object with explicit vega-lite specs
+
+    """
+    def __init__(self, searcher, definition, compiler=None, trace=None, cache=None, version=None):
+        Visualizer.__init__(self, None, definition, cache, compiler, trace)
+        self.searcher = searcher
+        self.version = version
+
+    def get_cache_key(self, limit=10):
+        """Builds the key of the aggregated output in the aggregation cache, from the version of the data index
+
+        Args:
+            limit (int): limit used for the aggregation
+
+        Returns:
+            key (tuple): key built by the cache, or None if the data version is unknown and the output can not be cached
+        """
+        if(self.version is None):
+            return None
+        return self.cache.make_key(self.plan, limit, self.version)
+
+    def build_handle(self):
+        """Defines the aggregation handle as the Elasticsearch searcher, no data is held in memory
+
+        Args:
+            None
+
+        Returns:
+            None -> output is stored in self.handle object
+        """
+        self.handle = self.searcher
+
+    def make_aggregation(self, limit=10):
+        """Compiles the instruction set into an Elasticsearch aggregation and builds the output from its response
+
+        Args:
+            limit (int): limits the number of output data points to not overcrowd the visualization -> useful for categorical data with high cardinality
+
+        Returns:
+            None -> generates output attribute containing the aggregated data in the expected format for vega-lite plotting
+        """
+        self.handle.build_query_object(self.instructions, limit)
+        self.output = self.handle.aggregate_data_index()
+
+class StreamingVisualizer(ElasticVisualizer):
+    """Extends ElasticVisualizer by aggregating the data index out of core, streaming its chunks instead of pushing the aggregation down
+
+    Args:
+        aggregator (streaming.StreamingAggregator): streaming aggregator pointing to the data index
+        definition (dict): json-like object from directory search results
+        compiler (plans.SpecCompiler): compiler providing validated plans for the definitions. Defaults to None, compiling without schema checks.
+        trace (metrics.RequestTrace): trace of the current page run, recording the time of each stage. Defaults to None.
+        cache (caching.AggregationCache): cache of aggregated outputs shared across sessions. Defaults to None, disabling caching.
+        version (str): data version of the data index, used to key cached outputs. Defaults to None, disabling caching.
+
+    Attributes:
+        searcher (streaming.StreamingAggregator): streaming aggregator reading the data index
+        version (str): data version of the data index, used to key cached outputs
+        definition (dict): raw json-like object from search
+        instructions (dict): json-like object from raw definition isolating just the instruction set for building the visualization
+        specs (dict): json-link object with explicit vega-lite specs
+
+    """
+    def make_aggregation(self, limit=10):
+        """Streams the dimensions of the spec in chunks and merges their partial aggregations
+
+        Args:
+            limit (int): limits the number of output data points to not overcrowd the visualization -> useful for categorical data with high cardinality
+
+        Returns:
+            None -> generates output attribute containing the aggregated data in the expected format for vega-lite plotting
+        """
+        self.output = self.handle.aggregate(self.plan, limit, self.time_range)
@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+"""
+Datasets loaded from the Elasticsearch data store, used as the data source for visualizations
+"""
+
+import time
+import threading
+from collections import OrderedDict
+import pandas as pd
+import eland as ed
+from elasticsearch import Elasticsearch
+
+from metrics import track, record_dataset, DATASET_EVICTIONS
+
+class ProjectedDataset:
+    """Column-projected view of a data index, loading only the columns that are referenced by specs
+
+    Columns are fetched through Eland column selection and any column that was not loaded up front is loaded lazily the first time it is requested.
+    When a snapshot store is given, columns are memory-mapped from the local snapshot and only fetched from Elasticsearch when missing from it.
+    Processes sharing the snapshot directory fetch each column and each appended document once: the first one writes the snapshot under a
+    lock of the store, and the others memory-map it (see snapshots.SharedSnapshotStore).
+    When a watermark field is given (a timestamp or sequence field that only grows as documents are added), documents appended to the
+    index are pulled on their own, above the largest value loaded so far (the high-water mark), instead of loading the index again.
+    Updates and deletions are detected from the deleted documents count of the index, which they raise until segments are merged.
+
+    Args:
+        cluster_location (str or elasticsearch.Elasticsearch): string reference to cluster connection, or client used by Eland. Ex: http://somecluster@password:9200/
+        index_reference (str): index pattern of the data index
+        version (str): data version of the index, used to key snapshots and cached aggregations
+        store (snapshots.SnapshotStore): snapshot store used to cache the loaded columns. Defaults to None, disabling snapshots.
+        watermark_field (str): field tracking appended documents. Defaults to None, disabling incremental refreshes.
+
+    Attributes:
+        cluster_location (str or elasticsearch.Elasticsearch): used in Eland-based queries
+        index_reference (str): index pattern of the data index
+        store (snapshots.SnapshotStore): snapshot store used to cache the loaded columns
+        version (str): data version of the index, used to key snapshots and cached aggregations
+        watermark_field (str): field tracking appended documents
+        data (pandas.DataFrame): columns loaded so far, indexed by document id
+        nbytes (int): memory footprint of the columns loaded so far, in bytes (private memory only for columns mapped from a shared store)
+        deleted (int): deleted documents count of the index when the loaded documents were read, None if unknown
+        published (float): time at which the loaded version was resolved, orders the snapshots of different versions
+
+    """
+    def __init__(self, cluster_location, index_reference, version, store=None, watermark_field=None):
+        self.cluster_location = cluster_location
+        self.index_reference = index_reference
+        self.version = version
+        self.store = store
+        self.watermark_field = watermark_field
+        self.data = None
+        self.nbytes = 0
+        self.deleted = None
+        self.published = time.time()
+        # reentrant, so the columns and their version can be read under the same lock (see load_version)
+        self.lock = threading.RLock()
+
+    @property
+    def columns(self):
+        """List of the columns loaded so far"""
+        return [] if self.data is None else list(self.data.columns)
+
+    def fetch_columns(self, columns):
+        """Fetches a subset of columns from the data index through Eland column selection
+
+        Args:
+            columns (list): columns to fetch
+
+        Returns:
+            pandas.DataFrame: fetched columns, indexed by document id
+        """
+        ed_df = ed.read_es(self.cluster_location, self.index_reference)
+        return ed.eland_to_pandas(ed_df[columns])
+
+    def fetch_appended(self, columns, watermark):
+        """Fetches the documents at or above a high-water mark through an Eland query
+
+        Args:
+            columns (list): columns to fetch
+            watermark (object): high-water mark, documents whose watermark field is at least this value are fetched
+
+        Returns:
+            pandas.DataFrame: fetched columns of the matching documents, indexed by document id
+        """
+        ed_df = ed.read_es(self.cluster_location, self.index_reference).es_query({'range': {self.watermark_field: {'gte': watermark}}})
+        return ed.eland_to_pandas(ed_df[columns])
+
+    def count_documents(self):
+        """Counts the documents of the data index, and the deleted documents its segments still hold
+
+        Args:
+            None
+
+        Returns:
+            tuple: number of documents and number of deleted documents in the index
+        """
+        es_client = self.cluster_location if isinstance(self.cluster_location, Elasticsearch) else Elasticsearch(self.cluster_location)
+        stats = es_client.indices.stats(index=self.index_reference, metric='docs')
+        docs = [index_stats['primaries']['docs'] for index_stats in stats['indices'].values()]
+        return sum(index_docs['count'] for index_docs in docs), sum(index_docs['deleted'] for index_docs in docs)
+
+    def get_watermark(self):
+        """High-water mark of the loaded documents, as sent in range queries
+
+        Args:
+            None
+
+        Returns:
+            object: largest value of the watermark field (ISO string for dates), or None if no document has one
+        """
+        watermark = self.data[self.watermark_field].max()
+        if(pd.isna(watermark)):
+            return None
+        if(isinstance(watermark, pd.Timestamp)):
+            return watermark.isoformat()
+        return watermark.item() if hasattr(watermark, 'item') else watermark
+
+    def append_documents(self, version):
+        """Pulls the documents appended to the index since the loaded columns were read, and appends them to the dataset
+
+        Documents are fetched from the high-water mark on (documents sharing the last loaded value can still be arriving) and
+        the ones already loaded are left out. The refresh only succeeds when the index grew by exactly the new documents:
+        deleted or updated documents can not be told apart from the watermark, and the index has to be loaded again instead.
+        When documents arrive while the refresh runs, it is deferred to the next version check: the dataset keeps its version
+        and no documents are returned.
+
+        Args:
+            version (str): data version of the index after the appends
+
+        Returns:
+            pandas.DataFrame: appended documents (loaded columns only), or None if the dataset can not be refreshed incrementally
+        """
+        if(self.watermark_field is None or self.data is None):
+            return None
+        self.load_columns([self.watermark_field])
+
+        with self.lock:
+            # released by the memory budget meanwhile, the index is loaded again when requested
+            if(self.data is None):
+                return None
+            if(self.store is None):
+                return self.pull_documents(version)
+
+            # the first process noticing the new version pulls the appended documents and writes the snapshot, the others read it
+            with self.store.lock(self.index_reference):
+                if(set(self.columns) <= set(self.store.get_snapshot_columns(self.index_reference, version))):
+                    return self.read_documents(version)
+                return self.pull_documents(version)
+
+    def pull_documents(self, version):
+        """Fetches the documents at or above the high-water mark from the data index and appends the ones not loaded yet
+
+        Args:
+            version (str): data version of the index after the appends
+
+        Returns:
+            pandas.DataFrame: appended documents (loaded columns only), or None if the index did not grow by exactly these documents
+        """
+        watermark = self.get_watermark()
+        if(watermark is None or self.deleted is None):
+            return None
+
+        # counted before the fetch, so documents indexed during the fetch are extra documents rather than missing ones
+        published = time.time()
+        expected, deleted = self.count_documents()
+        # updated and deleted documents stay in the deleted count until their segments are merged (merges lower the count again,
+        # the baseline follows them)
+        if(deleted > self.deleted):
+            return None
+
+        with track('fetch_appended'):
+            fetched = self.fetch_appended(self.columns, watermark)
+        loaded = fetched.index.isin(self.data.index)
+        delta = fetched[~loaded]
+
+        # documents sharing the high-water mark are fetched again, they must not have changed since they were loaded
+        refetched = fetched[loaded]
+        current = self.data.loc[refetched.index]
+        for column in self.data.columns:
+            if(not refetched[column].astype(object).equals(current[column].astype(object))):
+                return None
+
+        # documents indexed after the count are among the fetched ones, the refresh is deferred to the next version check
+        if(len(self.data) <= expected < len(self.data) + len(delta)):
+            return delta.iloc[:0]
+        if(len(self.data) + len(delta) != expected):
+            return None
+
+        # readers still hold the previous frame, the appended frame replaces it at once
+        appended = delta[self.data.columns]
+        data = pd.concat([self.data, appended])
+        if(self.store is not None):
+            # other processes only extend the version they loaded with the snapshot of the version it was appended to
+            self.store.append_snapshot(data, appended, self.index_reference, version, self.version, {'deleted': deleted, 'published': published})
+            # a snapshot compacted into a single file is mapped again, releasing the concatenated copy
+            if(len(self.store.get_snapshot_chain(self.index_reference, version)) == 1):
+                data = self.store.read_snapshot(self.index_reference, version, self.columns)
+                # measured as mapped, the appended documents follow the loaded ones
+                appended = data.iloc[len(self.data):]
+        self.deleted = deleted
+        self.published = published
+        self.swap_data(data, version, appended)
+        return delta
+
+    def read_documents(self, version):
+        """Swaps the loaded columns for the snapshot of a newer version, written by another process
+
+        Args:
+            version (str): data version of the snapshot
+
+        Returns:
+            pandas.DataFrame: documents of the snapshot that were not loaded yet, or None if the snapshot is not an append of the loaded version
+        """
+        # a snapshot written by a full reload may hold updated documents, or documents missing from the loaded columns
+        metadata = self.store.get_snapshot_metadata(self.index_reference, version)
+        if(metadata.get('appended_to') != self.version or 'deleted' not in metadata):
+            return None
+
+        # a segment only holds the appended documents, they are appended to the loaded columns as the writing process did
+        if(int(metadata.get('segments', 0)) > 0):
+            with track('read_snapshot'):
+                appended = self.store.read_segment(self.index_reference, version, self.columns)
+            data = pd.concat([self.data, appended[self.data.columns]])
+        else:
+            with track('read_snapshot'):
+                data = self.store.read_snapshot(self.index_reference, version, self.columns)
+
+            # the snapshot only extends the loaded columns when every loaded document is still in it (document ids are unique)
+            loaded = data.index.isin(self.data.index)
+            if(loaded.sum() != len(self.data)):
+                return None
+            appended = data[~loaded]
+
+        self.deleted = int(metadata['deleted'])
+        self.published = float(metadata.get('published', time.time()))
+        self.swap_data(data, version, appended)
+        return appended
+
+    def swap_data(self, data, version, appended):
+        """Replaces the loaded columns by a new version of the dataset, extending the loaded ones with appended documents
+
+        Args:
+            data (pandas.DataFrame): columns of the new version, indexed by document id
+            version (str): data version of the new columns
+            appended (pandas.DataFrame): documents of the new version that were not loaded, only their footprint is measured
+
+        Returns:
+            None -> data, version and nbytes attributes are updated
+        """
+        self.data = data
+        self.version = version
+        self.nbytes += self.get_nbytes(appended)
+        record_dataset(self)
+
+    def get_nbytes(self, frame, index=True):
+        """Measures the memory footprint of loaded columns, as accounted by the snapshot store when there is one
+
+        Args:
+            frame (pandas.DataFrame): loaded columns
+            index (bool): whether the index is measured too. Defaults to True.
+
+        Returns:
+            int: memory footprint of the columns, in bytes
+        """
+        if(self.store is None):
+            return int(frame.memory_usage(index=index, deep=True).sum())
+        return self.store.get_nbytes(frame, index)
+
+    def load_columns(self, columns):
+        """Loads the requested columns that are not loaded yet
+
+        Args:
+            columns (list): columns that should be available in the dataset
+
+        Returns:
+            pandas.DataFrame: loaded columns, as held when the requested ones were available. The data attribute may be released
+            by another thread as soon as the lock is released, so readers select from the returned frame.
+        """
+        with self.lock:
+            missing = [column for column in columns if column not in self.columns]
+            if(not missing):
+                return self.data
+
+            # the baseline of incremental refreshes is counted before the documents are read, see pull_documents
+            if(self.data is None and self.watermark_field is not None):
+                self.deleted = self.count_documents()[1]
+
+            if(self.store is None):
+                with track('fetch_columns'):
+                    frame = self.fetch_columns(missing)
+            else:
+                # a single process fetches the columns missing from the snapshot, the others wait for the snapshot and read it
+                with self.store.lock(self.index_reference):
+                    snapshot_columns = self.store.get_snapshot_columns(self.index_reference, self.version)
+                    to_fetch = [column for column in missing if column not in snapshot_columns]
+
+                    # the snapshot is rewritten with the new columns so the next process does not fetch them again
+                    if(to_fetch):
+                        with track('fetch_columns'):
+                            fetched = self.fetch_columns(to_fetch)
+                        snapshot = self.store.read_snapshot(self.index_reference, self.version)
+                        if(snapshot is not None):
+                            fetched = snapshot.join(fetched)
+                        metadata = self.store.get_snapshot_metadata(self.index_reference, self.version)
+                        if(snapshot is None and self.deleted is not None):
+                            metadata['deleted'] = self.deleted
+                        metadata.setdefault('published', self.published)
+                        self.store.write_snapshot(fetched, self.index_reference, self.version, metadata)
+
+                    # documents read from the snapshot were counted by the process that wrote it
+                    metadata = self.store.get_snapshot_metadata(self.index_reference, self.version)
+                    if(self.data is None and 'deleted' in metadata):
+                        self.deleted = int(metadata['deleted'])
+                    if(self.data is None and 'published' in metadata):
+                        self.published = float(metadata['published'])
+
+                with track('read_snapshot'):
+                    frame = self.store.read_snapshot(self.index_reference, self.version, missing)
+
+            if(self.data is None):
+                self.data = frame
+                self.nbytes = self.get_nbytes(frame)
+            else:
+                # a shallow copy keeps the loaded columns shared while readers still hold the previous frame
+                data = self.data.copy(deep=False)
+                for column in missing:
+                    data[column] = frame[column]
+                self.data = data
+                self.nbytes += self.get_nbytes(frame[missing], index=False)
+
+            record_dataset(self)
+            return self.data
+
+    def load_version(self, columns):
+        """Loads the requested columns, along with the data version they belong to
+
+        A refresh swaps the loaded columns and the version at once, so outputs cached or rolled up under a version are built
+        from the columns returned with it rather than from columns read apart.
+
+        Args:
+            columns (list): columns that should be available in the dataset
+
+        Returns:
+            tuple: loaded columns (see load_columns) and their data version
+        """
+        with self.lock:
+            return self.load_columns(columns), self.version
+
+    def unload(self):
+        """Releases the loaded columns, they are loaded again (from the snapshot when available) the next time they are requested
+
+        Args:
+            None
+
+        Returns:
+            None -> data attribute is reset
+        """
+        with self.lock:
+            self.data = None
+            self.nbytes = 0
+            record_dataset(self)
+
+    def __getitem__(self, columns):
+        """Selects columns from the dataset, loading them first if needed
+
+        Args:
+            columns (list or str): columns to select, or a single column name
+
+        Returns:
+            pandas.DataFrame or pandas.Series: selected columns, or the selected column for a single column name
+        """
+        return self.load_columns([columns] if isinstance(columns, str) else columns)[columns]
+
+
+class DatasetManager:
+    """Process-wide registry of the datasets of every data index, loaded lazily and kept under a memory budget
+
+    A dataset is created and loaded the first time its index is requested. When the loaded datasets exceed the memory budget, the least
+    recently used ones are released: datasets backed by a snapshot store are downgraded to their snapshot on disk (and memory-mapped
+    again when requested), the others are dropped and fetched from Elasticsearch again when requested.
+
+    Columns loaded lazily by a Visualizer are accounted for the next time a dataset is requested.
+
+    When a version getter is given, the data version of a requested index is checked at most once every refresh_seconds. A changed index is
+    refreshed with its appended documents when its dataset supports it, and every listener is called with them (so cached aggregations
+    and rollups are updated with the new documents only), otherwise its dataset is replaced by a new one, loaded from scratch.
+    Refreshes run in a background thread, one at a time for each index: requests are served by the loaded version meanwhile.
+
+    Args:
+        create_dataset (callable): creates the (unloaded) dataset of an index, called as create_dataset(index_reference)
+        get_columns (callable): columns loaded up front for an index, called as get_columns(index_reference)
+        max_bytes (int): memory budget for the loaded datasets, in bytes
+        get_version (callable): current data version of an index, called as get_version(index_reference). Defaults to None, never refreshing the datasets.
+        refresh_seconds (float): minimum time between two version checks of the same index, in seconds. Defaults to 10.
+        listeners (list): callables notified of appended documents, called as listener(dataset, appended, previous_version). Defaults to None.
+
+    Attributes:
+        create_dataset (callable): creates the (unloaded) dataset of an index
+        get_columns (callable): columns loaded up front for an index
+        max_bytes (int): memory budget for the loaded datasets, in bytes
+        get_version (callable): current data version of an index
+        refresh_seconds (float): minimum time between two version checks of the same index, in seconds
+        listeners (list): callables notified of appended documents
+        datasets (collections.OrderedDict): datasets by index, ordered from least to most recently used
+        checked (dict): time of the last version check of each index
+        refreshing (set): indices whose refresh is running
+        evictions (int): number of datasets released to stay under the memory budget
+
+    """
+    def __init__(self, create_dataset, get_columns, max_bytes, get_version=None, refresh_seconds=10, listeners=None):
+        self.create_dataset = create_dataset
+        self.get_columns = get_columns
+        self.max_bytes = max_bytes
+        self.get_version = get_version
+        self.refresh_seconds = refresh_seconds
+        self.listeners = listeners or []
+        self.datasets = OrderedDict()
+        self.checked = {}
+        self.refreshing = set()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the loaded datasets, in bytes"""
+        with self.lock:
+            return sum(dataset.nbytes for dataset in self.datasets.values())
+
+    def get_dataset(self, index_reference):
+        """Retrieves the dataset of an index, loading it if needed, and releases other datasets while the memory budget is exceeded
+
+        Args:
+            index_reference (str): index pattern of the data index
+
+        Returns:
+            ProjectedDataset: loaded dataset of the index
+        """
+        with self.lock:
+            dataset = self.datasets.get(index_reference)
+
+        # creating a dataset resolves the version of its index, which waits for the cluster outside of the registry lock: when
+        # concurrent requests create the same dataset, the first one registered is kept
+        if(dataset is None):
+            created = self.create_dataset(index_reference)
+            with self.lock:
+                dataset = self.datasets.setdefault(index_reference, created)
+                if(dataset is created):
+                    self.checked[index_reference] = time.monotonic()
+
+        with self.lock:
+            if(self.datasets.get(index_reference) is dataset):
+                self.datasets.move_to_end(index_reference)
+
+        # loading happens outside of the registry lock, so other indices can be served meanwhile
+        if(dataset.data is None):
+            dataset.load_columns(self.get_columns(index_reference))
+        elif(self.is_refresh_due(index_reference)):
+            threading.Thread(target=self.refresh_dataset, args=(index_reference, dataset), daemon=True).start()
+
+        self.enforce_budget(index_reference)
+        return dataset
+
+    def is_refresh_due(self, index_reference):
+        """Whether the version of an index should be checked, claiming the check so concurrent requests do not repeat it
+
+        Args:
+            index_reference (str): index pattern of the data index
+
+        Returns:
+            bool: True if the caller should check the version now, the caller then runs refresh_dataset
+        """
+        if(self.get_version is None):
+            return False
+
+        with self.lock:
+            now = time.monotonic()
+            if(index_reference in self.refreshing or now - self.checked.get(index_reference, 0) < self.refresh_seconds):
+                return False
+            self.checked[index_reference] = now
+            self.refreshing.add(index_reference)
+            return True
+
+    def refresh_dataset(self, index_reference, dataset):
+        """Brings the dataset of an index up to date with its data version, appending the new documents when possible
+
+        When the index changed in other ways than appends, a new dataset is loaded with the same columns and replaces the stale one once
+        loaded. Releases the refresh claimed by is_refresh_due.
+
+        Args:
+            index_reference (str): index pattern of the data index
+            dataset (ProjectedDataset): loaded dataset of the index
+
+        Returns:
+            None -> the dataset is refreshed in place, or replaced in the registry
+        """
+        try:
+            version = self.get_version(index_reference)
+            if(version == dataset.version):
+                return
+
+            previous_version = dataset.version
+            appended = dataset.append_documents(version)
+            if(appended is not None):
+                # a deferred refresh keeps the previous version, the appends are pulled at the next version check
+                if(dataset.version != previous_version):
+                    for listener in self.listeners:
+                        listener(dataset, appended, previous_version)
+                return
+
+            # the index was rewritten, updated or deleted from: the stale dataset serves requests until the new one is loaded
+            replacement = self.create_dataset(index_reference)
+            replacement.load_columns(dataset.columns or self.get_columns(index_reference))
+            with self.lock:
+                if(self.datasets.get(index_reference) is dataset):
+                    self.datasets[index_reference] = replacement
+            dataset.unload()
+            self.enforce_budget(index_reference)
+        finally:
+            with self.lock:
+                self.refreshing.discard(index_reference)
+
+    def enforce_budget(self, keep=None):
+        """Releases the least recently used datasets while the memory budget is exceeded
+
+        Args:
+            keep (str): index whose dataset is never released, usually the one just requested. Defaults to None.
+
+        Returns:
+            None -> released datasets are unloaded, and removed from the registry when they have no snapshot
+        """
+        with self.lock:
+            candidates = [name for name in self.datasets if name != keep]
+            total = sum(dataset.nbytes for dataset in self.datasets.values())
+
+            for name in candidates:
+                if(total <= self.max_bytes):
+                    break
+                dataset = self.datasets[name]
+                if(dataset.data is None):
+                    continue
+
+                total -= dataset.nbytes
+                dataset.unload()
+                self.evictions += 1
+                DATASET_EVICTIONS.labels(name).inc()
+
+                # datasets without a snapshot are dropped, a new version is resolved when the index is requested again
+                if(dataset.store is None):
+                    del self.datasets[name]
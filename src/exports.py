@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming data exports served on demand by a process-wide HTTP server, instead of inlining the data in the page
+"""
+
+import io
+import zlib
+import uuid
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from metrics import track
+
+# content type and file extension of each export format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'parquet': ('application/octet-stream', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', 'arrow')
+}
+
+class ChunkedWriter(io.RawIOBase):
+    """Write-only file object sending everything written to it as HTTP/1.1 chunks
+
+    Args:
+        stream (io.BufferedIOBase): response stream of the HTTP request handler
+
+    Attributes:
+        stream (io.BufferedIOBase): response stream of the HTTP request handler
+        position (int): number of bytes written so far, required by the Parquet and Arrow writers
+
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = memoryview(data).nbytes
+        if(size > 0):
+            self.stream.write(b'%x\r\n' % size)
+            self.stream.write(data)
+            self.stream.write(b'\r\n')
+            self.position += size
+        return size
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        # the empty chunk marks the end of the response
+        if(not self.closed):
+            self.stream.write(b'0\r\n\r\n')
+            self.stream.flush()
+        io.RawIOBase.close(self)
+
+
+class ExportSource:
+    """Data registered for export, read in chunks of rows when the export is requested
+
+    Args:
+        get_frame (callable): returns the dataframe to export, only called when the export is requested
+        columns (list): subset of columns to export. Defaults to None, exporting every column.
+        name (str): file name of the export, without extension. Defaults to "analysis".
+
+    Attributes:
+        get_frame (callable): returns the dataframe to export
+        columns (list): subset of columns to export
+        name (str): file name of the export, without extension
+
+    """
+    def __init__(self, get_frame, columns=None, name='analysis'):
+        self.get_frame = get_frame
+        self.columns = columns
+        self.name = name
+
+    def iterate_chunks(self, chunk_rows):
+        """Iterates over the exported data, one chunk of rows at a time
+
+        Args:
+            chunk_rows (int): number of rows in each chunk
+
+        Returns:
+            generator: dataframes of at most chunk_rows rows, at least one (possibly empty) chunk
+        """
+        frame = self.get_frame()
+        for start in range(0, max(len(frame), 1), chunk_rows):
+            chunk = frame.iloc[start:start + chunk_rows]
+            yield chunk if self.columns is None else chunk[self.columns]
+
+    def write(self, sink, export_format, chunk_rows):
+        """Writes the exported data to a file object in the requested format, chunk by chunk
+
+        Args:
+            sink (io.RawIOBase): file object receiving the export
+            export_format (str): one of "csv", "csv.gz", "parquet" or "arrow"
+            chunk_rows (int): number of rows converted at a time
+
+        Returns:
+            None -> export is written to the sink
+        """
+        if(export_format in ('csv', 'csv.gz')):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if export_format == 'csv.gz' else None
+            for index, chunk in enumerate(self.iterate_chunks(chunk_rows)):
+                data = chunk.to_csv(index=False, header=(index == 0)).encode()
+                sink.write(compressor.compress(data) if compressor else data)
+            if(compressor):
+                sink.write(compressor.flush())
+
+        elif(export_format in ('parquet', 'arrow')):
+            writer = None
+            for chunk in self.iterate_chunks(chunk_rows):
+                if(writer is None):
+                    # the schema of the first chunk is kept so that chunks with only missing values still match
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    schema = table.schema
+                    if(export_format == 'parquet'):
+                        writer = pq.ParquetWriter(sink, schema)
+                    else:
+                        writer = pa.ipc.new_file(sink, schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+
+                writer.write_table(table)
+            writer.close()
+        else:
+            raise NotImplementedError(f'{export_format} export format is not supported')
+
+
+class ExportServer:
+    """Process-wide HTTP server streaming registered exports on demand
+
+    Exports are registered under random tokens and kept in a bounded registry, evicting the oldest registrations.
+    Only the token is sent to the page, the data is converted and streamed in chunks when the link is clicked.
+
+    Args:
+        port (int): port the server listens on
+        public_url (str): base url of the server as reached by the browser. Ex: http://localhost:8502
+        host (str): interface the server binds to. Defaults to "127.0.0.1", only reachable through a reverse proxy on the same host.
+        max_exports (int): number of registrations kept. Defaults to 1024.
+        chunk_rows (int): number of rows converted at a time. Defaults to 50000.
+
+    Attributes:
+        public_url (str): base url of the server as reached by the browser
+        max_exports (int): number of registrations kept
+        chunk_rows (int): number of rows converted at a time
+        exports (collections.OrderedDict): registered exports by token, from oldest to newest
+
+    """
+    def __init__(self, port, public_url, host='127.0.0.1', max_exports=1024, chunk_rows=50000):
+        self.public_url = public_url.rstrip('/')
+        self.max_exports = max_exports
+        self.chunk_rows = chunk_rows
+        self.exports = OrderedDict()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.build_handler())
+        self.server.daemon_threads = True
+
+    def build_handler(self):
+        """Builds the request handler class bound to this server
+
+        Args:
+            None
+
+        Returns:
+            class: http.server request handler streaming the registered exports
+        """
+        export_server = self
+
+        class ExportHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                # expected path: /export/<token>.<format>
+                token, _, export_format = self.path.rpartition('/')[2].partition('.')
+                source = export_server.get_export(token)
+                if(source is None or export_format not in EXPORT_FORMATS):
+                    self.send_error(404, 'Export not found or expired')
+                    return
+
+                content_type, extension = EXPORT_FORMATS[export_format]
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Disposition', f'attachment; filename="{source.name}.{extension}"')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                sink = ChunkedWriter(self.wfile)
+                completed = False
+                try:
+                    with track(f'export[{export_format}]'):
+                        source.write(sink, export_format, export_server.chunk_rows)
+                    completed = True
+                finally:
+                    # a failed export drops the connection without the last chunk, so the client sees a failed download instead of
+                    # waiting for the rest of the response
+                    if(completed):
+                        sink.close()
+                    else:
+                        self.close_connection = True
+
+            def log_message(self, format, *args):
+                # keeps the app logs clean
+                pass
+
+        return ExportHandler
+
+    def start(self):
+        """Starts serving exports on a background thread
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def register(self, source):
+        """Registers data for export
+
+        Args:
+            source (ExportSource): data to export
+
+        Returns:
+            token (str): token identifying the export
+        """
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.exports[token] = source
+            while(len(self.exports) > self.max_exports):
+                self.exports.popitem(last=False)
+        return token
+
+    def get_export(self, token):
+        """Retrieves a registered export
+
+        Args:
+            token (str): token identifying the export
+
+        Returns:
+            ExportSource: registered export, or None if the token is unknown or expired
+        """
+        with self.lock:
+            return self.exports.get(token)
+
+    def get_url(self, token, export_format):
+        """Builds the url of an export in the given format
+
+        Args:
+            token (str): token identifying the export
+            export_format (str): one of "csv", "csv.gz", "parquet" or "arrow"
+
+        Returns:
+            url (str): download url of the export
+        """
+        return f'{self.public_url}/export/{token}.{export_format}'
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+In-process search backend for the directory index, used for search-as-you-type without Elasticsearch round-trips
+"""
+
+import re
+import math
+import time
+import bisect
+import threading
+from collections import Counter
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl import Search
+
+from searchutils import Searcher
+
+class DirectoryIndex(Searcher):
+    """In-memory inverted index over the text fields of the directory index, ranked with BM25
+
+    The index is shared by every session of the process. It is refreshed incrementally from Elasticsearch: when the directory version changes,
+    only documents with a new sequence number are fetched again and deleted documents are dropped. If Elasticsearch is unavailable, the last
+    refreshed state keeps being served.
+
+    Args:
+        es_client (elasticsearch.client.Elasticsearch): client handler for Elasticsearch from low-level client
+        cluster_location (str): string reference to cluster connection. Ex: http://somecluster@password:9200/
+        index_reference (str): index pattern reference for the directory, defaulting to "directory"
+        fields (tuple): text fields of the specs that are indexed. Defaults to ('description', 'title').
+        refresh_interval (float): minimum number of seconds between two version checks. Defaults to 30.
+
+    Attributes:
+        fields (tuple): text fields of the specs that are indexed
+        refresh_interval (float): minimum number of seconds between two version checks
+        version (str): version of the directory index at the last refresh
+        documents (dict): specs indexed by document id
+        sequence_numbers (dict): sequence number of each indexed document, used for incremental refreshes
+        postings (dict): term frequencies of each term for each field, as {field: {term: {doc_id: frequency}}}
+        lengths (dict): number of terms of each document for each field, as {field: {doc_id: length}}
+        vocabulary (list): sorted list of every indexed term, used for prefix matching
+
+    """
+    # BM25 parameters, the same defaults used by Elasticsearch
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, es_client, cluster_location, index_reference="directory", fields=('description', 'title'), refresh_interval=30):
+        Searcher.__init__(self, es_client, cluster_location, index_reference)
+        self.fields = fields
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self.checked_at = None
+        self.documents = {}
+        self.sequence_numbers = {}
+        self.postings = {field: {} for field in fields}
+        self.lengths = {field: {} for field in fields}
+        self.vocabulary = []
+        self.lock = threading.RLock()
+
+    def tokenize(self, text):
+        """Splits a text into lowercase terms, using the same ASCII folding applied to search inputs
+
+        Args:
+            text (str): text to tokenize
+
+        Returns:
+            terms (list): list of terms in the text
+        """
+        return re.findall(r'[a-z0-9]+', self.fold_text(text).lower())
+
+    def add_document(self, doc_id, document):
+        """Adds a document to the inverted index
+
+        Args:
+            doc_id (str): id of the document in the directory index
+            document (dict): spec stored in the directory
+
+        Returns:
+            None -> document terms are added to the postings attribute
+        """
+        self.documents[doc_id] = document
+        for field in self.fields:
+            terms = self.tokenize(str(document.get(field, '')))
+            self.lengths[field][doc_id] = len(terms)
+            for term, frequency in Counter(terms).items():
+                self.postings[field].setdefault(term, {})[doc_id] = frequency
+
+    def remove_document(self, doc_id):
+        """Removes a document from the inverted index
+
+        Args:
+            doc_id (str): id of the document in the directory index
+
+        Returns:
+            None -> document terms are removed from the postings attribute
+        """
+        document = self.documents.pop(doc_id)
+        self.sequence_numbers.pop(doc_id, None)
+        for field in self.fields:
+            self.lengths[field].pop(doc_id, None)
+            for term in set(self.tokenize(str(document.get(field, '')))):
+                postings = self.postings[field][term]
+                postings.pop(doc_id, None)
+                if(not postings):
+                    del self.postings[field][term]
+
+    def refresh_index(self, force=False):
+        """Refreshes the inverted index from Elasticsearch when the directory version changed
+
+        Args:
+            force (bool): checks the version even if the refresh interval has not elapsed yet. Defaults to False.
+
+        Returns:
+            None -> changed documents are updated in the inverted index
+        """
+        with self.lock:
+            now = time.monotonic()
+            if(not force and self.checked_at is not None and now - self.checked_at < self.refresh_interval):
+                return
+            self.checked_at = now
+
+            try:
+                version = self.get_index_version()
+                if(version == self.version):
+                    return
+
+                # only ids and sequence numbers are scanned, documents are fetched when new or changed
+                search_statement = Search(using=self.es_client, index=self.index_reference).source(False).extra(seq_no_primary_term=True)
+                current = {hit.meta.id: hit.meta.seq_no for hit in search_statement.scan()}
+
+                changed = set(doc_id for doc_id, seq_no in current.items() if self.sequence_numbers.get(doc_id) != seq_no)
+                fetched = []
+                if(changed):
+                    fetched = self.es_client.mget(index=self.index_reference, body={'ids': list(changed)})['docs']
+            except TransportError:
+                # keeps serving the last refreshed state
+                return
+
+            for doc_id in [doc_id for doc_id in self.documents if doc_id not in current or doc_id in changed]:
+                self.remove_document(doc_id)
+
+            for doc in fetched:
+                if(doc.get('found')):
+                    self.add_document(doc['_id'], doc['_source'])
+                    self.sequence_numbers[doc['_id']] = current[doc['_id']]
+
+            self.vocabulary = sorted(set(term for field in self.fields for term in self.postings[field]))
+            self.version = version
+
+    def expand_prefix(self, prefix):
+        """Finds every indexed term starting with the given prefix
+
+        Args:
+            prefix (str): beginning of a term
+
+        Returns:
+            terms (list): indexed terms starting with the prefix
+        """
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\uffff')
+        return self.vocabulary[start:end]
+
+    def score_field(self, field, terms):
+        """Scores documents against a list of terms in a single field with BM25
+
+        Args:
+            field (str): indexed field
+            terms (list): list of terms, where each element is a list of alternative terms (prefix expansions) of which the best one is kept
+
+        Returns:
+            scores (collections.Counter): BM25 score of each matching document
+        """
+        lengths = self.lengths[field]
+        if(not lengths):
+            return Counter()
+
+        document_count = len(lengths)
+        average_length = sum(lengths.values()) / document_count
+
+        scores = Counter()
+        for alternatives in terms:
+            best = Counter()
+            for term in alternatives:
+                postings = self.postings[field].get(term, {})
+                idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * lengths[doc_id] / average_length)
+                    score = idf * frequency * (self.k1 + 1) / (frequency + norm)
+                    best[doc_id] = max(best[doc_id], score)
+            scores.update(best)
+        return scores
+
+    def score(self, text, boosts, prefix=True):
+        """Scores every document against a search input, the same way a best_fields multi_match query does
+
+        Args:
+            text (str): search input, already normalized
+            boosts (dict): boost applied to the score of each field
+            prefix (bool): matches the last term of the input as a prefix, for autocomplete. Defaults to True.
+
+        Returns:
+            scores (dict): score of each matching document, the best boosted field score for each document
+        """
+        with self.lock:
+            tokens = self.tokenize(text)
+            terms = [[token] for token in tokens]
+            if(prefix and tokens):
+                terms[-1] = self.expand_prefix(tokens[-1]) or [tokens[-1]]
+
+            scores = {}
+            for field, boost in boosts.items():
+                for doc_id, score in self.score_field(field, terms).items():
+                    scores[doc_id] = max(scores.get(doc_id, 0), boost * score)
+            return scores
+
+
+class LocalMultiMatchSearcher(Searcher):
+    """Extends Searcher object with Multi Match search over the in-process directory index instead of Elasticsearch
+
+    Args:
+        es_client (elasticsearch.client.Elasticsearch): client handler for Elasticsearch from low-level client
+        cluster_location (str): string reference to cluster connection. Ex: http://somecluster@password:9200/
+        index_reference (str): index pattern reference for the search, defaulting to "directory"
+        directory_index (localsearch.DirectoryIndex): in-process index shared across sessions
+
+    Attributes:
+        es_client (elasticsearch.client.Elasticsearch): active client connection for interfacing queries
+        cluster_location (str): used in Eland-based queries
+        index_reference (str): index in which searches will be performed
+        directory_index (localsearch.DirectoryIndex): in-process index used for the searches
+
+    """
+    def __init__(self, es_client, cluster_location, index_reference, directory_index):
+        Searcher.__init__(self, es_client, cluster_location, index_reference)
+        self.directory_index = directory_index
+
+    def build_query_object(self, search_input, target_field=('description', 'title'), boosting_param=2, prefix=True):
+        """Builds the local equivalent of the Multi Match query built by MultiMatchSearcher
+
+        Args:
+            search_input (str): input text from search bar or widget
+            target_field (tuple): fields that will be used for search, only supporting two distinct fields. Boosting is by default applied to the first element of the tuple input.
+            boosting_param (int): how many times the first field is more relevant to the search than the second field
+            prefix (bool): matches the last term of the input as a prefix, for autocomplete. Defaults to True.
+
+        Returns:
+            None -> query structure is stored within Searcher object
+        """
+        self.process_input_text(search_input)
+        self.query_structure = {
+            'text': self.processed_text,
+            'boosts': {target_field[0]: boosting_param, target_field[1]: 1}, # by default the first field is boosted
+            'prefix': prefix
+        }
+
+    def search_data_directory(self, size=None, search_after=None):
+        """Performs configured search in the in-process directory index, ranked by score
+        Args:
+            size (int): number of top hits by relevance to retrieve. Defaults to None, retrieving every matching document.
+            search_after (list): sort values of the last hit of the previous page (see last_sort attribute), used for paging. Defaults to None.
+
+        Returns:
+            search_results (list): list of specs (dictionaries) containing the search results
+
+        Note:
+            The total number of matching documents is stored in the total_hits attribute.
+
+        """
+        self.directory_index.refresh_index()
+
+        # the documents are read under the same lock as their scores, so a concurrent refresh can not replace or remove them in between
+        with self.directory_index.lock:
+            scores = self.directory_index.score(**self.query_structure)
+
+            # same order as the ranked Elasticsearch search: score first, document id as tiebreaker
+            ranking = sorted(((-score, doc_id) for doc_id, score in scores.items()))
+            self.total_hits = len(ranking)
+
+            if(search_after is not None):
+                ranking = [entry for entry in ranking if entry > (-search_after[0], search_after[1])]
+            if(size is not None):
+                ranking = ranking[:size]
+
+            self.last_sort = [-ranking[-1][0], ranking[-1][1]] if ranking else None
+            return [self.directory_index.documents[doc_id] for _, doc_id in ranking]
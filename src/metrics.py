@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus instrumentation of the app: stage latencies, Elasticsearch traffic, cache usage and dataset footprint
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from elasticsearch import Urllib3HttpConnection
+
+logger = logging.getLogger(__name__)
+
+# latency buckets from a cached lookup (milliseconds) to a full dataset load (minutes)
+LATENCY_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram('datapages_stage_seconds', 'Latency of each stage of the app', ['stage'], buckets=LATENCY_BUCKETS)
+SPEC_SECONDS = Histogram('datapages_spec_stage_seconds', 'Latency of each stage of the app, by spec', ['stage', 'spec_id'], buckets=LATENCY_BUCKETS)
+REQUEST_SECONDS = Histogram('datapages_request_seconds', 'Latency of a whole page run', buckets=LATENCY_BUCKETS)
+
+ES_REQUESTS = Counter('datapages_elasticsearch_requests', 'Requests sent to Elasticsearch', ['endpoint', 'status'])
+ES_BYTES = Counter('datapages_elasticsearch_bytes', 'Bytes transferred with Elasticsearch', ['endpoint', 'direction'])
+ES_SECONDS = Histogram('datapages_elasticsearch_request_seconds', 'Latency of the requests sent to Elasticsearch', ['endpoint'], buckets=LATENCY_BUCKETS)
+
+CACHE_LOOKUPS = Counter('datapages_cache_lookups', 'Lookups in the process-wide caches', ['cache', 'result'])
+
+DATASET_BYTES = Gauge('datapages_dataset_bytes', 'Memory footprint of the loaded dataset columns', ['index'])
+DATASET_ROWS = Gauge('datapages_dataset_rows', 'Number of rows of the loaded dataset', ['index'])
+DATASET_COLUMNS = Gauge('datapages_dataset_columns', 'Number of loaded dataset columns', ['index'])
+DATASET_EVICTIONS = Counter('datapages_dataset_evictions', 'Datasets released to stay under the memory budget', ['index'])
+
+def get_endpoint(path):
+    """Names the Elasticsearch endpoint of a request path, by its last underscore-prefixed segment. Ex: /directory/_search -> _search"""
+    for part in reversed(path.split('?')[0].split('/')):
+        if(part.startswith('_')):
+            return part
+    return 'document'
+
+def get_size(payload):
+    """Number of bytes of a request or response body"""
+    if(payload is None):
+        return 0
+    if(isinstance(payload, str)):
+        return len(payload.encode('utf-8'))
+    return len(payload)
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    """Elasticsearch connection counting the requests and bytes exchanged with the cluster
+
+    Used as the connection_class of the Elasticsearch client. Ex: Elasticsearch(cluster_location, connection_class=InstrumentedConnection)
+
+    """
+    def log_request_success(self, method, full_url, path, body, status_code, response, duration):
+        endpoint = get_endpoint(path)
+        ES_REQUESTS.labels(endpoint, str(status_code)).inc()
+        ES_BYTES.labels(endpoint, 'sent').inc(get_size(body))
+        ES_BYTES.labels(endpoint, 'received').inc(get_size(response))
+        ES_SECONDS.labels(endpoint).observe(duration)
+        Urllib3HttpConnection.log_request_success(self, method, full_url, path, body, status_code, response, duration)
+
+    def log_request_fail(self, method, full_url, path, body, duration, status_code=None, response=None, exception=None):
+        endpoint = get_endpoint(path)
+        ES_REQUESTS.labels(endpoint, str(status_code or 'error')).inc()
+        ES_BYTES.labels(endpoint, 'sent').inc(get_size(body))
+        ES_BYTES.labels(endpoint, 'received').inc(get_size(response))
+        ES_SECONDS.labels(endpoint).observe(duration)
+        Urllib3HttpConnection.log_request_fail(self, method, full_url, path, body, duration, status_code, response, exception)
+
+
+class RequestTrace:
+    """Timings of the stages of one page run, logged with the query text when the run is slow
+
+    Args:
+        slow_seconds (float): page runs slower than this are logged. Defaults to None, disabling the slow-request log.
+
+    Attributes:
+        slow_seconds (float): page runs slower than this are logged
+        stages (list): (stage, spec_id, seconds) of each tracked stage, in order
+        query (str): search input of the page run
+
+    """
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = slow_seconds
+        self.stages = []
+        self.query = None
+        self.start = time.perf_counter()
+
+    def finish(self):
+        """Records the latency of the whole page run, logging its stages when it is slower than slow_seconds
+
+        Args:
+            None
+
+        Returns:
+            elapsed (float): latency of the page run, in seconds
+        """
+        elapsed = time.perf_counter() - self.start
+        REQUEST_SECONDS.observe(elapsed)
+
+        if(self.slow_seconds is not None and elapsed > self.slow_seconds):
+            breakdown = ', '.join(
+                f'{stage}{f"[{spec_id}]" if spec_id else ""}={seconds * 1000:.0f}ms' for stage, spec_id, seconds in self.stages
+            )
+            logger.warning('Slow request (%.0fms) for query %r: %s', elapsed * 1000, self.query, breakdown)
+        return elapsed
+
+
+@contextmanager
+def track(stage, spec_id=None, trace=None):
+    """Times a stage of the app, recording it in the stage histograms (and in the trace of the page run, when given)
+
+    Args:
+        stage (str): name of the stage. Ex: "search_data_directory"
+        spec_id (str): spec the stage is working on, recorded in the per-spec histogram. Defaults to None.
+        trace (RequestTrace): trace of the current page run. Defaults to None.
+
+    Returns:
+        context manager timing the enclosed block
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        if(spec_id is not None):
+            SPEC_SECONDS.labels(stage, spec_id).observe(elapsed)
+        if(trace is not None):
+            trace.stages.append((stage, spec_id, elapsed))
+
+def record_dataset(dataset):
+    """Records the memory footprint, rows and columns of a dataset
+
+    Args:
+        dataset (datasets.ProjectedDataset): dataset whose loaded columns are recorded
+
+    Returns:
+        None
+    """
+    DATASET_BYTES.labels(dataset.index_reference).set(dataset.nbytes)
+    DATASET_ROWS.labels(dataset.index_reference).set(0 if dataset.data is None else len(dataset.data))
+    DATASET_COLUMNS.labels(dataset.index_reference).set(len(dataset.columns))
+
+def start_metrics_server(port):
+    """Exposes the metrics of the process on http://<host>:<port>/metrics
+
+    Args:
+        port (int): port the metrics endpoint listens on
+
+    Returns:
+        None
+    """
+    start_http_server(port)
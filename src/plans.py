@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Compilation of directory specs into validated, immutable aggregation plans
+"""
+
+import json
+import hashlib
+import threading
+import functools
+from collections import namedtuple
+
+from aggregations import GroupKeys, TIME_UNITS
+from sketches import DEFAULT_PRECISION, DEFAULT_RELATIVE_ERROR
+
+# reducer of GroupKeys used by each agg_operation in the instruction set
+REDUCERS = {
+    'count': GroupKeys.count,
+    'sum': GroupKeys.sum,
+    'mean': GroupKeys.mean,
+    'median': GroupKeys.median,
+    'count_distinct': GroupKeys.count_distinct,
+    'percentile': GroupKeys.percentile
+}
+
+# optional parameters of each agg_operation in the instruction set, with their defaults
+# "percentile" is the percentile reported, "precision" and "relative_error" bound the error of the sketches
+AGG_PARAMETERS = {
+    'count_distinct': {'precision': DEFAULT_PRECISION},
+    'percentile': {'percentile': None, 'relative_error': DEFAULT_RELATIVE_ERROR}
+}
+
+# Elasticsearch field types accepted for aggregated values and time fields
+NUMERIC_TYPES = {'long', 'integer', 'short', 'byte', 'double', 'float', 'half_float', 'scaled_float', 'unsigned_long'}
+TIME_TYPES = {'date', 'date_nanos', 'keyword', 'text'}
+
+class SpecError(ValueError):
+    """Raised when a spec can not be compiled, listing every problem found
+
+    Args:
+        spec_id (str): id of the spec in the directory
+        problems (list): descriptions of the problems found in the spec
+
+    Attributes:
+        spec_id (str): id of the spec in the directory
+        problems (list): descriptions of the problems found in the spec
+
+    """
+    def __init__(self, spec_id, problems):
+        self.spec_id = spec_id
+        self.problems = problems
+        ValueError.__init__(self, f"Spec {spec_id} is not valid: {'; '.join(problems)}")
+
+
+class SpecPlan(namedtuple('SpecPlan', [
+        'spec_id', 'version', 'source_index', 'report_type', 'group_field', 'group_fields', 'time_field', 'time_unit', 'period',
+        'agg_field', 'agg_operation', 'agg_params', 'reducer', 'dimensions', 'dtypes'])):
+    """Immutable aggregation plan compiled from a directory spec
+
+    Attributes:
+        spec_id (str): id of the spec in the directory
+        version (str): hash of the spec contents the plan was compiled from
+        source_index (str): data index the spec reads from, None when neither the spec nor the compiler name one
+        report_type (str): "category", "timeseries" or "crosstab"
+        group_field (str): category field or time field the data is grouped by, None for crosstab specs
+        group_fields (tuple): fields the data is grouped by, in order (only group_field for category and timeseries specs)
+        time_field (str): group field binned into periods, None for category specs and crosstab specs without one
+        time_unit (str): time unit of the time field, None without a time field
+        period (str): resolved period of the time bins (see aggregations.TIME_UNITS), None without a time field
+        agg_field (str): field being aggregated
+        agg_operation (str): name of the aggregation operation
+        agg_params (tuple): (name, value) pairs of the parameters of the aggregation operation, passed to the reducer. Ex: (('q', 95.0), ('relative_error', 0.01))
+        reducer (callable): resolved GroupKeys reducer, bound to the parameters and called as reducer(keys, values)
+        dimensions (tuple): columns of the dataset used by the spec
+        dtypes (tuple): (column, Elasticsearch field type) pairs of the dimensions, empty when compiled without a schema
+
+    """
+    __slots__ = ()
+
+    @property
+    def grouping_key(self):
+        """(type, fields, time field, time_unit) identifying the grouping, plans with the same grouping key can share their group keys"""
+        return (self.report_type, self.group_fields, self.time_field, self.time_unit)
+
+
+class SpecCompiler:
+    """Compiles directory specs into validated aggregation plans, cached by spec_id and version
+
+    Specs read from the data index named in "instructions.source_index", or from the default index when they do not name one.
+
+    Args:
+        schema (dict): Elasticsearch field type of each field of the data index (see Searcher.get_index_schema). Defaults to None, skipping schema checks.
+        default_index (str): data index of the specs that do not name a source index. Defaults to None.
+        schema_loader (callable): returns the schema of a data index, or None if the index does not exist, called as schema_loader(index).
+            Used instead of schema to check each spec against its own source index. Defaults to None.
+
+    Attributes:
+        schema (dict): Elasticsearch field type of each field of the data index
+        default_index (str): data index of the specs that do not name a source index
+        schema_loader (callable): returns the schema of a data index
+        schemas (dict): schemas returned by the schema loader, by index
+        plans (dict): compiled plans by (spec_id, version)
+
+    """
+    def __init__(self, schema=None, default_index=None, schema_loader=None):
+        self.schema = schema
+        self.default_index = default_index
+        self.schema_loader = schema_loader
+        self.schemas = {}
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    def get_source_index(self, definition):
+        """Identifies the data index a spec reads from, without compiling it
+
+        Args:
+            definition (dict): json-like object from the directory
+
+        Returns:
+            index (str): source index named by the spec, or the default index
+        """
+        instructions = definition.get('instructions')
+        if(isinstance(instructions, dict) and instructions.get('source_index')):
+            return instructions['source_index']
+        return self.default_index
+
+    def get_schema(self, index):
+        """Retrieves the schema used to check the specs reading from an index
+
+        Args:
+            index (str): data index
+
+        Returns:
+            schema (dict): Elasticsearch field type of each field, or None if the index is unknown or does not exist, or schema checks are disabled
+        """
+        if(self.schema_loader is None):
+            return self.schema
+        if(index is None):
+            return None
+
+        with self.lock:
+            if(index in self.schemas):
+                return self.schemas[index]
+        schema = self.schema_loader(index)
+        with self.lock:
+            self.schemas[index] = schema
+        return schema
+
+    @staticmethod
+    def get_spec_version(definition):
+        """Identifies the version of a spec, using the hash stamped by submit_spec.py when available
+
+        Args:
+            definition (dict): json-like object from the directory
+
+        Returns:
+            version (str): hash of the spec contents
+        """
+        if('spec_hash' in definition):
+            return definition['spec_hash']
+        return hashlib.sha256(json.dumps(definition.get('instructions'), sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_agg_params(instructions, problems):
+        """Validates the parameters of the aggregation operation of an instruction set, filling in their defaults
+
+        Args:
+            instructions (dict): instruction set of the spec
+            problems (list): problems found in the spec, the invalid parameters are added to it
+
+        Returns:
+            params (tuple): (name, value) pairs of the parameters, as passed to the reducer
+        """
+        op = instructions['agg_operation']
+        params = {name: instructions.get(name, default) for name, default in AGG_PARAMETERS.get(op, {}).items()}
+
+        if(op == 'percentile'):
+            q = params.pop('percentile')
+            if(isinstance(q, bool) or not isinstance(q, (int, float)) or not 0 <= q <= 100):
+                problems.append(f'"instructions.percentile" must be a number from 0 to 100 for the percentile operation, got {q}')
+            else:
+                params['q'] = float(q)
+        if('relative_error' in params):
+            error = params['relative_error']
+            if(isinstance(error, bool) or not isinstance(error, (int, float)) or not 0 < error < 1):
+                problems.append(f'"instructions.relative_error" must be a number between 0 and 1, got {error}')
+        if('precision' in params):
+            precision = params['precision']
+            if(isinstance(precision, bool) or not isinstance(precision, int) or not 4 <= precision <= 16):
+                problems.append(f'"instructions.precision" must be an integer from 4 to 16, got {precision}')
+        return tuple(sorted(params.items()))
+
+    def compile_spec(self, definition):
+        """Validates a spec and compiles it into a plan
+
+        Args:
+            definition (dict): json-like object from the directory
+
+        Returns:
+            SpecPlan: compiled plan
+        """
+        spec_id = definition.get('spec_id')
+        problems = []
+
+        for key in ('spec_id', 'instructions', 'specs'):
+            if(key not in definition):
+                problems.append(f'missing "{key}"')
+        instructions = definition.get('instructions')
+        if(not isinstance(instructions, dict)):
+            raise SpecError(spec_id, problems or ['"instructions" is not an object'])
+
+        report_type = instructions.get('type')
+        required = ['dimensions', 'agg_field', 'agg_operation']
+        if(report_type == 'category'):
+            required.append('cat_field')
+        elif(report_type == 'timeseries'):
+            required += ['time_field', 'time_unit']
+        elif(report_type == 'crosstab'):
+            required.append('group_fields')
+            if('time_field' in instructions):
+                required.append('time_unit')
+        else:
+            problems.append(f'"{report_type}" is not a valid plot type, expected "category", "timeseries" or "crosstab"')
+
+        for key in required:
+            if(key not in instructions):
+                problems.append(f'missing "instructions.{key}"')
+        if(problems):
+            raise SpecError(spec_id, problems)
+
+        if(report_type == 'crosstab'):
+            group_field = None
+            group_fields = tuple(instructions['group_fields']) if isinstance(instructions['group_fields'], list) else ()
+            time_field = instructions.get('time_field')
+            if(len(group_fields) == 0 or len(set(group_fields)) != len(group_fields)):
+                problems.append('"instructions.group_fields" must list at least one field, without repeating fields')
+            if(time_field is not None and time_field not in group_fields):
+                problems.append(f'"{time_field}" time field is not listed in the group fields')
+        else:
+            group_field = instructions['cat_field'] if report_type == 'category' else instructions['time_field']
+            group_fields = (group_field,)
+            time_field = instructions['time_field'] if report_type == 'timeseries' else None
+        time_unit = instructions.get('time_unit') if time_field is not None else None
+        agg_field = instructions['agg_field']
+        agg_operation = instructions['agg_operation']
+        dimensions = tuple(instructions['dimensions'])
+
+        if(agg_operation not in REDUCERS):
+            problems.append(f'"{agg_operation}" operation is not supported, expected one of {sorted(REDUCERS)}')
+        if(time_unit is not None and time_unit not in TIME_UNITS):
+            problems.append(f'"{time_unit}" is not a valid time unit, expected one of {sorted(TIME_UNITS)}')
+        for field in group_fields + (agg_field,):
+            if(field not in dimensions):
+                problems.append(f'"{field}" is not listed in the dimensions')
+        agg_params = self.get_agg_params(instructions, problems)
+
+        source_index = self.get_source_index(definition)
+        schema = self.get_schema(source_index)
+        if(schema is None and self.schema_loader is not None and source_index is not None):
+            problems.append(f'"{source_index}" data index does not exist')
+
+        dtypes = ()
+        if(schema is not None):
+            for field in dimensions:
+                if(field not in schema):
+                    problems.append(f'"{field}" does not exist in the data index {source_index or ""}'.rstrip())
+            dtypes = tuple((field, schema.get(field)) for field in dimensions)
+
+            if(agg_operation not in ('count', 'count_distinct') and agg_field in schema and schema[agg_field] not in NUMERIC_TYPES):
+                problems.append(f'"{agg_field}" has type {schema[agg_field]} and can not be aggregated with {agg_operation}')
+            if(time_field is not None and time_field in schema and schema[time_field] not in TIME_TYPES):
+                problems.append(f'"{time_field}" has type {schema[time_field]} and is not a time field')
+
+        if(problems):
+            raise SpecError(spec_id, problems)
+
+        return SpecPlan(
+            spec_id=spec_id,
+            version=self.get_spec_version(definition),
+            source_index=source_index,
+            report_type=report_type,
+            group_field=group_field,
+            group_fields=group_fields,
+            time_field=time_field,
+            time_unit=time_unit,
+            period=TIME_UNITS.get(time_unit),
+            agg_field=agg_field,
+            agg_operation=agg_operation,
+            agg_params=agg_params,
+            reducer=functools.partial(REDUCERS[agg_operation], **dict(agg_params)),
+            dimensions=dimensions,
+            dtypes=dtypes
+        )
+
+    def get_plan(self, definition):
+        """Retrieves the compiled plan of a spec, compiling it the first time a version of the spec is seen
+
+        Args:
+            definition (dict): json-like object from the directory
+
+        Returns:
+            SpecPlan: compiled plan
+        """
+        key = (definition.get('spec_id'), self.get_spec_version(definition))
+        with self.lock:
+            plan = self.plans.get(key)
+        if(plan is None):
+            plan = self.compile_spec(definition)
+            with self.lock:
+                self.plans[key] = plan
+        return plan
+
+    def compile_directory(self, definitions):
+        """Compiles a batch of specs, collecting the problems of the broken ones instead of raising
+
+        Args:
+            definitions (list): json-like objects from the directory
+
+        Returns:
+            errors (dict): SpecError of each broken spec, by spec_id
+        """
+        errors = {}
+        for definition in definitions:
+            try:
+                self.get_plan(definition)
+            except SpecError as error:
+                errors[error.spec_id] = error
+        return errors
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Reduction of aggregated outputs to the resolution of their chart, before they are sent to Vega-Lite
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# size of the charts whose spec does not set one, in pixels (as in the spec template)
+DEFAULT_WIDTH = 600
+DEFAULT_HEIGHT = 400
+
+# marks downsampled to one point for each pixel of the chart width, keeping the shape of every line
+LINE_MARKS = {'line', 'area', 'trail'}
+
+# marks binned into square cells of POINT_CELL_SIZE pixels, keeping one point (the centroid) for each cell
+POINT_MARKS = {'point', 'circle', 'square'}
+POINT_CELL_SIZE = 4
+
+# marks over a categorical axis, where categories beyond one for every MIN_BAND_SIZE pixels are gathered in an "other" bucket
+BAND_MARKS = {'bar', 'tick', 'rect'}
+MIN_BAND_SIZE = 8
+
+# label of the bucket gathering the tail categories, and field holding the number of points of each cell of binned point clouds
+OTHER_LABEL = 'other'
+POINT_COUNT_FIELD = 'point_count'
+
+# agg_operations whose values for several categories add up to the value of their union
+ADDITIVE_OPERATIONS = {'count', 'sum'}
+
+# spec properties making Vega-Lite compute over the data (a rule at the mean, a histogram...), whose results would change with the data
+COMPUTED_PROPERTIES = {'transform', 'aggregate', 'bin'}
+
+# Vega-Lite field types placed on a continuous scale
+CONTINUOUS_TYPES = {'quantitative', 'temporal'}
+
+class Reduction(namedtuple('Reduction', ['method', 'rows', 'reduced_rows'])):
+    """Record of the reduction applied to an output before it was charted, the output itself is kept whole for downloads
+
+    Attributes:
+        method (str): "lttb" for downsampled lines, "binning" for binned point clouds, "other" for tail categories gathered in a bucket
+            and "top" for tail categories left out (when their values can not be added up)
+        rows (int): number of rows of the output
+        reduced_rows (int): number of rows sent to the chart
+
+    """
+    __slots__ = ()
+
+    # description of each method, as shown next to the chart
+    DESCRIPTIONS = {
+        'lttb': 'lines downsampled to the chart width',
+        'binning': 'points binned to the chart resolution',
+        'other': 'smallest categories gathered in an "other" bucket',
+        'top': 'smallest categories left out'
+    }
+
+    def describe(self):
+        """Describes the reduction for the page
+
+        Args:
+            None
+
+        Returns:
+            description (str): rows charted out of the rows of the output, and the method used
+        """
+        return f'The chart shows {self.reduced_rows:,} of {self.rows:,} data points ({self.DESCRIPTIONS[self.method]})'
+
+
+def get_layers(specs, width=None, height=None):
+    """Flattens the views of a Vega-Lite spec (layered, faceted or concatenated) into its layers
+
+    Args:
+        specs (dict): Vega-Lite spec, or one of its views
+        width (int): width of the enclosing view, in pixels. Defaults to None, using DEFAULT_WIDTH when no view sets one.
+        height (int): height of the enclosing view, in pixels. Defaults to None, using DEFAULT_HEIGHT when no view sets one.
+
+    Returns:
+        layers (list): (mark type, encoding, width, height) of every layer, the size being the one of the panel it is drawn in
+    """
+    # "container" and step-based sizes are resolved by the browser, the default size is used instead
+    width = specs['width'] if isinstance(specs.get('width'), int) else width
+    height = specs['height'] if isinstance(specs.get('height'), int) else height
+
+    if(isinstance(specs.get('spec'), dict)):
+        return get_layers(specs['spec'], width, height)
+    for key in ('layer', 'concat', 'hconcat', 'vconcat'):
+        if(key in specs):
+            return [layer for view in specs[key] for layer in get_layers(view, width, height)]
+
+    mark = specs.get('mark')
+    mark = mark.get('type') if isinstance(mark, dict) else mark
+    if(mark is None):
+        return []
+    return [(mark, specs.get('encoding', {}), width or DEFAULT_WIDTH, height or DEFAULT_HEIGHT)]
+
+def has_computed_properties(specs):
+    """Checks whether a Vega-Lite spec computes over the data, anywhere in its views and encodings
+
+    Args:
+        specs (dict or list): Vega-Lite spec, or any part of it
+
+    Returns:
+        bool: True if the spec transforms, aggregates or bins the data
+    """
+    if(isinstance(specs, dict)):
+        return any(key in COMPUTED_PROPERTIES or has_computed_properties(value) for key, value in specs.items())
+    if(isinstance(specs, list)):
+        return any(has_computed_properties(value) for value in specs)
+    return False
+
+def get_channel_field(encoding, channel, output, types):
+    """Retrieves the output field encoded by a channel, when its type is one of the given types
+
+    Args:
+        encoding (dict): encoding of a layer
+        channel (str): encoding channel, such as "x" or "y"
+        output (pandas.DataFrame): aggregated output
+        types (set): accepted Vega-Lite field types
+
+    Returns:
+        field (str): field of the output, or None if the channel does not encode an output field of these types
+    """
+    definition = encoding.get(channel)
+    if(not isinstance(definition, dict) or definition.get('type') not in types or definition.get('field') not in output.columns):
+        return None
+    return definition['field']
+
+def get_numbers(series):
+    """Converts a quantitative or temporal field to floats, so that distances can be measured"""
+    if(pd.api.types.is_datetime64_any_dtype(series)):
+        values = series.to_numpy(dtype='datetime64[ns]').view('int64').astype('float64')
+        values[series.isna().to_numpy()] = np.nan
+        return values
+    return series.to_numpy(dtype='float64', na_value=np.nan)
+
+def get_series_positions(output, fields):
+    """Splits the rows of an output into series, one for every combination of the fields that are not charted on the axes
+
+    Args:
+        output (pandas.DataFrame): aggregated output
+        fields (list): fields charted on the axes
+
+    Returns:
+        positions (list): row positions of each series
+    """
+    series_fields = [column for column in output.columns if column not in fields]
+    if(not series_fields):
+        return [np.arange(len(output))]
+    return list(output.groupby(series_fields, sort=False, dropna=False).indices.values())
+
+def get_lttb_positions(x, y, bounds, threshold):
+    """Selects the points of several lines kept by Largest-Triangle-Three-Buckets downsampling
+
+    The first and last points of a line are kept, and the points in between are split into threshold - 2 buckets. In each bucket, the
+    point kept is the one forming the largest triangle with the point kept in the previous bucket and the average point of the next
+    bucket. Buckets are walked in order, each step selecting the point of the same bucket in every line at once.
+
+    Args:
+        x (numpy.ndarray): positions of the points on the x axis, as floats, lines one after the other and each sorted by x
+        y (numpy.ndarray): values of the points, as floats (missing values are never kept over present ones)
+        bounds (numpy.ndarray): position of the first point of each line, followed by the number of points
+        threshold (int): number of points kept in each line, lines with fewer points are kept whole
+
+    Returns:
+        numpy.ndarray: positions of the kept points, in order
+    """
+    starts, sizes = bounds[:-1], np.diff(bounds)
+    reduced = sizes > threshold
+    if(threshold < 3 or not reduced.any()):
+        return np.arange(len(x))
+    whole = np.flatnonzero(np.repeat(~reduced, sizes))
+    starts, sizes = starts[reduced], sizes[reduced]
+
+    # bucket boundaries of every line, every bucket holding at least one point since there are fewer buckets than points between the ends
+    edges = starts[:, None] + np.linspace(1, sizes - 1, threshold - 1, axis=1).astype('int64')
+
+    # average point of every bucket, the last point of the line standing for the bucket after the last one
+    present = ~np.isnan(y)
+    sums_x = np.concatenate([[0], np.cumsum(x)])
+    sums_y = np.concatenate([[0], np.cumsum(np.where(present, y, 0))])
+    counts = np.concatenate([[0], np.cumsum(present)])
+    last = starts + sizes - 1
+    average_x = np.column_stack([(sums_x[edges[:, 1:]] - sums_x[edges[:, :-1]]) / np.diff(edges, axis=1), x[last]])
+    average_y = np.column_stack([(sums_y[edges[:, 1:]] - sums_y[edges[:, :-1]]) / np.maximum(counts[edges[:, 1:]] - counts[edges[:, :-1]], 1), y[last]])
+
+    kept = np.empty((len(starts), threshold), dtype='int64')
+    kept[:, 0], kept[:, -1] = starts, last
+    rows = np.arange(len(starts))
+    for bucket in range(threshold - 2):
+        start, end = edges[:, bucket], edges[:, bucket + 1]
+        candidates = start[:, None] + np.arange((end - start).max())
+        valid = candidates < end[:, None]
+        candidates = np.minimum(candidates, end[:, None] - 1)
+
+        anchor_x, anchor_y = x[kept[:, bucket]][:, None], y[kept[:, bucket]][:, None]
+        next_x, next_y = average_x[:, bucket + 1, None], average_y[:, bucket + 1, None]
+        areas = np.abs((anchor_x - next_x) * (y[candidates] - anchor_y) - (anchor_x - x[candidates]) * (next_y - anchor_y))
+        # padding and missing values are never selected over a point with a measurable area
+        areas = np.where(valid & np.isfinite(areas), areas, -1)
+        kept[:, bucket + 1] = candidates[rows, areas.argmax(axis=1)]
+    return np.sort(np.concatenate([whole, kept.ravel()]))
+
+def downsample_lines(output, encoding, width):
+    """Downsamples every line of an output to one point for each pixel of the chart width
+
+    Args:
+        output (pandas.DataFrame): aggregated output
+        encoding (dict): encoding of the line layer
+        width (int): width of the panel the lines are drawn in, in pixels
+
+    Returns:
+        pandas.DataFrame: downsampled output, or None if the lines can not be downsampled
+    """
+    x = get_channel_field(encoding, 'x', output, CONTINUOUS_TYPES)
+    y = get_channel_field(encoding, 'y', output, {'quantitative'})
+    if(x is None or y is None or len(output) <= width):
+        return None
+
+    # rows are laid out line after line, each line sorted by x
+    x_values = get_numbers(output[x])
+    lines = get_series_positions(output, [x, y])
+    order = np.concatenate([positions[np.argsort(x_values[positions], kind='stable')] for positions in lines])
+    bounds = np.concatenate([[0], np.cumsum([len(positions) for positions in lines])])
+
+    kept = get_lttb_positions(x_values[order], get_numbers(output[y])[order], bounds, width)
+    return output.iloc[np.sort(order[kept])]
+
+def bin_points(output, encoding, width, height):
+    """Bins a point cloud into square cells of the chart, each cell being charted as the centroid of its points
+
+    Args:
+        output (pandas.DataFrame): aggregated output
+        encoding (dict): encoding of the point layer
+        width (int): width of the panel the points are drawn in, in pixels
+        height (int): height of the panel the points are drawn in, in pixels
+
+    Returns:
+        pandas.DataFrame: centroid and number of points of every non-empty cell, or None if the points can not be binned
+    """
+    x = get_channel_field(encoding, 'x', output, CONTINUOUS_TYPES)
+    y = get_channel_field(encoding, 'y', output, CONTINUOUS_TYPES)
+    if(x is None or y is None or len(output) <= (width // POINT_CELL_SIZE) * (height // POINT_CELL_SIZE)):
+        return None
+
+    cells = []
+    for field, size in ((x, width), (y, height)):
+        values = get_numbers(output[field])
+        low, high = np.nanmin(values), np.nanmax(values)
+        count = max(size // POINT_CELL_SIZE, 1)
+        cells.append(np.clip(np.floor((values - low) / ((high - low) or 1) * count), 0, count - 1))
+
+    series_fields = [column for column in output.columns if column not in (x, y)]
+    frame = output.assign(x_cell=cells[0], y_cell=cells[1])
+    binned = frame.groupby(series_fields + ['x_cell', 'y_cell'], sort=False, dropna=False).agg(**{
+        x: (x, 'mean'), y: (y, 'mean'), POINT_COUNT_FIELD: (x, 'size')
+    })
+    return binned.reset_index(series_fields)[list(output.columns) + [POINT_COUNT_FIELD]].reset_index(drop=True)
+
+def bucket_categories(output, encoding, width, height, plan):
+    """Keeps the categories that fit the categorical axis of a chart, gathering the others in an "other" bucket
+
+    Categories are ranked by their total value. The bucket adds up the values of the tail categories, so it is only built for additive
+    agg_operations, the tail categories are left out otherwise.
+
+    Args:
+        output (pandas.DataFrame): aggregated output
+        encoding (dict): encoding of the band layer
+        width (int): width of the panel, in pixels
+        height (int): height of the panel, in pixels
+        plan (plans.SpecPlan): compiled plan of the charted spec
+
+    Returns:
+        tuple: (reduced output, "other" or "top"), or (None, None) if the chart has no categorical axis or all the categories fit
+    """
+    for category_channel, value_channel, size in (('x', 'y', width), ('y', 'x', height)):
+        category = get_channel_field(encoding, category_channel, output, {'nominal', 'ordinal'})
+        value = get_channel_field(encoding, value_channel, output, {'quantitative'})
+        if(category is not None and value is not None):
+            break
+    else:
+        return None, None
+
+    # time periods charted as bands are never gathered with other periods
+    if(pd.api.types.is_datetime64_any_dtype(output[category])):
+        return None, None
+
+    bands = max(size // MIN_BAND_SIZE, 2)
+    if(len(output) <= bands):
+        return None, None
+    totals = output.groupby(category, sort=False)[value].sum()
+    if(len(totals) <= bands):
+        return None, None
+
+    top = totals.nlargest(bands - 1).index
+    in_top = output[category].isin(top).to_numpy()
+    if(plan.agg_operation not in ADDITIVE_OPERATIONS):
+        return output[in_top], 'top'
+
+    series_fields = [column for column in output.columns if column not in (category, value)]
+    tail = output[~in_top]
+    if(series_fields):
+        other = tail.groupby(series_fields, sort=False, dropna=False)[value].sum().reset_index()
+    else:
+        other = pd.DataFrame({value: [tail[value].sum()]})
+    other[category] = OTHER_LABEL
+    return pd.concat([output[in_top], other[list(output.columns)]], ignore_index=True), 'other'
+
+def reduce_output(output, specs, plan):
+    """Reduces an aggregated output to what its chart can draw, according to the marks of the spec and the size of its views
+
+    Lines are downsampled with LTTB to one point for each pixel of their panel width, point clouds are binned into cells of a few pixels
+    and categorical axes keep one category for every few pixels. Specs computing over the data in Vega-Lite (transforms, aggregated
+    or binned encodings) are charted from the whole output, since their computed values would change.
+
+    Args:
+        output (pandas.DataFrame): aggregated output, kept whole
+        specs (dict): Vega-Lite spec of the chart
+        plan (plans.SpecPlan): compiled plan of the charted spec
+
+    Returns:
+        tuple: (output sent to the chart, Reduction), the Reduction being None when the output is charted as it is
+    """
+    layers = get_layers(specs)
+    if(not layers or has_computed_properties(specs)):
+        return output, None
+
+    # every layer is drawn from the same output, so the reduction of the first one must suit the other ones
+    marks = {mark for mark, _, _, _ in layers}
+    _, encoding, width, height = layers[0]
+    if(marks <= LINE_MARKS):
+        reduced, method = downsample_lines(output, encoding, width), 'lttb'
+    elif(marks <= POINT_MARKS):
+        reduced, method = bin_points(output, encoding, width, height), 'binning'
+    elif(marks <= BAND_MARKS):
+        reduced, method = bucket_categories(output, encoding, width, height, plan)
+    else:
+        return output, None
+
+    if(reduced is None or len(reduced) == len(output)):
+        return output, None
+    return reduced, Reduction(method, len(output), len(reduced))
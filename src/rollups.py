@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-aggregated daily rollups of time fields, answering timeseries specs and time windows without scanning the rows
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+
+from aggregations import get_day_offsets, bin_days, get_period_labels, get_day_window, load_plan_fields
+from sketches import SKETCHES, build_sketch, evaluate_sketch, get_sketch_key
+from metrics import CACHE_LOOKUPS
+
+# agg_operations that can be answered from daily partials or daily sketches, the others need the rows themselves
+ROLLUP_OPERATIONS = {'count', 'sum', 'mean', 'count_distinct', 'percentile'}
+
+class TimeCube:
+    """Daily rollup of a time field: the rows of each day, the sum and count of each measure for every day, and daily sketches of distinct counts and percentiles
+
+    Days, weeks, months and quarters are all rolled up from the daily partials, so answering a spec (for any time window)
+    takes time proportional to the number of days covered, not to the number of rows. Appended rows are added to the daily partials
+    and merged into the daily sketches, without reading the previous rows again.
+
+    Args:
+        name (str): name of the time field
+        start (int): day offset from the epoch of the first day of the cube
+        rows (numpy.ndarray): number of rows of each day, from the first to the last day with rows
+
+    Attributes:
+        name (str): name of the time field
+        start (int): day offset from the epoch of the first day of the cube
+        rows (numpy.ndarray): number of rows of each day
+        measures (dict): (sums, counts) arrays of the non-missing values of each day, by measure
+        integers (set): measures holding integers, whose sums are kept as integers
+        sketches (dict): sketches of each day (keyed by day position), by measure and sketch (see sketches.get_sketch_key)
+
+    """
+    def __init__(self, name, start, rows):
+        self.name = name
+        self.start = start
+        self.rows = rows
+        self.measures = {}
+        self.integers = set()
+        self.sketches = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_series(cls, series):
+        """Builds the daily rollup of a time field
+
+        Args:
+            series (pandas.Series): time field, either datetimes or strings parsed by pandas.to_datetime
+
+        Returns:
+            TimeCube: rollup holding the rows of each day
+        """
+        days, valid = get_day_offsets(series)
+        if(not valid.any()):
+            return cls(series.name, 0, np.zeros(0, dtype='int64'))
+
+        start = days[valid].min()
+        return cls(series.name, start, np.bincount(days[valid] - start))
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the daily partials, in bytes"""
+        return (self.rows.nbytes + sum(sums.nbytes + counts.nbytes for sums, counts in self.measures.values())
+                + sum(sketch.nbytes for sketch in self.sketches.values()))
+
+    def get_bounds(self):
+        """First and last day with rows
+
+        Args:
+            None
+
+        Returns:
+            tuple: (first, last) datetime.date, or None if the time field has no rows
+        """
+        if(len(self.rows) == 0):
+            return None
+        first = pd.Timestamp(np.datetime64(int(self.start), 'D')).date()
+        last = pd.Timestamp(np.datetime64(int(self.start) + len(self.rows) - 1, 'D')).date()
+        return first, last
+
+    def add_measure(self, times, values):
+        """Adds the daily sums and counts of the non-missing values of a measure, once for each measure
+
+        Args:
+            times (pandas.Series): time field the cube was built from
+            values (pandas.Series): values of the measure, aligned with the time field
+
+        Returns:
+            None -> daily partials are stored in the measures attribute
+        """
+        with self.lock:
+            if(values.name in self.measures):
+                return
+
+            days, valid = get_day_offsets(times)
+            numbers = np.asarray(values).astype('float64')
+            valid &= ~np.isnan(numbers)
+
+            sums = np.bincount(days[valid] - self.start, weights=numbers[valid], minlength=len(self.rows))
+            counts = np.bincount(days[valid] - self.start, minlength=len(self.rows))
+            if(np.issubdtype(np.asarray(values).dtype, np.integer)):
+                self.integers.add(values.name)
+            self.measures[values.name] = (sums, counts)
+
+    def add_sketch(self, times, values, op, params):
+        """Adds the daily sketches of a measure for a sketch-based agg_operation, once for each measure and sketch
+
+        Args:
+            times (pandas.Series): time field the cube was built from
+            values (pandas.Series): values of the measure, aligned with the time field
+            op (str): sketch-based agg_operation, "count_distinct" or "percentile"
+            params (dict): parameters of the agg_operation
+
+        Returns:
+            None -> daily sketches are stored in the sketches attribute
+        """
+        key = (values.name,) + get_sketch_key(op, params)
+        with self.lock:
+            if(key in self.sketches):
+                return
+
+            days, valid = get_day_offsets(times)
+            self.sketches[key] = build_sketch(op, days[valid] - self.start, np.asarray(values)[valid], params)
+
+    def append(self, times, frame):
+        """Adds appended rows to the daily partials and sketches, extending the days of the cube when needed
+
+        Args:
+            times (pandas.Series): time field of the appended rows
+            frame (pandas.DataFrame): appended rows, holding every measure of the cube
+
+        Returns:
+            None -> daily partials and sketches are updated in place
+        """
+        days, valid = get_day_offsets(times)
+        if(not valid.any()):
+            return
+
+        with self.lock:
+            start = min(self.start, days[valid].min()) if len(self.rows) else days[valid].min()
+            size = int(max(self.start + len(self.rows), days[valid].max() + 1) - start)
+            shift = int(self.start - start)
+            positions = days[valid] - start
+
+            def extend(daily, added_positions, weights=None):
+                # previous days are moved to their position in the extended range, then the appended rows are added to their days
+                extended = np.zeros(size, dtype=daily.dtype)
+                extended[shift:shift + len(daily)] = daily
+                return extended + np.bincount(added_positions, weights=weights, minlength=size).astype(daily.dtype)
+
+            measures = {}
+            for measure, (sums, counts) in self.measures.items():
+                numbers = np.asarray(frame[measure]).astype('float64')[valid]
+                present = ~np.isnan(numbers)
+                measures[measure] = (extend(sums, positions[present], numbers[present]), extend(counts, positions[present]))
+                if(not np.issubdtype(np.asarray(frame[measure]).dtype, np.integer)):
+                    self.integers.discard(measure)
+
+            # daily sketches are keyed by day position, so they move along with the first day before the appended rows are merged
+            sketches = {}
+            for key, sketch in self.sketches.items():
+                measure, op, params = key[0], key[1], dict(key[2:])
+                if(shift):
+                    sketch = sketch.regroup(pd.Series(np.arange(len(self.rows)) + shift, index=np.arange(len(self.rows))))
+                sketches[key] = sketch.merge(build_sketch(op, positions, np.asarray(frame[measure])[valid], params))
+
+            self.start, self.rows, self.measures, self.sketches = start, extend(self.rows, positions), measures, sketches
+
+    def rollup(self, period, op, measure=None, time_range=None, params=None):
+        """Rolls the daily partials up to periods, within an optional time window
+
+        Periods span from the first to the last day with rows in the window and are labeled as in GroupKeys.from_times, so the
+        output is the same as aggregating the rows themselves.
+
+        Args:
+            period (str): period of the bins, one of the aggregations.TIME_UNITS values
+            op (str): reduction, one of ROLLUP_OPERATIONS
+            measure (str): measure being reduced, ignored for "count", which counts rows. Defaults to None.
+            time_range (tuple): (start, end) dates, both inclusive. Defaults to None, covering every day.
+            params (dict): parameters of sketch-based operations. Defaults to None.
+
+        Returns:
+            tuple: (labels, values) of each period
+        """
+        if(op not in ROLLUP_OPERATIONS):
+            raise NotImplementedError(f'{op} operation can not be answered from a rollup')
+
+        first, last = 0, len(self.rows) - 1
+        if(time_range is not None):
+            window_first, window_last = get_day_window(time_range)
+            first = max(first, window_first - self.start)
+            last = min(last, window_last - self.start)
+
+        # the periods only span the days with rows, the same way resampling the rows does
+        filled = np.flatnonzero(self.rows[first:last + 1]) + first if last >= first else np.zeros(0, dtype='int64')
+        if(len(filled) == 0):
+            return pd.DatetimeIndex([], name=self.name), np.zeros(0, dtype='float64' if op == 'mean' else 'int64')
+        first, last = filled[0], filled[-1]
+
+        offsets = bin_days(np.arange(first, last + 1) + self.start, period)
+        codes = offsets - offsets[0]
+        size = codes[-1] + 1
+        labels = get_period_labels(np.arange(offsets[0], offsets[0] + size), period, self.name)
+
+        if(op == 'count'):
+            return labels, np.bincount(codes, weights=self.rows[first:last + 1], minlength=size).astype('int64')
+
+        # daily sketches are merged into period sketches, days outside of the window are left out
+        if(op in SKETCHES):
+            sketch = self.sketches[(measure,) + get_sketch_key(op, params)]
+            period_sketch = sketch.regroup(pd.Series(codes, index=np.arange(first, last + 1)))
+            return labels, evaluate_sketch(period_sketch, pd.RangeIndex(size), params)
+
+        sums, counts = self.measures[measure]
+        period_sums = np.bincount(codes, weights=sums[first:last + 1], minlength=size)
+        if(op == 'sum'):
+            return labels, period_sums.astype('int64') if measure in self.integers else period_sums
+
+        period_counts = np.bincount(codes, weights=counts[first:last + 1], minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return labels, period_sums / period_counts
+
+
+class RollupStore:
+    """Process-wide registry of the time cubes of every dataset, built once for each time field and measure and data version
+
+    Cubes are only kept for the latest data version of each index. They are updated with the documents appended to the index,
+    and released when the data changes in other ways.
+
+    Args:
+        None
+
+    Attributes:
+        cubes (dict): (data version, TimeCube) of each (index, time field)
+
+    """
+    def __init__(self):
+        self.cubes = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def supports(plan):
+        """Whether a spec plan can be answered from a time cube
+
+        Args:
+            plan (plans.SpecPlan): compiled spec plan
+
+        Returns:
+            bool: True for timeseries specs counting, summing, averaging, counting distinct values or estimating percentiles
+        """
+        return plan.report_type == 'timeseries' and plan.agg_operation in ROLLUP_OPERATIONS
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the stored cubes, in bytes"""
+        with self.lock:
+            return sum(cube.nbytes for _, cube in self.cubes.values())
+
+    def get_cube(self, dataset, plan, loaded=None):
+        """Retrieves the cube of the time field of a spec, building it (and the daily partials of its measure) when missing
+
+        Args:
+            dataset (datasets.ProjectedDataset): versioned dataset holding the time field
+            plan (plans.SpecPlan): compiled timeseries plan
+            loaded (tuple): fields of the plan and their data version (see aggregations.load_plan_fields). Defaults to None, reading them.
+
+        Returns:
+            TimeCube: cube of the time field, or None if the dataset is not versioned and its cube can not be kept
+        """
+        # the cube is built from the rows of the version it is kept under, a refresh may swap them meanwhile
+        data, version = loaded if loaded is not None else load_plan_fields(dataset, [plan])
+        if(version is None):
+            return None
+
+        key = (dataset.index_reference, plan.group_field)
+        with self.lock:
+            cube_version, cube = self.cubes.get(key, (None, None))
+
+        if(cube_version != version):
+            CACHE_LOOKUPS.labels('rollup', 'miss').inc()
+            cube = TimeCube.from_series(data[plan.group_field])
+            with self.lock:
+                # rows read before a refresh do not replace the cube of the refreshed version
+                if(dataset.version == version):
+                    self.cubes[key] = (version, cube)
+        else:
+            CACHE_LOOKUPS.labels('rollup', 'hit').inc()
+
+        if(plan.agg_operation in ('sum', 'mean') and plan.agg_field not in cube.measures):
+            cube.add_measure(data[plan.group_field], data[plan.agg_field])
+        elif(plan.agg_operation in SKETCHES):
+            cube.add_sketch(data[plan.group_field], data[plan.agg_field], plan.agg_operation, dict(plan.agg_params))
+        return cube
+
+    def append_documents(self, dataset, appended, previous_version):
+        """Updates the cubes of a dataset with the documents appended to its index, instead of building them again
+
+        Cubes of other versions, or whose fields are missing from the appended documents, are dropped and built again when requested.
+
+        Args:
+            dataset (datasets.ProjectedDataset): refreshed dataset, holding its new version
+            appended (pandas.DataFrame): appended documents
+            previous_version (str): data version of the dataset before the appends
+
+        Returns:
+            None -> cubes are updated in place and keyed by the new version
+        """
+        with self.lock:
+            cubes = [(key, cube_version, cube) for key, (cube_version, cube) in self.cubes.items() if key[0] == dataset.index_reference]
+
+        for key, cube_version, cube in cubes:
+            fields = {key[1]} | set(cube.measures) | set(sketch_key[0] for sketch_key in cube.sketches)
+            if(cube_version != previous_version or not fields.issubset(appended.columns)):
+                with self.lock:
+                    self.cubes.pop(key, None)
+                continue
+
+            cube.append(appended[key[1]], appended)
+            with self.lock:
+                self.cubes[key] = (dataset.version, cube)
+
+    def aggregate(self, dataset, plan, time_range=None, loaded=None):
+        """Answers a timeseries spec from the cube of its time field
+
+        Args:
+            dataset (datasets.ProjectedDataset): versioned dataset holding the fields of the spec
+            plan (plans.SpecPlan): compiled timeseries plan, counting, summing or averaging
+            time_range (tuple): (start, end) dates, both inclusive. Defaults to None, covering every day.
+            loaded (tuple): fields of the plan and their data version (see get_cube). Defaults to None, reading them.
+
+        Returns:
+            pandas.DataFrame: aggregated data in the same format produced by aggregations.aggregate, or None if the dataset has no cube
+        """
+        cube = self.get_cube(dataset, plan, loaded)
+        if(cube is None):
+            return None
+
+        labels, values = cube.rollup(plan.period, plan.agg_operation, plan.agg_field, time_range, dict(plan.agg_params))
+        return pd.DataFrame({plan.group_field: labels, plan.agg_field: values})
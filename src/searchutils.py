@@ -3,12 +3,24 @@
 Utility classes for handling search and results from Elasticsearch queries
 """
 
+import math
+import hashlib
 import unicodedata
+import pandas as pd
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Q
 import eland as ed
 import streamlit as st
 
+from sketches import DEFAULT_PRECISION, DEFAULT_RELATIVE_ERROR
+from aggregations import TIME_UNITS, bin_days, get_period_labels
+
+# largest precision_threshold accepted by the Elasticsearch cardinality aggregation
+MAX_PRECISION_THRESHOLD = 40000
+
+# t-digest compression used by Elasticsearch percentiles by default, matching the default relative error of the sketches
+DEFAULT_COMPRESSION = 100
+
 class Searcher:
     """Base class for all search-oriented objects. 
     Handles queries and search results from Elasticsearch full-text operations
@@ -22,12 +34,61 @@ class Searcher:
         es_client (elasticsearch.client.Elasticsearch): active client connection for interfacing queries
         cluster_location (str): used in Eland-based queries
         index_reference (str): index in which searches will be performed
+        total_hits (int): total number of documents matching the last search
+        last_sort (list): sort values of the last hit of the last ranked search, used for paging with search_after
     """
+    # unique field used to break ties between hits with the same score in ranked searches
+    tiebreaker_field = 'spec_id.keyword'
+
     def __init__(self, es_client, cluster_location, index_reference="directory"):
         self.es_client = es_client
         self.cluster_location = cluster_location
         self.index_reference = index_reference
 
+    def get_index_version(self):
+        """Computes the data version of the referenced index (or index pattern)
+
+        The version is derived from the index uuids and document counts, so it changes whenever the index is recreated, appended to or updated.
+
+        Args:
+            None
+
+        Returns:
+            version (str): short hash identifying the current state of the index
+        """
+        stats = self.es_client.indices.stats(index=self.index_reference, metric='docs')
+        state = []
+        for name, index_stats in sorted(stats['indices'].items()):
+            docs = index_stats['primaries']['docs']
+            state.append(f"{name}:{index_stats.get('uuid')}:{docs['count']}:{docs['deleted']}")
+
+        return hashlib.sha1(';'.join(state).encode()).hexdigest()[:12]
+
+    def get_index_schema(self):
+        """Retrieves the Elasticsearch field type of every field of the referenced index (or index pattern)
+
+        Args:
+            None
+
+        Returns:
+            schema (dict): field type by field name, with nested fields and multi-fields flattened with dots
+        """
+        schema = {}
+
+        def flatten(properties, prefix=''):
+            for name, mapping in properties.items():
+                field = f'{prefix}{name}'
+                if('type' in mapping):
+                    schema.setdefault(field, mapping['type'])
+                if('properties' in mapping):
+                    flatten(mapping['properties'], f'{field}.')
+                if('fields' in mapping):
+                    flatten(mapping['fields'], f'{field}.')
+
+        for index_mapping in self.es_client.indices.get_mapping(index=self.index_reference).values():
+            flatten(index_mapping['mappings'].get('properties', {}))
+        return schema
+
     def process_input_text(self, input_text):
         """Normalizes text inputs from the search elements and stores in processed_text attribute.
         Normalization includes the following steps:
@@ -42,28 +103,54 @@ class Searcher:
             None -> adds processed_text as an attribute to the Searcher object
 
         """
-        processed_text = str(unicodedata.normalize('NFKD', input_text).encode('ASCII', 'ignore'), 'utf-8')
-        self.processed_text = processed_text
+        self.processed_text = self.fold_text(input_text)
 
+    @staticmethod
+    def fold_text(input_text):
+        """Removes accents (substituting the ascii version) and non-ascii characters from a text
 
-    def search_data_directory(self):
+        Args:
+            input_text (str): text to normalize
+
+        Returns:
+            processed_text (str): ascii-folded text
+        """
+        return str(unicodedata.normalize('NFKD', input_text).encode('ASCII', 'ignore'), 'utf-8')
+
+
+    def search_data_directory(self, size=None, search_after=None):
         """Performs configured search in the specified index (directory)
         Args:
-            None
+            size (int): number of top hits by relevance to retrieve. Defaults to None, scanning every matching document in score-less order.
+            search_after (list): sort values of the last hit of the previous page (see last_sort attribute), used for paging ranked results. Defaults to None.
         
         Returns:
-            search_results (list): list of "hits" (dictionary result from search) containing all search results
+            search_results (list): list of "hits" (dictionary result from search) containing the search results
 
         Note:
-            For very large indices, this is not a good solution, since it performs pagination on the index. Might result in long queries.
+            The total number of matching documents is stored in the total_hits attribute.
+            Scanning (size=None) paginates over the whole index, for very large indices use ranked search with a size instead.
 
         """
-        search_statement = Search(using=self.es_client, index=self.index_reference)
-
-        # scan search results through pagination - by default it scans the ENTIRE index, this should now be used for very large queries
+        search_statement = Search(using=self.es_client, index=self.index_reference).query(self.query_structure)
         st.spinner('Processing your request...')
-        search_results = [hit.to_dict() for hit in search_statement.query(self.query_structure).scan()]
-        return search_results
+
+        if(size is None):
+            # scan search results through pagination - by default it scans the ENTIRE index, this should now be used for very large queries
+            search_results = [hit.to_dict() for hit in search_statement.scan()]
+            self.total_hits = len(search_results)
+            self.last_sort = None
+            return search_results
+
+        # ranked search only retrieves the top hits, the tiebreaker keeps the order stable for paging with search_after
+        search_statement = search_statement.sort('_score', {self.tiebreaker_field: 'asc'}).extra(size=size, track_total_hits=True)
+        if(search_after is not None):
+            search_statement = search_statement.extra(search_after=search_after)
+
+        response = search_statement.execute()
+        self.total_hits = response.hits.total.value
+        self.last_sort = list(response.hits[-1].meta.sort) if len(response.hits) > 0 else None
+        return [hit.to_dict() for hit in response]
 
 
 class SourceFinder(Searcher):
@@ -96,6 +183,58 @@ class SourceFinder(Searcher):
         df = ed.DataFrame(self.cluster_location, self.index_reference)
         self.source = df
 
+class DirectoryScanner(Searcher):
+    """Extends Searcher object with functionality for reading every spec in the directory index
+
+    Args:
+        es_client (elasticsearch.client.Elasticsearch): client handler for Elasticsearch from low-level client
+        cluster_location (str): string reference to cluster connection. Ex: http://somecluster@password:9200/
+        index_reference (str): index pattern reference for the directory, defaulting to "directory"
+
+    Attributes:
+        es_client (elasticsearch.client.Elasticsearch): active client connection for interfacing queries
+        cluster_location (str): used in Eland-based queries
+        index_reference (str): index in which searches will be performed
+
+    """
+    def __init__(self, es_client, cluster_location, index_reference="directory"):
+        Searcher.__init__(self, es_client, cluster_location, index_reference)
+
+    def get_directory_specs(self, source_fields=None):
+        """Retrieves every spec available in the directory index
+
+        Args:
+            source_fields (list): subset of spec fields to retrieve. Defaults to None, retrieving the whole spec.
+
+        Returns:
+            specs (list): list of specs (dictionaries) stored in the directory
+        """
+        search_statement = Search(using=self.es_client, index=self.index_reference).query('match_all')
+        if(source_fields is not None):
+            search_statement = search_statement.source(source_fields)
+
+        return [hit.to_dict() for hit in search_statement.scan()]
+
+    def get_spec_dimensions(self, source_index=None, default_index=None):
+        """Collects the union of the dimensions referenced by the specs in the directory index
+
+        Args:
+            source_index (str): only specs reading from this data index are considered. Defaults to None, considering every spec.
+            default_index (str): data index of the specs that do not name a source index. Defaults to None.
+
+        Returns:
+            dimensions (list): columns of the data index used by at least one spec, in order of first appearance
+        """
+        dimensions = []
+        for spec in self.get_directory_specs(['instructions.dimensions', 'instructions.source_index']):
+            instructions = spec.get('instructions', {})
+            if(source_index is not None and (instructions.get('source_index') or default_index) != source_index):
+                continue
+            for dimension in instructions.get('dimensions', []):
+                if(dimension not in dimensions):
+                    dimensions.append(dimension)
+        return dimensions
+
 class MultiMatchSearcher(Searcher):
     """Extends Searcher object with Multi Match search functionality
 
@@ -182,3 +321,245 @@ class MatchSearcher(Searcher):
         })
 
         self.query_structure = query_structure
+
+
+class AggregationSearcher(Searcher):
+    """Extends Searcher object with aggregation pushdown functionality.
+    Compiles the instruction set of a spec into a native Elasticsearch aggregation, so that only the aggregated buckets are transferred.
+
+    Args:
+        es_client (elasticsearch.client.Elasticsearch): client handler for Elasticsearch from low-level client
+        cluster_location (str): string reference to cluster connection. Ex: http://somecluster@password:9200/
+        index_reference (str): index pattern reference for the aggregation, usually the data index
+
+    Attributes:
+        es_client (elasticsearch.client.Elasticsearch): active client connection for interfacing queries
+        cluster_location (str): used in Eland-based queries
+        index_reference (str): index in which aggregations will be performed
+
+    """
+    # equivalent Elasticsearch metric aggregation for each agg_operation in the instruction set, counts are read from the doc_count of
+    # each bucket instead, since in-memory aggregations count rows whether or not agg_field holds a value
+    metric_aggregations = {
+        'count': None,
+        'sum': 'sum',
+        'mean': 'avg',
+        'median': 'percentiles',
+        'count_distinct': 'cardinality',
+        'percentile': 'percentiles'
+    }
+
+    # equivalent Elasticsearch calendar interval for each time_unit in the instruction set
+    calendar_intervals = {
+        'day': 'day',
+        'week': 'week',
+        'month': 'month',
+        'quarter': 'quarter'
+    }
+
+    def __init__(self, es_client, cluster_location, index_reference):
+        Searcher.__init__(self, es_client, cluster_location, index_reference)
+
+    def build_query_object(self, instructions, limit=10):
+        """Compiles the instruction set of a spec into an Elasticsearch aggregation.
+
+        Category specs become a "terms" aggregation ordered by the metric and limited in size, timeseries specs become a "date_histogram" aggregation.
+        Crosstab specs first become a "terms" aggregation of the top categories of each categorical group field, nested by aggregate_data_index
+        once the top categories are known (see build_crosstab_object).
+
+        Args:
+            instructions (dict): instruction set from the directory spec
+            limit (int): number of buckets kept for category specs, ordered by the aggregated value, and of top categories of each field for crosstab specs. Defaults to 10.
+
+        Returns:
+            None -> aggregation structure is stored within Searcher object
+        """
+        op = instructions['agg_operation']
+        if(op not in self.metric_aggregations):
+            raise NotImplementedError(f'{op} operation is not supported')
+
+        metric_type = self.metric_aggregations[op]
+        metric_params = {'field': instructions['agg_field']}
+
+        # the median is pushed down as the 50th percentile, percentiles and distinct counts use the native sketches of Elasticsearch
+        if(op in ('median', 'percentile')):
+            percent = float(instructions.get('percentile', 50)) if op == 'percentile' else 50.0
+            metric_params['percents'] = [percent]
+            metric_order = f'metric[{percent}]'
+        elif(op == 'count'):
+            metric_order = '_count'
+        else:
+            metric_order = 'metric'
+
+        # the error bounds of the instruction set are mapped to the settings of the Elasticsearch sketches: distinct values are counted
+        # exactly up to precision_threshold and with at least as many HyperLogLog++ registers above it, and t-digest (which bounds ranks
+        # rather than values) is kept at least as compressed as the Elasticsearch default, tightened for smaller relative errors
+        if(op == 'count_distinct'):
+            precision = instructions.get('precision', DEFAULT_PRECISION)
+            metric_params['precision_threshold'] = min(2 ** precision, MAX_PRECISION_THRESHOLD)
+        elif(op == 'percentile'):
+            relative_error = instructions.get('relative_error', DEFAULT_RELATIVE_ERROR)
+            metric_params['tdigest'] = {'compression': max(DEFAULT_COMPRESSION, math.ceil(1 / relative_error))}
+
+        report_type = instructions['type']
+        if(report_type == 'crosstab'):
+            self.build_marginal_object(instructions, limit)
+            self.metric = (metric_type, metric_params)
+            return
+        elif(report_type == 'category'):
+            bucket_type = 'terms'
+            bucket_params = {
+                'field': instructions['cat_field'],
+                'size': limit,
+                'order': {metric_order: 'desc'}
+            }
+        elif(report_type == 'timeseries'):
+            # keeps empty periods, the same way pandas resampling does
+            bucket_type = 'date_histogram'
+            bucket_params = self.get_time_bucket(instructions, min_doc_count=0)
+        else:
+            raise TypeError(f"Instruction set {instructions} given is not valid, check for plot types or dimensions")
+
+        # size 0 since only the buckets are needed, not the documents themselves
+        aggregation_structure = Search(using=self.es_client, index=self.index_reference).extra(size=0)
+        groups = aggregation_structure.aggs.bucket('groups', bucket_type, **bucket_params)
+        if(metric_type is not None):
+            groups.metric('metric', metric_type, **metric_params)
+
+        self.instructions = instructions
+        self.aggregation_structure = aggregation_structure
+
+    def get_time_bucket(self, instructions, min_doc_count=0):
+        """Builds the "date_histogram" parameters binning the time field of a spec into its time unit"""
+        time_unit = instructions['time_unit']
+        if(time_unit not in self.calendar_intervals):
+            raise TypeError(f"{time_unit} is not a valid time unit")
+        return {'field': instructions['time_field'], 'calendar_interval': self.calendar_intervals[time_unit], 'min_doc_count': min_doc_count}
+
+    def build_marginal_object(self, instructions, limit=10):
+        """Compiles the first request of a crosstab spec: the top categories of each categorical group field, by documents holding every group field
+
+        Args:
+            instructions (dict): crosstab instruction set from the directory spec
+            limit (int): number of top categories kept for each categorical group field
+
+        Returns:
+            None -> aggregation structure is stored within Searcher object
+        """
+        aggregation_structure = Search(using=self.es_client, index=self.index_reference).extra(size=0)
+        for field in instructions['group_fields']:
+            aggregation_structure = aggregation_structure.filter('exists', field=field)
+        for field in instructions['group_fields']:
+            if(field != instructions.get('time_field')):
+                aggregation_structure.aggs.bucket(field, 'terms', field=field, size=limit)
+
+        self.instructions = instructions
+        self.limit = limit
+        self.aggregation_structure = aggregation_structure
+
+    def build_crosstab_object(self, top_categories):
+        """Compiles the second request of a crosstab spec: one bucket level per group field, restricted to the top categories, and the metric in the deepest level
+
+        Only the combinations with documents are returned, the time field keeping only its non-empty periods.
+
+        Args:
+            top_categories (dict): top categories of each categorical group field
+
+        Returns:
+            None -> aggregation structure is stored within Searcher object
+        """
+        aggregation_structure = Search(using=self.es_client, index=self.index_reference).extra(size=0)
+        level = aggregation_structure.aggs
+        for field in self.instructions['group_fields']:
+            if(field == self.instructions.get('time_field')):
+                level = level.bucket('groups', 'date_histogram', **self.get_time_bucket(self.instructions, min_doc_count=1))
+            else:
+                level = level.bucket('groups', 'terms', field=field, include=top_categories[field], size=max(len(top_categories[field]), 1))
+
+        metric_type, metric_params = self.metric
+        if(metric_type is not None):
+            level.metric('metric', metric_type, **metric_params)
+        self.aggregation_structure = aggregation_structure
+
+    def collect_crosstab_buckets(self, buckets, depth=0, keys=()):
+        """Flattens nested crosstab buckets into (key of each group field..., value) records"""
+        records = []
+        for bucket in buckets:
+            if(depth + 1 < len(self.instructions['group_fields'])):
+                records += self.collect_crosstab_buckets(bucket['groups']['buckets'], depth + 1, keys + (bucket['key'],))
+                continue
+
+            records.append(keys + (bucket['key'], self.get_bucket_value(bucket)))
+        return records
+
+    def get_bucket_value(self, bucket):
+        """Reads the aggregated value of a bucket: its metric, or its number of documents for counts"""
+        if('metric' not in bucket):
+            return bucket['doc_count']
+        metric = bucket['metric']
+        return next(iter(metric['values'].values())) if 'values' in metric else metric['value']
+
+    def aggregate_crosstab(self):
+        """Performs the two requests of a crosstab spec: the top categories of each field, then the nested buckets of their combinations
+
+        Args:
+            None
+
+        Returns:
+            output (pandas.DataFrame): aggregated data in long format, one column per group field, as produced by Visualizer.make_aggregation
+        """
+        response = self.aggregation_structure.execute()
+        aggregations = response.aggregations.to_dict()
+        top_categories = {field: [bucket['key'] for bucket in aggregation['buckets']] for field, aggregation in aggregations.items()}
+
+        self.build_crosstab_object(top_categories)
+        buckets = self.aggregation_structure.execute().aggregations.groups.to_dict()['buckets']
+
+        columns = list(self.instructions['group_fields']) + [self.instructions['agg_field']]
+        output = pd.DataFrame.from_records(self.collect_crosstab_buckets(buckets), columns=columns)
+
+        if(self.instructions.get('time_field') is not None):
+            output[self.instructions['time_field']] = self.get_period_labels(output[self.instructions['time_field']])
+        return output
+
+    def get_period_labels(self, keys):
+        """Labels date histogram buckets the same way in-memory aggregations do: by the day itself for days and by the last day of the period otherwise
+
+        Args:
+            keys (pandas.Series): bucket keys, returned as epoch milliseconds of the start of each period
+
+        Returns:
+            numpy.ndarray: label of each bucket, as in resample('1d'), resample('W'), resample('1M') and resample('Q')
+        """
+        period = TIME_UNITS[self.instructions['time_unit']]
+        days = keys.to_numpy(dtype='int64') // (24 * 60 * 60 * 1000)
+        return get_period_labels(bin_days(days, period), period).values
+
+    def aggregate_data_index(self):
+        """Performs the configured aggregation in the specified index
+
+        Args:
+            None
+
+        Returns:
+            output (pandas.DataFrame): aggregated data in the same format produced by Visualizer.make_aggregation
+        """
+        if(self.instructions['type'] == 'crosstab'):
+            return self.aggregate_crosstab()
+
+        response = self.aggregation_structure.execute()
+        buckets = response.aggregations.groups.to_dict()['buckets']
+
+        if(self.instructions['type'] == 'category'):
+            key_field = self.instructions['cat_field']
+        else:
+            key_field = self.instructions['time_field']
+
+        records = [(bucket['key'], self.get_bucket_value(bucket)) for bucket in buckets]
+
+        output = pd.DataFrame.from_records(records, columns=[key_field, self.instructions['agg_field']])
+
+        if(self.instructions['type'] == 'timeseries'):
+            output[key_field] = self.get_period_labels(output[key_field])
+
+        return output
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable sketches of distinct counts and quantiles, kept for each group and vectorized over groups
+"""
+
+import numpy as np
+import pandas as pd
+
+# default number of register index bits of distinct counts, the relative error of the estimates is about 1.04 / sqrt(2 ** precision)
+DEFAULT_PRECISION = 12
+
+# default relative error of the quantiles, every reported quantile is within this ratio of a value of the group at the right rank
+DEFAULT_RELATIVE_ERROR = 0.01
+
+# bytes taken by each non-empty register of a sparse group (group position, register index and rank)
+SPARSE_REGISTER_BYTES = 7
+
+# smallest absolute value told apart from zero by quantile sketches
+MIN_QUANTILE_VALUE = 1e-9
+
+def get_bit_lengths(words):
+    """Computes the number of significant bits of unsigned 64-bit integers, exactly
+
+    Args:
+        words (numpy.ndarray): unsigned 64-bit integers
+
+    Returns:
+        numpy.ndarray: bit length of each integer, 0 for zeros
+    """
+    # floats only hold 53 bits, so the high and low bits are measured separately
+    high = (words >> np.uint64(11)).astype('float64')
+    low = (words & np.uint64(2047)).astype('float64')
+    return np.where(high > 0, np.frexp(high)[1] + 11, np.frexp(low)[1])
+
+def get_group_starts(codes):
+    """Sorts group codes, returning the sort order and the position where each group starts in it"""
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0]) if len(codes) else np.zeros(0, dtype='int64')
+    return order, starts
+
+
+class HyperLogLog:
+    """HyperLogLog sketches of the distinct values of each group
+
+    Each group keeps 2 ** precision registers holding the longest run of leading zeros among the hashes of its values.
+    Sketches are merged by keeping the largest registers, so the same sketch answers any union of groups (chunks, days, months).
+    Groups with few values keep their non-empty registers only, so a sketch takes at most SPARSE_REGISTER_BYTES per value rather
+    than 2 ** precision bytes per group; groups with as many non-empty registers as to outweigh a full row of registers keep one.
+
+    Args:
+        keys (pandas.Index): key of each group
+        positions (numpy.ndarray): group position (in keys) of each non-empty register, registers may be repeated
+        indices (numpy.ndarray): index of each non-empty register within its group
+        ranks (numpy.ndarray): rank written in each non-empty register, the largest is kept for repeated registers
+        precision (int): number of register index bits, from 4 to 16
+
+    Attributes:
+        keys (pandas.Index): key of each group
+        positions (numpy.ndarray): group position of each non-empty register of the sparse groups, in group order
+        indices (numpy.ndarray): index of each non-empty register of the sparse groups
+        ranks (numpy.ndarray): rank of each non-empty register of the sparse groups
+        dense_positions (numpy.ndarray): group position of each dense group, in group order
+        registers (numpy.ndarray): (dense groups, 2 ** precision) registers of each dense group
+        precision (int): number of register index bits
+
+    """
+    # parameters of the sketch, the other parameters of an agg_operation are used when evaluating it
+    PARAMETERS = ('precision',)
+
+    def __init__(self, keys, positions, indices, ranks, precision=DEFAULT_PRECISION):
+        self.keys = keys
+        self.precision = precision
+
+        # the longest run of each register, sorted by group
+        size = 1 << precision
+        longest = pd.Series(np.asarray(ranks, dtype='uint8')).groupby(np.asarray(positions, dtype='int64') * size + indices).max()
+        flat = longest.index.to_numpy().astype('int64')
+        positions = flat // size
+
+        # groups whose sparse registers would outweigh their dense registers are kept dense
+        dense = np.bincount(positions, minlength=len(keys)) * SPARSE_REGISTER_BYTES >= size
+        self.dense_positions = np.flatnonzero(dense)
+        self.registers = np.zeros((len(self.dense_positions), size), dtype='uint8')
+        in_dense = dense[positions]
+        self.registers[np.searchsorted(self.dense_positions, positions[in_dense]), flat[in_dense] % size] = longest.to_numpy()[in_dense]
+
+        self.positions = positions[~in_dense].astype('int32')
+        self.indices = (flat[~in_dense] % size).astype('uint16')
+        self.ranks = longest.to_numpy()[~in_dense]
+
+    @classmethod
+    def from_values(cls, keys, values, precision=DEFAULT_PRECISION):
+        """Sketches the distinct non-missing values of each group
+
+        Args:
+            keys (numpy.ndarray): group key of each value
+            values (numpy.ndarray or pandas.Series): values, of any hashable type
+            precision (int): number of register index bits, from 4 to 16. Defaults to DEFAULT_PRECISION.
+
+        Returns:
+            HyperLogLog: sketch of each group
+        """
+        values = pd.Series(np.asarray(values))
+        present = values.notna().to_numpy()
+        codes, uniques = pd.factorize(np.asarray(keys)[present], sort=True)
+
+        hashes = pd.util.hash_array(values[present].to_numpy())
+        width = 64 - precision
+        indices = (hashes >> np.uint64(width)).astype('int64')
+        ranks = width + 1 - get_bit_lengths(hashes & np.uint64((1 << width) - 1))
+
+        # values of missing keys are left out
+        keyed = codes >= 0
+        return cls(pd.Index(uniques), codes[keyed], indices[keyed], ranks[keyed], precision)
+
+    def get_registers(self):
+        """Lists the non-empty registers of every group
+
+        Returns:
+            tuple: group positions, register indices and ranks of the non-empty registers
+        """
+        rows, indices = np.nonzero(self.registers)
+        return (np.concatenate([self.positions.astype('int64'), self.dense_positions[rows]]),
+                np.concatenate([self.indices.astype('int64'), indices]),
+                np.concatenate([self.ranks, self.registers[rows, indices]]))
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the registers, in bytes"""
+        return self.positions.nbytes + self.indices.nbytes + self.ranks.nbytes + self.dense_positions.nbytes + self.registers.nbytes
+
+    def merge(self, other):
+        """Merges the sketches of another set of values of the same groups (or of other groups)
+
+        Args:
+            other (HyperLogLog): sketch with the same precision
+
+        Returns:
+            HyperLogLog: sketch of the union of both
+        """
+        keys = self.keys.append(other.keys)
+        positions, indices, ranks = self.get_registers()
+        other_positions, other_indices, other_ranks = other.get_registers()
+        merged = HyperLogLog(keys, np.concatenate([positions, other_positions + len(self.keys)]), np.concatenate([indices, other_indices]),
+                             np.concatenate([ranks, other_ranks]), self.precision)
+        return merged.regroup(pd.Series(keys, index=np.arange(len(keys))), positional=True)
+
+    def regroup(self, mapping, positional=False):
+        """Merges groups into coarser groups, such as days into months
+
+        Args:
+            mapping (pandas.Series): new key of each current key, current keys missing from it are left out
+            positional (bool): whether the mapping is indexed by group position instead of key. Defaults to False.
+
+        Returns:
+            HyperLogLog: sketch of each new group
+        """
+        new_keys = mapping.reindex(np.arange(len(self.keys)) if positional else self.keys).to_numpy()
+        kept = ~pd.isna(new_keys)
+        codes, uniques = pd.factorize(new_keys[kept], sort=True)
+
+        # new position of each current group, -1 for the ones left out
+        new_positions = np.full(len(self.keys), -1, dtype='int64')
+        new_positions[kept] = codes
+        positions, indices, ranks = self.get_registers()
+        positions = new_positions[positions]
+        moved = positions >= 0
+        return HyperLogLog(pd.Index(uniques), positions[moved], indices[moved], ranks[moved], self.precision)
+
+    def evaluate(self, keys):
+        """Estimates the distinct values of each group
+
+        Args:
+            keys (pandas.Index): groups to estimate
+
+        Returns:
+            numpy.ndarray: estimated distinct values of each group, 0 for groups without values
+        """
+        size = 1 << self.precision
+        groups = len(self.keys)
+
+        # every empty register adds 1 to the harmonic sum, so the sparse groups only sum their non-empty registers
+        weights = np.exp2(-self.ranks.astype('float64')) - 1
+        harmonic = size + np.bincount(self.positions, weights=weights, minlength=groups).astype('float64')
+        empty = size - np.bincount(self.positions, minlength=groups)
+        harmonic[self.dense_positions] = np.sum(np.exp2(-self.registers.astype('float64')), axis=1)
+        empty[self.dense_positions] = np.sum(self.registers == 0, axis=1)
+
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimates = alpha * size ** 2 / harmonic
+
+        # small sets are counted from the empty registers instead (linear counting)
+        with np.errstate(divide='ignore'):
+            small = size * np.log(size / np.maximum(empty, 1))
+        estimates = np.where((estimates <= 2.5 * size) & (empty > 0), small, estimates)
+
+        positions = self.keys.get_indexer(keys)
+        counts = np.where(positions >= 0, np.round(estimates[positions] if len(estimates) else 0), 0)
+        return counts.astype('int64')
+
+
+class QuantileSketch:
+    """Relative-error quantile sketches of the values of each group, in the style of DDSketch
+
+    Values are counted in logarithmic buckets, so every quantile is reported within relative_error of a value of the group at the
+    requested rank, however the values are distributed. Sketches are merged by adding the bucket counts, so the same sketch answers
+    any union of groups and any quantile.
+
+    Args:
+        counts (pandas.Series): values of each (key, bucket), buckets are ordered like the values they hold
+        relative_error (float): relative error of the quantiles, between 0 and 1
+
+    Attributes:
+        counts (pandas.Series): values of each (key, bucket)
+        relative_error (float): relative error of the quantiles
+        gamma (float): ratio between the bounds of each bucket
+
+    """
+    # parameters of the sketch, the other parameters of an agg_operation are used when evaluating it
+    PARAMETERS = ('relative_error',)
+
+    def __init__(self, counts, relative_error=DEFAULT_RELATIVE_ERROR):
+        self.counts = counts
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+
+    @classmethod
+    def from_values(cls, keys, values, relative_error=DEFAULT_RELATIVE_ERROR):
+        """Sketches the non-missing values of each group
+
+        Args:
+            keys (numpy.ndarray): group key of each value
+            values (numpy.ndarray or pandas.Series): numeric values
+            relative_error (float): relative error of the quantiles, between 0 and 1. Defaults to DEFAULT_RELATIVE_ERROR.
+
+        Returns:
+            QuantileSketch: sketch of each group
+        """
+        sketch = cls(None, relative_error)
+        numbers = np.asarray(values).astype('float64')
+        present = ~np.isnan(numbers)
+        buckets = sketch.get_buckets(numbers[present])
+        counts = pd.Series(1, index=[np.asarray(keys)[present], buckets]).groupby(level=[0, 1]).sum()
+        sketch.counts = counts
+        return sketch
+
+    def get_buckets(self, numbers):
+        """Buckets values: 0 holds values close to zero, positive buckets positive values and negative buckets negative values"""
+        magnitudes = np.maximum(np.abs(numbers), MIN_QUANTILE_VALUE)
+        offset = np.ceil(np.log(MIN_QUANTILE_VALUE) / np.log(self.gamma))
+        buckets = (np.ceil(np.log(magnitudes) / np.log(self.gamma)) - offset + 1).astype('int64')
+        buckets = np.where(np.abs(numbers) < MIN_QUANTILE_VALUE, 0, buckets)
+        return np.where(numbers < 0, -buckets, buckets)
+
+    def get_values(self, buckets):
+        """Value reported for each bucket, within relative_error of every value the bucket holds"""
+        offset = np.ceil(np.log(MIN_QUANTILE_VALUE) / np.log(self.gamma))
+        magnitudes = 2 * self.gamma ** (np.abs(buckets) + offset - 1) / (1 + self.gamma)
+        return np.where(buckets == 0, 0.0, np.sign(buckets) * magnitudes)
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the bucket counts, in bytes"""
+        return int(self.counts.memory_usage(index=True, deep=True))
+
+    def merge(self, other):
+        """Merges the sketches of another set of values of the same groups (or of other groups)
+
+        Args:
+            other (QuantileSketch): sketch with the same relative error
+
+        Returns:
+            QuantileSketch: sketch of the union of both
+        """
+        return QuantileSketch(self.counts.add(other.counts, fill_value=0).astype('int64'), self.relative_error)
+
+    def regroup(self, mapping):
+        """Merges groups into coarser groups, such as days into months
+
+        Args:
+            mapping (pandas.Series): new key of each current key, current keys missing from it are left out
+
+        Returns:
+            QuantileSketch: sketch of each new group
+        """
+        new_keys = mapping.reindex(self.counts.index.get_level_values(0)).to_numpy()
+        kept = ~pd.isna(new_keys)
+        counts = self.counts[kept]
+        grouped = counts.groupby([new_keys[kept], counts.index.get_level_values(1)]).sum()
+        return QuantileSketch(grouped, self.relative_error)
+
+    def evaluate(self, keys, q=50):
+        """Estimates a quantile of each group
+
+        Args:
+            keys (pandas.Index): groups to estimate
+            q (float): percentile, from 0 to 100. Defaults to 50.
+
+        Returns:
+            numpy.ndarray: estimated quantile of each group, NaN for groups without values
+        """
+        if(len(self.counts) == 0):
+            return np.full(len(keys), np.nan)
+
+        counts = self.counts.sort_index()
+        groups = counts.index.get_level_values(0)
+        ranks = counts.groupby(level=0).cumsum()
+        totals = counts.groupby(level=0).sum()
+
+        # first bucket whose cumulative count passes the rank of the quantile, as in np.percentile(..., interpolation='lower')
+        targets = np.floor(q / 100 * (totals - 1)).reindex(groups).to_numpy()
+        passed = ranks.to_numpy() > targets
+        buckets = pd.Series(counts.index.get_level_values(1)[passed], index=groups[passed]).groupby(level=0).first()
+        return pd.Series(self.get_values(buckets.to_numpy()), index=buckets.index).reindex(keys).to_numpy().astype('float64')
+
+
+# sketch backing each sketch-based agg_operation
+SKETCHES = {
+    'count_distinct': HyperLogLog,
+    'percentile': QuantileSketch
+}
+
+def build_sketch(op, keys, values, params):
+    """Sketches the values of each group for a sketch-based agg_operation
+
+    Args:
+        op (str): agg_operation, one of the SKETCHES keys
+        keys (numpy.ndarray): group key of each value
+        values (numpy.ndarray or pandas.Series): values
+        params (dict): parameters of the agg_operation, the ones used by the sketch are picked
+
+    Returns:
+        HyperLogLog or QuantileSketch: sketch of each group
+    """
+    sketch_class = SKETCHES[op]
+    return sketch_class.from_values(keys, values, **{name: value for name, value in params.items() if name in sketch_class.PARAMETERS})
+
+def evaluate_sketch(sketch, keys, params):
+    """Evaluates a sketch-based agg_operation for each group
+
+    Args:
+        sketch (HyperLogLog or QuantileSketch): sketch of each group
+        keys (pandas.Index): groups to evaluate
+        params (dict): parameters of the agg_operation, the ones not used by the sketch are passed to the evaluation (the percentile)
+
+    Returns:
+        numpy.ndarray: value of each group
+    """
+    return sketch.evaluate(keys, **{name: value for name, value in params.items() if name not in sketch.PARAMETERS})
+
+def get_sketch_key(op, params):
+    """Identifies the sketch of an agg_operation, agg_operations differing only in their evaluation (the percentile) share it"""
+    return (op,) + tuple(sorted((name, value) for name, value in params.items() if name in SKETCHES[op].PARAMETERS))
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Local columnar snapshots of datasets loaded from Elasticsearch, used for fast cold starts
+"""
+
+import os
+import re
+import time
+import glob
+import fcntl
+import hashlib
+from contextlib import contextmanager
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+class SnapshotStore:
+    """Feather snapshot cache for datasets loaded from the Elasticsearch data store
+
+    Snapshots are keyed by index name and data version (see Searcher.get_index_version), so a new snapshot is only written when the data index changes.
+    Every index pattern has its own subdirectory, holding the snapshots of its versions and its lock. Writing a snapshot removes the
+    snapshots of the versions published before it (see the published metadata), never newer ones still used by other processes.
+    Documents appended to a version are written as a segment holding only them, chained to the snapshot of the version they were appended
+    to, so a refresh does not rewrite the whole dataset. Reading a chain of segments copies the columns instead of mapping them, so chains
+    are compacted back into a single file after max_segments appends.
+    Snapshots are written uncompressed and as a single record batch, so they can be memory-mapped and columns without missing values are
+    read as views of the mapped pages, which are only read from disk when touched.
+
+    Args:
+        snapshot_dir (str): local directory where snapshots are stored
+
+    Attributes:
+        snapshot_dir (str): local directory where snapshots are stored
+
+    """
+    # name of the column holding the Elasticsearch document ids, since feather does not store the dataframe index
+    id_column = '_id'
+    # prefix of the schema metadata keys describing how a snapshot was written, such as the version it was appended to
+    metadata_prefix = 'datapages.'
+    # number of appended segments a snapshot is made of before it is compacted into a single file
+    max_segments = 8
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def get_snapshot_path(self, index_name, version):
+        """Builds the local path of a snapshot
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+            version (str): data version of the snapshot
+
+        Returns:
+            path (str): path to the feather file
+        """
+        return os.path.join(self.get_snapshot_directory(index_name), f'{version}.feather')
+
+    def get_snapshot_directory(self, index_name):
+        """Builds the subdirectory holding every version of the snapshot of an index pattern, created when missing
+
+        Index patterns may contain wildcards and commas, so unsafe characters are replaced and a hash of the pattern is appended to keep
+        patterns such as orders-* and orders_* apart.
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+
+        Returns:
+            directory (str): path to the subdirectory of the index pattern
+        """
+        name_hash = hashlib.sha1(index_name.encode()).hexdigest()[:8]
+        directory = os.path.join(self.snapshot_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', index_name)}-{name_hash}")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def get_snapshot_columns(self, index_name, version):
+        """Lists the columns stored in the snapshot of an index at the given version, without reading any data
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+            version (str): data version of the snapshot
+
+        Returns:
+            columns (list): columns available in the snapshot, empty if there is no snapshot for this version
+        """
+        path = self.get_snapshot_path(index_name, version)
+        if(not os.path.exists(path)):
+            return []
+
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+        return [column for column in schema.names if column != self.id_column]
+
+    def get_snapshot_metadata(self, index_name, version):
+        """Reads the metadata a snapshot was written with, without reading any data
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+            version (str): data version of the snapshot
+
+        Returns:
+            metadata (dict): metadata values by key, empty if there is no snapshot for this version
+        """
+        return self.read_metadata(self.get_snapshot_path(index_name, version))
+
+    def read_metadata(self, path):
+        """Reads the metadata of a snapshot file, without reading any data
+
+        Args:
+            path (str): path to the feather file
+
+        Returns:
+            metadata (dict): metadata values by key, empty if the file does not exist
+        """
+        try:
+            with pa.memory_map(path) as source:
+                schema_metadata = pa.ipc.open_file(source).schema.metadata or {}
+        except FileNotFoundError:
+            return {}
+        return {
+            key.decode()[len(self.metadata_prefix):]: value.decode()
+            for key, value in schema_metadata.items() if key.decode().startswith(self.metadata_prefix)
+        }
+
+    def get_snapshot_chain(self, index_name, version):
+        """Lists the versions whose files make up the snapshot of an index, from the single file snapshot to the latest appended segment
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+            version (str): data version of the snapshot
+
+        Returns:
+            chain (list): versions of the files to read in order, the given version alone when the snapshot is a single file
+        """
+        chain = [version]
+        metadata = self.get_snapshot_metadata(index_name, version)
+        while(int(metadata.get('segments', 0)) > 0):
+            chain.insert(0, metadata['appended_to'])
+            metadata = self.get_snapshot_metadata(index_name, metadata['appended_to'])
+        return chain
+
+    def read_snapshot(self, index_name, version, columns=None):
+        """Memory-maps the snapshot of an index at the given version, a snapshot made of appended segments is read as one frame
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+            version (str): data version of the snapshot
+            columns (list): subset of columns to read. Defaults to None, reading every column.
+
+        Returns:
+            pandas.DataFrame: dataframe indexed by document id, or None if there is no snapshot for this version
+        """
+        return self.read_files([self.get_snapshot_path(index_name, chained) for chained in self.get_snapshot_chain(index_name, version)], columns)
+
+    def read_segment(self, index_name, version, columns=None):
+        """Memory-maps the file of a snapshot at the given version alone, holding only the appended documents when it is a segment
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+            version (str): data version of the snapshot
+            columns (list): subset of columns to read. Defaults to None, reading every column.
+
+        Returns:
+            pandas.DataFrame: dataframe indexed by document id, or None if there is no snapshot for this version
+        """
+        return self.read_files([self.get_snapshot_path(index_name, version)], columns)
+
+    def read_files(self, paths, columns=None):
+        """Reads snapshot files as a single frame, a single file is memory-mapped and read without copies
+
+        Args:
+            paths (list): paths to the feather files, in order
+            columns (list): subset of columns to read. Defaults to None, reading every column.
+
+        Returns:
+            pandas.DataFrame: dataframe indexed by document id, or None if a file is missing
+        """
+        if(not all(os.path.exists(path) for path in paths)):
+            return None
+
+        if(columns is not None):
+            columns = [self.id_column] + [column for column in columns if column != self.id_column]
+
+        tables = [feather.read_table(path, columns=columns, memory_map=True) for path in paths]
+        table = tables[0] if len(tables) == 1 else pa.concat_tables(tables)
+        return table.to_pandas(split_blocks=True).set_index(self.id_column).rename_axis(None)
+
+    def prepare_frame(self, frame):
+        """Converts a dataset to the layout it is stored with, stored as is by default
+
+        Args:
+            frame (pandas.DataFrame): dataset with its document ids in the id column
+
+        Returns:
+            pandas.DataFrame: dataset as written to the snapshot
+        """
+        return frame
+
+    def get_nbytes(self, frame, index=True):
+        """Measures the memory a process holds for a frame read from the store, every column counts by default
+
+        Args:
+            frame (pandas.DataFrame): columns read from a snapshot
+            index (bool): whether the index is measured too. Defaults to True.
+
+        Returns:
+            int: memory footprint of the frame, in bytes
+        """
+        return int(frame.memory_usage(index=index, deep=True).sum())
+
+    @contextmanager
+    def lock(self, index_name):
+        """Holds an exclusive lock on the snapshots of an index, shared by every process using the snapshot directory
+
+        Used to let a single process fetch missing data from Elasticsearch and write the snapshot, while the others wait and read it.
+
+        Args:
+            index_name (str): index pattern the snapshot was loaded from
+
+        Returns:
+            None -> the lock is held within the with block
+        """
+        lock_path = os.path.join(self.get_snapshot_directory(index_name), 'snapshot.lock')
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_snapshot(self, dataframe, index_name, version, metadata=None):
+        """Writes the snapshot of an index as a single file and removes snapshots of previous versions
+
+        Args:
+            dataframe (pandas.DataFrame): dataset loaded from the data index, indexed by document id
+            index_name (str): index pattern the dataset was loaded from
+            version (str): data version of the dataset
+            metadata (dict): string values stored with the snapshot (see get_snapshot_metadata), published holding the time at which
+                the version was resolved. Defaults to None.
+
+        Returns:
+            None -> snapshot is stored in the snapshot directory
+        """
+        frame = self.prepare_frame(dataframe.rename_axis(self.id_column).reset_index())
+        # a single file snapshot, even when it replaces a chain of segments
+        metadata = {key: value for key, value in (metadata or {}).items() if key != 'segments'}
+        self.write_table(pa.Table.from_pandas(frame, preserve_index=False), index_name, version, metadata)
+
+    def append_snapshot(self, dataframe, appended, index_name, version, previous_version, metadata=None):
+        """Writes the snapshot of an index extended with appended documents, as a segment chained to the snapshot of the previous version
+
+        The whole dataset is written as a single file instead when the chain reached max_segments, or when the appended documents can not
+        be stored with the columns and types of the previous snapshot.
+
+        Args:
+            dataframe (pandas.DataFrame): dataset including the appended documents, indexed by document id
+            appended (pandas.DataFrame): appended documents, indexed by document id
+            index_name (str): index pattern the dataset was loaded from
+            version (str): data version of the dataset
+            previous_version (str): data version the documents were appended to
+            metadata (dict): string values stored with the snapshot (see get_snapshot_metadata). Defaults to None.
+
+        Returns:
+            None -> snapshot is stored in the snapshot directory
+        """
+        metadata = dict(metadata or {}, appended_to=previous_version)
+        previous_path = self.get_snapshot_path(index_name, previous_version)
+        segments = int(self.get_snapshot_metadata(index_name, previous_version).get('segments', 0)) + 1
+        if(segments > self.max_segments or not os.path.exists(previous_path)):
+            return self.write_snapshot(dataframe, index_name, version, metadata)
+
+        with pa.memory_map(previous_path) as source:
+            schema = pa.ipc.open_file(source).schema
+        frame = self.prepare_frame(appended.rename_axis(self.id_column).reset_index())
+        if(set(frame.columns) != set(schema.names)):
+            return self.write_snapshot(dataframe, index_name, version, metadata)
+        try:
+            # columns without values in the appended documents are inferred as nulls, and cast back to the types of the snapshot
+            table = pa.Table.from_pandas(frame[schema.names], preserve_index=False).cast(schema)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            return self.write_snapshot(dataframe, index_name, version, metadata)
+        self.write_table(table, index_name, version, dict(metadata, segments=segments))
+
+    def write_table(self, table, index_name, version, metadata):
+        """Writes a snapshot file and removes the files of previous versions it is not chained to
+
+        The file is written under a temporary name and then atomically renamed, so concurrent replicas never read a partial snapshot.
+
+        Args:
+            table (pyarrow.Table): columns of the snapshot file, with the document ids in the id column
+            index_name (str): index pattern the dataset was loaded from
+            version (str): data version of the dataset
+            metadata (dict): string values stored with the snapshot, published defaulting to the current time
+
+        Returns:
+            None -> snapshot is stored in the snapshot directory
+        """
+        path = self.get_snapshot_path(index_name, version)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+
+        metadata = dict(metadata, published=metadata.get('published', time.time()))
+
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            **{f'{self.metadata_prefix}{key}'.encode(): str(value).encode() for key, value in metadata.items()}
+        })
+        feather.write_feather(table, temp_path, compression='uncompressed', chunksize=max(table.num_rows, 1))
+        os.replace(temp_path, path)
+
+        # versions published before this one are no longer needed, while newer ones are still used by the processes that loaded them
+        # (a process still on an older version rewrites it when it loads more columns)
+        published = float(metadata['published'])
+        chained = {self.get_snapshot_path(index_name, chained) for chained in self.get_snapshot_chain(index_name, version)}
+        for stale_path in glob.glob(os.path.join(glob.escape(os.path.dirname(path)), '*.feather')):
+            if(stale_path not in chained and float(self.read_metadata(stale_path).get('published', 0)) < published):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    # already removed by another replica
+                    pass
+
+
+class SharedSnapshotStore(SnapshotStore):
+    """Snapshot store shared by the worker processes of a host, publishing each dataset once as memory-mapped Arrow buffers
+
+    The snapshot directory is meant to live in shared memory (such as /dev/shm), so every process maps the same pages instead of holding
+    its own copy of the dataset. String columns holding repeated values are dictionary-encoded and read as pandas categoricals, so apart
+    from document ids, mostly distinct strings and the dictionaries, the columns of every worker are zero-copy views of the published
+    buffers. A new version is published under a new file and atomically renamed into place: workers keep reading the version they mapped
+    until they swap to the new one.
+
+    Args:
+        snapshot_dir (str): local directory where snapshots are stored, preferably on a shared memory file system
+
+    Attributes:
+        snapshot_dir (str): local directory where snapshots are stored
+
+    """
+    # string columns with more distinct values than this fraction of their rows (such as identifiers) are not dictionary-encoded
+    max_distinct_ratio = 0.5
+    # appends are published as a single file, so every worker keeps mapping the shared pages instead of copying a chain of segments
+    max_segments = 0
+
+    def prepare_frame(self, frame):
+        """Dictionary-encodes the string columns of a dataset holding repeated values, document ids are kept as they are
+
+        Args:
+            frame (pandas.DataFrame): dataset with its document ids in the id column
+
+        Returns:
+            pandas.DataFrame: dataset with categorical string columns
+        """
+        frame = frame.copy(deep=False)
+        for column in frame.columns:
+            if(column == self.id_column or not pd.api.types.is_string_dtype(frame[column])):
+                continue
+            try:
+                encoded = frame[column].astype('category')
+            except TypeError:
+                # unhashable values (such as arrays of a multi-valued field) are stored as they are
+                continue
+            if(len(encoded.cat.categories) <= self.max_distinct_ratio * len(encoded)):
+                frame[column] = encoded
+        return frame
+
+    def get_nbytes(self, frame, index=True):
+        """Measures the memory a process holds for a frame read from the store, leaving out the columns mapped from shared memory
+
+        The document ids, strings that were not dictionary-encoded and columns with missing values (filled in by pandas) are copied
+        by every worker, the other columns are views of the published buffers and are not charged to any of them.
+
+        Args:
+            frame (pandas.DataFrame): columns read from a snapshot
+            index (bool): whether the index is measured too. Defaults to True.
+
+        Returns:
+            int: private memory footprint of the frame, in bytes
+        """
+        private = [
+            column for column in frame.columns
+            if(not isinstance(frame[column].dtype, pd.CategoricalDtype) and (frame[column].dtype == object or frame[column].hasnans))
+        ]
+        return int(frame[private].memory_usage(index=index, deep=True).sum())
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core aggregation of data indices too large to be loaded in memory, streamed in chunks over sliced scrolls and merged from partials
+"""
+
+import numpy as np
+import pandas as pd
+
+from aggregations import get_day_offsets, bin_days, get_period_labels, get_day_window, select_top
+from sketches import SKETCHES, build_sketch, evaluate_sketch
+from metrics import track
+
+# values kept for each group to estimate medians, the rank error of the estimate is about 1 / sqrt(MEDIAN_SAMPLE_SIZE)
+MEDIAN_SAMPLE_SIZE = 2048
+
+# agg_operations whose partials give the same output as aggregating every row, medians are only estimated from samples
+EXACT_OPERATIONS = {'count', 'sum', 'mean', 'count_distinct', 'percentile'}
+
+class PartialAggregate:
+    """Mergeable partial aggregation of the chunks of a data index, for one spec plan
+
+    Counts, sums and means are exact: each partial holds the rows of each group, and the sum and count of its non-missing values.
+    Medians are approximate: each partial holds a uniform sample of at most MEDIAN_SAMPLE_SIZE values of each group (bottom-k sampling
+    over random priorities, which stays uniform when merged), and the median of the sample is reported. Groups with fewer values
+    than the sample size get their exact median.
+    Distinct counts and percentiles merge the HyperLogLog and quantile sketches of each chunk, within the error bound of the plan.
+
+    Args:
+        plan (plans.SpecPlan): compiled spec plan being aggregated
+        seed (int): seed of the sampling priorities of medians. Defaults to None.
+
+    Attributes:
+        plan (plans.SpecPlan): compiled spec plan being aggregated
+        rows (pandas.Series): rows of each group, by group key (period offsets for timeseries specs, tuples of the group fields for crosstab specs)
+        sums (pandas.Series): sum of the non-missing values of each group
+        counts (pandas.Series): number of non-missing values of each group
+        sample (pandas.DataFrame): sampled values (key, priority, value) of each group, for medians
+        sketch (sketches.HyperLogLog or sketches.QuantileSketch): sketch of each group, for distinct counts and percentiles
+        integers (bool): whether every chunk held integer values, whose sums are kept as integers
+
+    """
+    def __init__(self, plan, seed=None):
+        self.plan = plan
+        self.random = np.random.default_rng(seed)
+        self.rows = pd.Series(dtype='int64')
+        self.sums = pd.Series(dtype='float64')
+        self.counts = pd.Series(dtype='int64')
+        self.sample = pd.DataFrame({'key': [], 'priority': [], 'value': []})
+        self.sketch = None
+        self.integers = True
+
+    @classmethod
+    def from_group_keys(cls, plan, keys, data):
+        """Builds the partial of a dataset from the group keys it was aggregated over, reusing their partial reductions
+
+        Only the group-level partials are converted, the rows are not read again, so the partial of an in-memory aggregation
+        is kept at little cost and later rows (such as documents appended to the index) can be merged into it.
+
+        Args:
+            plan (plans.SpecPlan): compiled spec plan, aggregating every row (without a time window)
+            keys (aggregations.GroupKeys): group keys the dataset was aggregated over
+            data (pandas.DataFrame or datasets.ProjectedDataset): dataset that was aggregated
+
+        Returns:
+            PartialAggregate: partial of the dataset, or None if the agg_operation of the plan is not exact (see EXACT_OPERATIONS)
+        """
+        if(plan.agg_operation not in EXACT_OPERATIONS):
+            return None
+
+        partial = cls(plan)
+        group_keys = partial.get_group_keys(keys)
+        partial.rows = pd.Series(keys.count(), index=group_keys).astype('int64')
+        if(plan.agg_operation == 'count'):
+            return partial
+
+        values = data[plan.agg_field]
+        if(plan.agg_operation in SKETCHES):
+            sketch = keys.get_sketch(values, plan.agg_operation, dict(plan.agg_params))
+            partial.sketch = sketch.regroup(pd.Series(group_keys, index=np.arange(keys.size)))
+            return partial
+
+        sums, counts = keys.get_partials(values)
+        filled = counts > 0
+        partial.sums = pd.Series(sums[filled], index=group_keys[filled])
+        partial.counts = pd.Series(counts[filled], index=group_keys[filled])
+        partial.integers = bool(np.issubdtype(np.asarray(values).dtype, np.integer))
+        return partial
+
+    def get_group_keys(self, keys):
+        """Converts the labels of group keys into the keys of the partial: labels, period offsets or tuples of both for crosstab specs"""
+        def convert(labels, binned):
+            if(not binned):
+                return np.asarray(labels, dtype=object)
+            days, _ = get_day_offsets(pd.Series(labels))
+            return bin_days(days, self.plan.period)
+
+        if(self.plan.report_type != 'crosstab'):
+            return pd.Index(convert(keys.labels, self.plan.report_type == 'timeseries'))
+
+        components = [
+            convert(component.labels, component.name == self.plan.time_field)[group_codes]
+            for component, group_codes in zip(keys.components, keys.component_codes)
+        ]
+        group_keys = np.empty(keys.size, dtype=object)
+        group_keys[:] = list(zip(*components))
+        return pd.Index(group_keys, tupleize_cols=False)
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the partials, in bytes"""
+        series = (self.rows, self.sums, self.counts)
+        return (sum(int(partial.memory_usage(index=True, deep=True)) for partial in series)
+                + int(self.sample.memory_usage(index=True, deep=True).sum()) + (self.sketch.nbytes if self.sketch is not None else 0))
+
+    def get_keys(self, frame, time_range=None):
+        """Computes the group key of each row of a chunk
+
+        Args:
+            frame (pandas.DataFrame): chunk of the data index
+            time_range (tuple): (start, end) dates, both inclusive, restricting the rows of timeseries specs. Defaults to None.
+
+        Returns:
+            tuple: (keys, valid) arrays, the group key of each row and whether the row belongs to a group
+        """
+        if(self.plan.report_type == 'crosstab'):
+            components = [self.get_field_keys(frame[field], field == self.plan.time_field, time_range) for field in self.plan.group_fields]
+            valid = np.logical_and.reduce([component_valid for _, component_valid in components])
+            keys = np.empty(len(frame), dtype=object)
+            keys[:] = list(zip(*[component_keys for component_keys, _ in components]))
+            return keys, valid
+        return self.get_field_keys(frame[self.plan.group_field], self.plan.report_type == 'timeseries', time_range)
+
+    def get_field_keys(self, series, binned, time_range=None):
+        """Computes the key of each row of a chunk for one group field: its values, or its period offsets for time fields"""
+        if(not binned):
+            return series.to_numpy(), series.notna().to_numpy()
+
+        days, valid = get_day_offsets(series)
+        if(time_range is not None):
+            first, last = get_day_window(time_range)
+            valid &= (days >= first) & (days <= last)
+        return bin_days(days, self.plan.period), valid
+
+    def add_chunk(self, frame, time_range=None):
+        """Aggregates a chunk into the partial
+
+        Args:
+            frame (pandas.DataFrame): chunk holding the dimensions of the plan
+            time_range (tuple): (start, end) dates, both inclusive, restricting the rows of timeseries specs. Defaults to None.
+
+        Returns:
+            None -> partials are updated in place
+        """
+        keys, valid = self.get_keys(frame, time_range)
+        keys = pd.Series(keys[valid])
+        self.merge_series('rows', keys.value_counts())
+
+        if(self.plan.agg_operation == 'count'):
+            return
+
+        values = frame[self.plan.agg_field]
+        if(self.plan.agg_operation in SKETCHES):
+            self.merge_sketch(build_sketch(self.plan.agg_operation, keys.to_numpy(), values.to_numpy()[valid], dict(self.plan.agg_params)))
+            return
+
+        self.integers &= bool(np.issubdtype(values.dtype, np.integer))
+        numbers = values.to_numpy(dtype='float64', na_value=np.nan)[valid]
+        present = ~np.isnan(numbers)
+        grouped = pd.Series(numbers[present]).groupby(keys[present].to_numpy())
+        self.merge_series('sums', grouped.sum())
+        self.merge_series('counts', grouped.size())
+
+        if(self.plan.agg_operation == 'median'):
+            chunk_sample = pd.DataFrame({
+                'key': keys[present].to_numpy(),
+                'priority': self.random.random(int(present.sum())),
+                'value': numbers[present]
+            })
+            self.merge_sample(chunk_sample)
+
+    def merge_series(self, name, partial):
+        """Adds a partial series into one of the partials, aligned on the group keys"""
+        setattr(self, name, getattr(self, name).add(partial, fill_value=0))
+
+    def merge_sample(self, sample):
+        """Merges sampled values, keeping the values with the lowest priorities of each group"""
+        sample = pd.concat([self.sample, sample], ignore_index=True) if len(self.sample) else sample
+        self.sample = sample.sort_values('priority', kind='stable').groupby('key', sort=False).head(MEDIAN_SAMPLE_SIZE)
+
+    def merge_sketch(self, sketch):
+        """Merges the sketch of other rows into the sketch of the partial"""
+        self.sketch = sketch if self.sketch is None else self.sketch.merge(sketch)
+
+    def merge(self, other):
+        """Merges the partial of other chunks into this one
+
+        Args:
+            other (PartialAggregate): partial of the same plan
+
+        Returns:
+            PartialAggregate: this partial, holding both
+        """
+        self.merge_series('rows', other.rows)
+        self.merge_series('sums', other.sums)
+        self.merge_series('counts', other.counts)
+        self.integers &= other.integers
+        if(len(other.sample)):
+            self.merge_sample(other.sample)
+        if(other.sketch is not None):
+            self.merge_sketch(other.sketch)
+        return self
+
+    def reduce(self, keys):
+        """Reduces the partials of the given groups, following the agg_operation of the plan
+
+        Args:
+            keys (pandas.Index): group keys
+
+        Returns:
+            numpy.ndarray: reduced value of each group (NaN for groups without values, but for counts, sums and distinct counts)
+        """
+        op = self.plan.agg_operation
+        if(op == 'count'):
+            return self.rows.reindex(keys, fill_value=0).to_numpy().astype('int64')
+        if(op == 'sum'):
+            sums = self.sums.reindex(keys, fill_value=0).to_numpy()
+            return sums.astype('int64') if self.integers else sums
+
+        if(op == 'mean'):
+            counts = self.counts.reindex(keys).to_numpy().astype('float64')
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return self.sums.reindex(keys).to_numpy().astype('float64') / counts
+        if(op == 'median'):
+            return self.sample.groupby('key')['value'].median().reindex(keys).to_numpy().astype('float64')
+        if(op in SKETCHES):
+            if(self.sketch is None):
+                return np.zeros(len(keys), dtype='int64') if op == 'count_distinct' else np.full(len(keys), np.nan)
+            return evaluate_sketch(self.sketch, keys, dict(self.plan.agg_params))
+        raise NotImplementedError(f'{op} operation is not supported')
+
+    def finalize(self, limit=10):
+        """Builds the output of the merged partials
+
+        Args:
+            limit (int): number of top groups kept for category specs, and of top categories of each field for crosstab specs. Defaults to 10.
+
+        Returns:
+            pandas.DataFrame: aggregated data in the same format produced by aggregations.aggregate
+        """
+        if(self.plan.report_type == 'crosstab'):
+            return self.finalize_crosstab(limit)
+
+        name = self.plan.group_field
+        if(self.plan.report_type == 'timeseries'):
+            # empty periods between the first and the last one are kept, the same way resampling does
+            if(len(self.rows)):
+                offsets = np.arange(int(self.rows.index.min()), int(self.rows.index.max()) + 1)
+            else:
+                offsets = np.zeros(0, dtype='int64')
+            reduced = self.reduce(pd.Index(offsets))
+            return pd.DataFrame({name: get_period_labels(offsets, self.plan.period, name), self.plan.agg_field: reduced})
+
+        keys = pd.Index(self.rows.index)
+        labels, reduced = select_top(keys, self.reduce(keys), limit)
+        return pd.DataFrame({name: labels, self.plan.agg_field: reduced})
+
+    def finalize_crosstab(self, limit=10):
+        """Builds the long-format output of a crosstab plan, keeping the combinations of the top categories of each field by rows"""
+        fields = list(self.plan.group_fields)
+        rows = self.rows.sort_index()
+        keys = pd.Index(rows.index, tupleize_cols=False)
+        levels = pd.MultiIndex.from_tuples(keys, names=fields) if len(keys) else pd.MultiIndex.from_arrays([[]] * len(fields), names=fields)
+
+        kept = np.ones(len(keys), dtype=bool)
+        for level, field in enumerate(fields):
+            if(field == self.plan.time_field):
+                continue
+            marginal = rows.groupby(levels.get_level_values(level).to_numpy()).sum()
+            top, _ = select_top(marginal.index, marginal.to_numpy(), limit)
+            kept &= levels.get_level_values(level).isin(top)
+
+        output = levels[kept].to_frame(index=False)
+        if(self.plan.time_field is not None):
+            offsets = output[self.plan.time_field].to_numpy().astype('int64')
+            output[self.plan.time_field] = get_period_labels(offsets, self.plan.period, self.plan.time_field)
+        output[self.plan.agg_field] = self.reduce(keys[kept])
+        return output
+
+
+class StreamingAggregator:
+    """Aggregates a data index without loading it, streaming the dimensions of a spec in chunks over sliced scrolls
+
+    Every slice is read by its own scroll (a consistent view of the index) on a worker of the executor, aggregating one chunk
+    at a time into a partial, and the partials of the slices are merged. Memory is bounded by the chunk size, the number of
+    slices read at the same time and the number of groups, whatever the size of the index.
+
+    Args:
+        es_client (elasticsearch.Elasticsearch): client used for the scrolls
+        index_reference (str): index pattern of the data index
+        executor (concurrent.futures.Executor): thread pool reading the slices. Defaults to None, reading the slices one after the other.
+        slices (int): number of slices the index is split into. Defaults to 4.
+        chunk_size (int): documents fetched by each scroll request. Defaults to 10000.
+        scroll (str): keep-alive of the scroll contexts between two requests. Defaults to "2m".
+
+    Attributes:
+        es_client (elasticsearch.Elasticsearch): client used for the scrolls
+        index_reference (str): index pattern of the data index
+        executor (concurrent.futures.Executor): thread pool reading the slices
+        slices (int): number of slices the index is split into
+        chunk_size (int): documents fetched by each scroll request
+        scroll (str): keep-alive of the scroll contexts between two requests
+
+    """
+    def __init__(self, es_client, index_reference, executor=None, slices=4, chunk_size=10000, scroll='2m'):
+        self.es_client = es_client
+        self.index_reference = index_reference
+        self.executor = executor
+        self.slices = slices
+        self.chunk_size = chunk_size
+        self.scroll = scroll
+
+    def stream_slice(self, columns, slice_id):
+        """Streams the documents of one slice of the index in chunks
+
+        Args:
+            columns (list): fields fetched for each document
+            slice_id (int): slice to read, between 0 and slices - 1
+
+        Returns:
+            generator: one pandas.DataFrame per chunk, holding the fetched fields
+        """
+        body = {'query': {'match_all': {}}, '_source': list(columns), 'sort': ['_doc']}
+        if(self.slices > 1):
+            body['slice'] = {'id': slice_id, 'max': self.slices}
+
+        response = self.es_client.search(index=self.index_reference, body=body, scroll=self.scroll, size=self.chunk_size)
+        scroll_id = response.get('_scroll_id')
+        try:
+            while(response['hits']['hits']):
+                yield pd.DataFrame.from_records([hit.get('_source', {}) for hit in response['hits']['hits']], columns=list(columns))
+                response = self.es_client.scroll(body={'scroll': self.scroll, 'scroll_id': scroll_id})
+                scroll_id = response.get('_scroll_id', scroll_id)
+        finally:
+            # scroll contexts hold resources on the cluster until they expire, so they are released as soon as the slice is read
+            if(scroll_id is not None):
+                self.es_client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+
+    def aggregate_slice(self, plan, slice_id, time_range=None):
+        """Aggregates one slice of the index into a partial
+
+        Args:
+            plan (plans.SpecPlan): compiled spec plan
+            slice_id (int): slice to read
+            time_range (tuple): (start, end) dates, both inclusive, restricting the rows of timeseries specs. Defaults to None.
+
+        Returns:
+            PartialAggregate: partial of the slice
+        """
+        partial = PartialAggregate(plan, seed=slice_id)
+        with track('stream_slice', plan.spec_id):
+            for frame in self.stream_slice(sorted(set(plan.group_fields) | {plan.agg_field}), slice_id):
+                partial.add_chunk(frame, time_range)
+        return partial
+
+    def aggregate(self, plan, limit=10, time_range=None):
+        """Aggregates the whole index for a spec plan, reading the slices in parallel and merging their partials
+
+        Args:
+            plan (plans.SpecPlan): compiled spec plan
+            limit (int): number of top groups kept for category specs. Defaults to 10.
+            time_range (tuple): (start, end) dates, both inclusive, restricting the rows of timeseries specs. Defaults to None.
+
+        Returns:
+            pandas.DataFrame: aggregated data in the same format produced by aggregations.aggregate
+        """
+        if(self.executor is None):
+            partials = [self.aggregate_slice(plan, slice_id, time_range) for slice_id in range(self.slices)]
+        else:
+            requests = [self.executor.submit(self.aggregate_slice, plan, slice_id, time_range) for slice_id in range(self.slices)]
+            partials = [request.result() for request in requests]
+
+        merged = partials[0]
+        for partial in partials[1:]:
+            merged.merge(partial)
+        return merged.finalize(limit)